@@ -38,7 +38,6 @@ from flask_discussion import Discussion
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
-from flask_misaka import Misaka
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 
@@ -47,9 +46,13 @@ import pytz
 import webassets
 
 from akamatsu.bootstrap import BASE_CONFIG
+from akamatsu.cache import PageRouteTable, ResponseCache
 from akamatsu.errors import forbidden, page_not_found, server_error
-from akamatsu.util import CeleryWrapper, CryptoManager, HashidsWrapper, \
-        HighlighterRenderer
+from akamatsu.mailer import MailQueue
+from akamatsu.metrics import Metrics
+from akamatsu.search import SearchIndex
+from akamatsu.util import CachedMisaka, CeleryWrapper, CryptoManager, \
+        HashidsWrapper, HighlighterRenderer, LRUCache
 
 __version__ = '2.0.0'
 
@@ -86,11 +89,14 @@ migrate = Migrate()
 # Flask-Mail
 mail = Mail()
 
+# Background mail delivery (without Celery)
+mail_queue = MailQueue()
+
 # Flask-Login
 login_manager = LoginManager()
 
-# Flask-Misaka
-md = Misaka(
+# Flask-Misaka (with cache)
+md = CachedMisaka(
     renderer=HighlighterRenderer(),
     fenced_code=True,
     underline=True,
@@ -109,6 +115,24 @@ celery = CeleryWrapper()
 # Flask-Discussion
 discussion = Discussion()
 
+# Serialized RSS feeds (invalidated when posts or users change)
+feed_cache = LRUCache(8)
+
+# Identities of logged in users (see `User.load_identity()`)
+identity_cache = LRUCache(1024)
+
+# Full-page cache for anonymous visitors
+response_cache = ResponseCache()
+
+# Page routes (rebuilt when pages change)
+page_routes = PageRouteTable()
+
+# Request instrumentation
+metrics = Metrics()
+
+# Full-text search of posts and pages
+search_index = SearchIndex()
+
 
 @babel.localeselector
 def get_locale():
@@ -208,6 +232,7 @@ def init_app():
 
     # Setup Flask-Mail
     mail.init_app(app)
+    mail_queue.init_app(app)
 
 
     # Setup Flask-Login
@@ -223,7 +248,10 @@ def init_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return models.User.get_by_id(user_id)
+        return models.User.load_identity(
+            user_id,
+            ttl=app.config.get('LOGIN_CACHE_TTL', 0)
+        )
 
 
     # Enable Celery support (optional)
@@ -231,13 +259,29 @@ def init_app():
         celery.init_app(app)
 
         # Import tasks
-        from akamatsu.async_tasks import async_mail
+        from akamatsu.async_tasks import async_image_variants, async_mail
 
 
     # Setup Flask-Misaka
     md.init_app(app)
 
 
+    # Setup response cache
+    response_cache.init_app(app)
+
+
+    # Setup page route table
+    page_routes.init_app(app)
+
+
+    # Setup request instrumentation (optional)
+    metrics.init_app(app)
+
+
+    # Setup full-text search
+    search_index.init_app(app)
+
+
     # Setup Flask-Assets and bundles
     assets.init_app(app)
     libsass = webassets.filter.get_filter(
@@ -28,13 +28,43 @@
 """This file contains celery tasks."""
 
 
+from flask import current_app
 from flask_mail import Message
 
-from akamatsu import celery, mail
+from akamatsu import celery
+from akamatsu.images import generate_variants
+from akamatsu.mailer import PERMANENT_ERRORS, RETRY_ERRORS, SMTPConnection
 
 
-@celery.task()
-def async_mail(*args, **kwargs):
-    """Send Flask-Mail emails asynchronously."""
+# SMTP connection reused by the tasks run in this worker process
+_smtp = SMTPConnection()
+
+
+@celery.task(bind=True, max_retries=3)
+def async_mail(self, *args, **kwargs):
+    """Send Flask-Mail emails asynchronously.
+
+    The SMTP connection is reused across tasks and failed deliveries are
+    retried with exponential backoff.
+    """
     message = Message(*args, **kwargs)
-    mail.send(message)
+    _smtp.idle_timeout = current_app.config.get('MAIL_IDLE_TIMEOUT', 30)
+
+    try:
+        _smtp.send(message)
+
+    except PERMANENT_ERRORS:
+        # Sending again will not help
+        raise
+
+    except RETRY_ERRORS as e:
+        raise self.retry(
+            exc=e,
+            countdown=current_app.config.get('MAIL_RETRY_BACKOFF', 2) * 2 ** self.request.retries
+        )
+
+
+@celery.task()
+def async_image_variants(content_hash, mime):
+    """Generate the variants of an uploaded image."""
+    generate_variants(content_hash, mime)
@@ -0,0 +1,956 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the import and export of data backups.
+
+Backups are newline-delimited JSON files, where each line is an entity
+(user, page, post or upload) serialized as
+`{"entity": <name>, "data": <attributes>}`.
+
+Backup files may be compressed with gzip or zstd (the latter requires the
+`zstandard` package). A backup may also be split in shards (one file per
+entity type) listed in a `manifest.json` file along with their checksums.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import time
+
+import slugify
+
+from flask import current_app
+from sqlalchemy import bindparam
+from sqlalchemy.orm import aliased
+
+try:
+    import zstandard
+    _HAS_ZSTD = True
+
+except ImportError:
+    _HAS_ZSTD = False
+
+from akamatsu import db, feed_cache, page_routes, response_cache, \
+        search_index
+from akamatsu.models import FEED_VERSION, CacheVersion, FileUpload, Page, \
+        Post, Role, Tag, User, post_tags, user_posts, user_roles
+
+
+# Format of dates in backups
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Entities that can be found in a backup (in insertion order)
+ENTITIES = ('user', 'page', 'post', 'upload')
+
+# Supported compression methods and their file extensions
+COMPRESSIONS = OrderedDict([
+    ('gzip', '.gz'),
+    ('zstd', '.zst')
+])
+
+# Name of the manifest of sharded backups
+MANIFEST_NAME = 'manifest.json'
+
+# Magic numbers of compressed files
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class BackupExporter(object):
+    """Streaming exporter of backup files.
+
+    Entities are read with column queries in batches (`yield_per()`) instead
+    of hydrating ORM instances, and their relations (roles, authors and tags)
+    are obtained with one query per batch. Ghosted entities are obtained in
+    the same query through a self join.
+
+    Args:
+        batch_size (int): Number of entities to read per batch.
+        compression (str): Compression method (see `COMPRESSIONS`) or `None`.
+        echo: Function used to report progress.
+    """
+
+    def __init__(self, batch_size=1000, compression=None, echo=print):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression method: {}'.format(compression))
+
+        if compression == 'zstd' and not _HAS_ZSTD:
+            raise RuntimeError('zstd compression requires the zstandard package')
+
+        self.batch_size = batch_size
+        self.compression = compression
+        self.echo = echo
+
+    def export(self, path, entities=ENTITIES):
+        """Export entities to a single file.
+
+        Args:
+            path (str): Path of the file to write.
+            entities (tuple): Types of the entities to export.
+
+        Returns:
+            Dictionary with the number of entities, size and SHA-256 checksum
+            of the file.
+        """
+        started = time.monotonic()
+        count = 0
+
+        raw = _DigestWriter(open(path, 'wb'))
+
+        try:
+            with self._open_text(raw) as out:
+                for entity in entities:
+                    for data in getattr(self, '_iter_{}s'.format(entity))():
+                        out.write(
+                            json.dumps({'entity': entity, 'data': data}) + '\n'
+                        )
+                        count += 1
+
+        finally:
+            raw.close()
+
+        self.echo('Exported {} entities to {} in {:.1f}s'.format(
+            count,
+            path,
+            time.monotonic() - started
+        ))
+
+        return {
+            'count': count,
+            'size': raw.size,
+            'sha256': raw.digest.hexdigest()
+        }
+
+    def export_shards(self, directory, jobs=4):
+        """Export each entity type to its own file concurrently.
+
+        Shards are written to the given directory along with a manifest
+        listing them and their checksums.
+
+        Args:
+            directory (str): Directory to write the shards to.
+            jobs (int): Maximum number of shards to export at the same time.
+
+        Returns:
+            Path to the manifest.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        app = current_app._get_current_object()
+        extension = '.ndjson' + COMPRESSIONS.get(self.compression, '')
+
+        def _export_shard(entity):
+            # Each thread uses its own application context (and session)
+            with app.app_context():
+                try:
+                    name = '{}{}'.format(entity, extension)
+                    shard = self.export(os.path.join(directory, name), (entity,))
+                    shard.update(entity=entity, file=name)
+
+                    return shard
+
+                finally:
+                    db.session.remove()
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            shards = list(executor.map(_export_shard, ENTITIES))
+
+        manifest = {
+            'version': 1,
+            'created_at': datetime.datetime.utcnow().strftime(DATE_FORMAT),
+            'compression': self.compression,
+            'shards': shards
+        }
+
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        return manifest_path
+
+    def _open_text(self, raw):
+        """Open a text stream on top of a binary file, compressing if needed.
+
+        Args:
+            raw: Binary file to write to.
+
+        Returns:
+            Text stream.
+        """
+        if self.compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+
+        elif self.compression == 'zstd':
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+
+        else:
+            stream = io.BufferedWriter(raw)
+
+        return io.TextIOWrapper(stream, encoding='utf-8')
+
+    def _iter_users(self):
+        """Obtain the data of all the users.
+
+        Yields:
+            Dictionaries with the data of the users.
+        """
+        query = (
+            db.session.query(
+                User.id,
+                User.username,
+                User.password,
+                User.reset_password_token,
+                User.email,
+                User.is_active,
+                User.first_name,
+                User.last_name,
+                User.personal_bio,
+                User.notify_login
+            )
+            .order_by(User.id)
+        )
+
+        for batch in self._batches(query):
+            roles = self._fetch_names(
+                db.session.query(user_roles.c.user_id, Role.name)
+                .join(Role, Role.id == user_roles.c.role_id)
+                .filter(user_roles.c.user_id.in_([row.id for row in batch]))
+            )
+
+            for row in batch:
+                data = row._asdict()
+                del data['id']
+                data['roles'] = roles.get(row.id, [])
+
+                yield data
+
+    def _iter_pages(self):
+        """Obtain the data of all the pages.
+
+        Yields:
+            Dictionaries with the data of the pages.
+        """
+        ghosted = aliased(Page)
+        query = (
+            db.session.query(
+                Page.title,
+                Page.mini,
+                Page.route,
+                Page.custom_head,
+                Page.content,
+                Page.is_published,
+                Page.comments_enabled,
+                ghosted.route.label('ghosted'),
+                Page.last_updated
+            )
+            .outerjoin(ghosted, Page.ghosted_id == ghosted.id)
+            .order_by(Page.id)
+        )
+
+        for batch in self._batches(query):
+            for row in batch:
+                data = row._asdict()
+                data['last_updated'] = data['last_updated'].strftime(DATE_FORMAT)
+
+                yield data
+
+    def _iter_posts(self):
+        """Obtain the data of all the posts.
+
+        Yields:
+            Dictionaries with the data of the posts.
+        """
+        ghosted = aliased(Post)
+        query = (
+            db.session.query(
+                Post.id,
+                Post.title,
+                Post.slug,
+                Post.content,
+                Post.is_published,
+                Post.comments_enabled,
+                Post.last_updated,
+                ghosted.slug.label('ghosted')
+            )
+            .outerjoin(ghosted, Post.ghosted_id == ghosted.id)
+            .order_by(Post.id)
+        )
+
+        for batch in self._batches(query):
+            ids = [row.id for row in batch]
+
+            authors = self._fetch_names(
+                db.session.query(user_posts.c.post_id, User.username)
+                .join(User, User.id == user_posts.c.user_id)
+                .filter(user_posts.c.post_id.in_(ids))
+            )
+            tags = self._fetch_names(
+                db.session.query(post_tags.c.post_id, Tag.name)
+                .join(Tag, Tag.id == post_tags.c.tag_id)
+                .filter(post_tags.c.post_id.in_(ids))
+            )
+
+            for row in batch:
+                data = row._asdict()
+                del data['id']
+                data['last_updated'] = data['last_updated'].strftime(DATE_FORMAT)
+                data['authors'] = authors.get(row.id, [])
+                data['tags'] = tags.get(row.id, [])
+
+                yield data
+
+    def _iter_uploads(self):
+        """Obtain the data of all the uploads.
+
+        Yields:
+            Dictionaries with the data of the uploads.
+        """
+        query = (
+            db.session.query(
+                FileUpload.path,
+                FileUpload.description,
+                FileUpload.mime,
+                FileUpload.uploaded_at,
+                FileUpload.content_hash
+            )
+            .order_by(FileUpload.id)
+        )
+
+        for batch in self._batches(query):
+            for row in batch:
+                data = row._asdict()
+                data['uploaded_at'] = data['uploaded_at'].strftime(DATE_FORMAT)
+
+                yield data
+
+    def _batches(self, query):
+        """Read the results of a query in batches.
+
+        Args:
+            query: Query to read.
+
+        Yields:
+            Lists of rows.
+        """
+        results = iter(query.yield_per(self.batch_size))
+
+        while True:
+            batch = list(islice(results, self.batch_size))
+
+            if not batch:
+                return
+
+            yield batch
+
+    def _fetch_names(self, query):
+        """Group the results of a query of (ID, name) rows by ID.
+
+        Args:
+            query: Query to execute.
+
+        Returns:
+            Dictionary mapping IDs to lists of names.
+        """
+        names = {}
+
+        for item_id, name in query:
+            names.setdefault(item_id, []).append(name)
+
+        return names
+
+
+class BackupImporter(object):
+    """Streaming importer of backup files.
+
+    Lines are read one at a time and entities are inserted in batches with
+    `executemany` (through `bulk_insert_mappings()`) instead of going through
+    the ORM unit of work, so memory usage does not depend on the size of the
+    backup.
+
+    Roles, tags and users are resolved through in-memory maps of name to ID.
+    Relations to entities which may not have been imported yet (ghosts and
+    authors not yet seen) are kept aside and set at the end with batched
+    statements.
+
+    Bulk operations do not trigger ORM events, therefore the markdown content
+    is rendered here and caches must be invalidated with `invalidate_caches()`
+    once the transaction has been committed.
+
+    Attributes:
+        counts (OrderedDict): Number of entities imported, by type.
+        errors (int): Number of lines or relations that could not be imported.
+
+    Args:
+        batch_size (int): Number of entities to insert per batch.
+        echo: Function used to report progress and errors.
+    """
+
+    def __init__(self, batch_size=500, echo=print):
+        self.batch_size = batch_size
+        self.echo = echo
+
+        self.counts = OrderedDict((entity, 0) for entity in ENTITIES)
+        self.errors = 0
+
+        self._batches = {entity: [] for entity in ENTITIES}
+        self._started = None
+
+        # Maps of name to ID
+        self._roles = {}
+        self._tags = {}
+        self._users = {}
+
+        # Relations set at the end of the import
+        self._page_ghosts = []
+        self._post_ghosts = []
+        self._post_authors = []
+
+    @property
+    def total(self):
+        """Total number of entities imported."""
+        return sum(self.counts.values())
+
+    @property
+    def elapsed(self):
+        """Seconds elapsed since the import started."""
+        if self._started is None:
+            return 0
+
+        return time.monotonic() - self._started
+
+    def run(self, lines):
+        """Import the entities in the given lines.
+
+        Everything is executed in the current transaction, which is neither
+        committed nor rolled back here.
+
+        Args:
+            lines: Iterable of lines of the backup (e.g. an open file).
+        """
+        self._started = time.monotonic()
+
+        self._roles = dict(db.session.query(Role.name, Role.id))
+        self._tags = dict(db.session.query(Tag.name, Tag.id))
+        self._users = dict(db.session.query(User.username, User.id))
+
+        for line in lines:
+            line = line.strip()
+
+            if not line:
+                continue
+
+            try:
+                struct = json.loads(line)
+
+            except ValueError:
+                self._error('Malformed data: {}'.format(line))
+                continue
+
+            if not isinstance(struct, dict):
+                self._error('Malformed data: {}'.format(line))
+                continue
+
+            entity = struct.get('entity')
+            data = struct.get('data')
+
+            if not data or not isinstance(data, dict):
+                self._error('Malformed data: {}'.format(line))
+                continue
+
+            if entity not in self._batches:
+                self._error('Invalid entity: {}'.format(line))
+                continue
+
+            batch = self._batches[entity]
+            batch.append(data)
+
+            if len(batch) >= self.batch_size:
+                self._flush(entity)
+
+        for entity in ENTITIES:
+            if self._batches[entity]:
+                self._flush(entity)
+
+        # Relations
+        self.echo('Setting relations...')
+
+        self._set_ghosts(Page, Page.route, self._page_ghosts)
+        self._set_ghosts(Post, Post.slug, self._post_ghosts)
+        self._set_pending_authors()
+
+        # Page routes are cached by the application
+        if self.counts['page']:
+            CacheVersion.bump(db.session.connection(), page_routes.VERSION_NAME)
+
+        # Feed validators include its version stamp
+        if self.counts['post'] or self.counts['user']:
+            CacheVersion.bump(db.session.connection(), FEED_VERSION)
+
+        # Bulk inserts do not trigger the events maintaining the search index
+        if self.counts['page'] or self.counts['post']:
+            self.echo('Rebuilding search index...')
+            search_index.rebuild(db.session.connection())
+
+    def invalidate_caches(self):
+        """Invalidate the caches affected by the imported data.
+
+        Should be called after the transaction is committed.
+        """
+        page_routes.invalidate()
+        feed_cache.clear()
+        response_cache.clear()
+
+    def _flush(self, entity):
+        """Insert the pending batch of an entity type.
+
+        Args:
+            entity (str): Type of the entity.
+        """
+        batch = self._batches[entity]
+
+        getattr(self, '_insert_{}s'.format(entity))(batch)
+
+        self.counts[entity] += len(batch)
+        self._batches[entity] = []
+
+        self._report()
+
+    def _insert_users(self, batch):
+        """Insert a batch of users and their roles.
+
+        Args:
+            batch (list): Data of the users.
+        """
+        rows = [
+            {
+                'username': data['username'],
+                'password': data['password'],
+                'reset_password_token': data['reset_password_token'],
+                'email': data['email'],
+                'is_active': data['is_active'],
+                'first_name': data['first_name'],
+                'last_name': data['last_name'],
+                'personal_bio': data['personal_bio'],
+                'notify_login': data['notify_login'],
+            }
+            for data in batch
+        ]
+
+        db.session.bulk_insert_mappings(User, rows)
+
+        ids = self._fetch_ids(User.username, [r['username'] for r in rows])
+        self._users.update(ids)
+
+        roles = []
+
+        for data in batch:
+            for name in set(data['roles']):
+                if name not in self._roles:
+                    self._error(
+                        'Unknown role "{}" for user "{}"'.format(name, data['username'])
+                    )
+                    continue
+
+                roles.append({
+                    'user_id': ids[data['username']],
+                    'role_id': self._roles[name]
+                })
+
+        if roles:
+            db.session.execute(user_roles.insert(), roles)
+
+    def _insert_pages(self, batch):
+        """Insert a batch of pages.
+
+        Args:
+            batch (list): Data of the pages.
+        """
+        rows = []
+
+        for data in batch:
+            row = {
+                'title': data['title'],
+                'mini': data['mini'],
+                'route': data['route'],
+                'custom_head': data['custom_head'],
+                'content': data['content'],
+                'is_published': data['is_published'],
+                'comments_enabled': data['comments_enabled'],
+                'last_updated': _parse_date(data['last_updated'])
+            }
+            row.update(Page.render_fields(data['content']))
+
+            rows.append(row)
+
+            if data['ghosted']:
+                self._page_ghosts.append((data['route'], data['ghosted']))
+
+        db.session.bulk_insert_mappings(Page, rows)
+
+    def _insert_posts(self, batch):
+        """Insert a batch of posts, their tags and their authors.
+
+        Args:
+            batch (list): Data of the posts.
+        """
+        rows = []
+
+        for data in batch:
+            row = {
+                'title': data['title'],
+                'slug': data['slug'] or slugify.slugify(
+                    data['title'],
+                    to_lower=True,
+                    max_length=512
+                ),
+                'content': data['content'],
+                'is_published': data['is_published'],
+                'comments_enabled': data['comments_enabled'],
+                'last_updated': _parse_date(data['last_updated'])
+            }
+            row.update(Post.render_fields(data['content']))
+
+            rows.append(row)
+
+        db.session.bulk_insert_mappings(Post, rows)
+
+        ids = self._fetch_ids(Post.slug, [r['slug'] for r in rows])
+        self._create_tags({name for data in batch for name in data['tags'] or ()})
+
+        tags = []
+        authors = []
+
+        for data, row in zip(batch, rows):
+            post_id = ids[row['slug']]
+
+            for name in set(data['tags'] or ()):
+                tags.append({'post_id': post_id, 'tag_id': self._tags[name]})
+
+            usernames = list(OrderedDict.fromkeys(data['authors'] or ()))
+
+            if all(username in self._users for username in usernames):
+                authors.extend(
+                    {'user_id': self._users[username], 'post_id': post_id}
+                    for username in usernames
+                )
+
+            else:
+                # Authors may appear later in the backup
+                self._post_authors.append((post_id, usernames))
+
+            if data['ghosted']:
+                self._post_ghosts.append((row['slug'], data['ghosted']))
+
+        if tags:
+            db.session.execute(post_tags.insert(), tags)
+
+        if authors:
+            db.session.execute(user_posts.insert(), authors)
+
+    def _insert_uploads(self, batch):
+        """Insert a batch of uploads.
+
+        Args:
+            batch (list): Data of the uploads.
+        """
+        rows = [
+            {
+                'path': data['path'],
+                'description': data['description'],
+                'mime': data['mime'],
+                'uploaded_at': _parse_date(data['uploaded_at']),
+                'content_hash': data.get('content_hash')
+            }
+            for data in batch
+        ]
+
+        db.session.bulk_insert_mappings(FileUpload, rows)
+
+    def _create_tags(self, names):
+        """Create the tags that do not exist yet.
+
+        Args:
+            names (set): Names of the tags.
+        """
+        new = [name for name in names if name not in self._tags]
+
+        if not new:
+            return
+
+        db.session.bulk_insert_mappings(Tag, [{'name': name} for name in new])
+        self._tags.update(self._fetch_ids(Tag.name, new))
+
+    def _set_ghosts(self, model, column, pairs):
+        """Set the ghosted entity of pages or posts.
+
+        Args:
+            model: Model of the entities.
+            column: Unique column used to reference the entities.
+            pairs (list): Tuples with the reference of the ghost and the
+                reference of the ghosted entity.
+        """
+        table = model.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam('_id'))
+            .values(ghosted_id=bindparam('_ghosted_id'))
+        )
+
+        for chunk in _chunks(pairs, self.batch_size):
+            ids = self._fetch_ids(column, {ref for pair in chunk for ref in pair})
+            params = []
+
+            for ghost, ghosted in chunk:
+                if ghosted not in ids:
+                    self._error('Cannot find ghosted entity "{}"'.format(ghosted))
+                    continue
+
+                params.append({'_id': ids[ghost], '_ghosted_id': ids[ghosted]})
+
+            if params:
+                db.session.execute(statement, params)
+
+    def _set_pending_authors(self):
+        """Set the authors of posts imported before their users."""
+        for chunk in _chunks(self._post_authors, self.batch_size):
+            missing = {
+                username
+                for _, usernames in chunk
+                for username in usernames
+                if username not in self._users
+            }
+
+            self._users.update(self._fetch_ids(User.username, missing))
+
+            authors = []
+
+            for post_id, usernames in chunk:
+                for username in usernames:
+                    if username not in self._users:
+                        self._error('Cannot find author "{}"'.format(username))
+                        continue
+
+                    authors.append({
+                        'user_id': self._users[username],
+                        'post_id': post_id
+                    })
+
+            if authors:
+                db.session.execute(user_posts.insert(), authors)
+
+    def _fetch_ids(self, column, values):
+        """Obtain the IDs of entities given the values of a unique column.
+
+        Args:
+            column: Unique column of the model.
+            values: Values to look for.
+
+        Returns:
+            Dictionary mapping values to IDs.
+        """
+        if not values:
+            return {}
+
+        model = column.class_
+
+        return dict(
+            db.session.query(column, model.id)
+            .filter(column.in_(list(values)))
+        )
+
+    def _report(self):
+        """Report the progress of the import."""
+        elapsed = self.elapsed
+
+        self.echo('{} entities imported in {:.1f}s ({:.0f}/s): {}'.format(
+            self.total,
+            elapsed,
+            self.total / elapsed if elapsed else 0,
+            ', '.join(
+                '{} {}s'.format(count, entity)
+                for entity, count in self.counts.items()
+            )
+        ))
+
+    def _error(self, message):
+        """Report an error.
+
+        Args:
+            message (str): Error message.
+        """
+        self.errors += 1
+        self.echo('[ERROR] {}'.format(message))
+
+
+class _DigestWriter(io.RawIOBase):
+    """Binary file wrapper computing the checksum and size of written data.
+
+    Args:
+        raw: Binary file to write to.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.raw.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+
+        super(_DigestWriter, self).close()
+
+
+def iter_backup(source):
+    """Iterate over the lines of a backup.
+
+    The backup may be a single (possibly compressed) file, a sharded backup
+    directory or its manifest. The checksums of the shards are verified
+    before reading them.
+
+    Args:
+        source (str): Path to the backup.
+
+    Yields:
+        Lines of the backup.
+
+    Raises:
+        `ValueError` if a shard is missing or its checksum does not match.
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, MANIFEST_NAME)
+
+    if os.path.basename(source) != MANIFEST_NAME:
+        yield from _read_lines(source)
+        return
+
+    with open(source, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    directory = os.path.dirname(source)
+    order = {entity: index for index, entity in enumerate(ENTITIES)}
+
+    # Entities referenced by others are imported first
+    shards = sorted(
+        manifest['shards'],
+        key=lambda s: order.get(s.get('entity'), len(order))
+    )
+    paths = []
+
+    for shard in shards:
+        path = os.path.join(directory, os.path.basename(shard['file']))
+
+        if not os.path.isfile(path):
+            raise ValueError('Missing shard: {}'.format(shard['file']))
+
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256()
+
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+
+        if digest.hexdigest() != shard['sha256']:
+            raise ValueError('Checksum mismatch in shard: {}'.format(shard['file']))
+
+        paths.append(path)
+
+    for path in paths:
+        yield from _read_lines(path)
+
+
+def _read_lines(path):
+    """Iterate over the lines of a (possibly compressed) backup file.
+
+    The compression method is detected from the contents of the file.
+
+    Args:
+        path (str): Path to the file.
+
+    Yields:
+        Lines of the file.
+    """
+    with open(path, 'rb') as raw:
+        magic = raw.read(4)
+        raw.seek(0)
+
+        if magic.startswith(_GZIP_MAGIC):
+            stream = gzip.GzipFile(fileobj=raw, mode='rb')
+
+        elif magic.startswith(_ZSTD_MAGIC):
+            if not _HAS_ZSTD:
+                raise RuntimeError('zstd compression requires the zstandard package')
+
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+
+        else:
+            stream = raw
+
+        yield from io.TextIOWrapper(stream, encoding='utf-8')
+
+
+def _chunks(items, size):
+    """Split a list in chunks.
+
+    Args:
+        items (list): Items to split.
+        size (int): Maximum size of the chunks.
+
+    Yields:
+        Lists of items.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _parse_date(value):
+    """Parse a date found in a backup.
+
+    Args:
+        value (str): Formatted date.
+
+    Returns:
+        `datetime` instance.
+    """
+    return datetime.datetime.strptime(value, DATE_FORMAT)
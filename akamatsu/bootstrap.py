@@ -45,6 +45,15 @@ BASE_CONFIG = {
     # Passlib
     'PASSLIB_SCHEMES': ['bcrypt'],
     'PASSLIB_ALG_BCRYPT_ROUNDS': 14,
+    # Hashing runs inline by default. Production configurations may set a
+    # pool of worker processes (e.g. 2) to keep it out of request threads
+    'PASSLIB_POOL_SIZE': 0,
+    'PASSLIB_QUEUE_LIMIT': 8,
+
+    # Send emails from a background thread (if Celery is not used). Off by
+    # default: delivery errors are then logged instead of raised in the
+    # request that sends the email
+    'USE_MAIL_QUEUE': False,
 
     # App specific
     'SITENAME': 'akamatsu',
@@ -53,6 +62,9 @@ BASE_CONFIG = {
     'TIMEZONE': 'UTC',
     'ALLOWED_EXTENSIONS': {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'},
     'UPLOADS_PATH': '/tmp',
+    # Maximum size of chunked uploads in bytes (single requests are limited
+    # by `MAX_CONTENT_LENGTH`)
+    'MAX_UPLOAD_SIZE': 512 * 1024 * 1024,
 
     # Cookie consent
     'COOKIE_CONSENT_SHOW': False
@@ -110,6 +122,10 @@ DEV_CONFIG = {
     'MAIL_USERNAME': '',
     'MAIL_PASSWORD': '',
 
+    # Request instrumentation
+    'METRICS_ENABLED': False,
+    'METRICS_ENDPOINT': '/_metrics',
+
     # Celery
     'USE_CELERY': False,
     'CELERY_BROKER_URL': 'redis://localhost:6379/1',
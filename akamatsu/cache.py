@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""This file contains caching code."""
+
+from collections import namedtuple
+from functools import wraps
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from flask import Response, g, make_response, request, session
+from flask_login import current_user
+
+from akamatsu.util import LRUCache
+
+
+class MemoryBackend(object):
+    """In-process cache backend with least-recently-used eviction.
+
+    Args:
+        maxsize (int): Maximum number of entries to keep.
+    """
+
+    def __init__(self, maxsize=1024):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key):
+        entry = self._cache.get(key)
+
+        if entry is None:
+            return None
+
+        expires, value = entry
+
+        if expires and expires < time.time():
+            self._cache.delete(key)
+            return None
+
+        return value
+
+    def get_many(self, keys):
+        return [self.get(k) for k in keys]
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        self._cache.set(key, (expires, value))
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class FileSystemBackend(object):
+    """Cache backend storing each entry as a file in a directory.
+
+    Entries are written atomically, so the directory can be shared by
+    several worker processes.
+
+    Args:
+        path (str): Directory in which to store the entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o755)
+
+    def _entry_path(self, key):
+        return os.path.join(
+            self.path,
+            hashlib.sha1(key.encode('utf-8')).hexdigest()
+        )
+
+    def get(self, key):
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+
+        return value
+
+    def get_many(self, keys):
+        return [self.get(k) for k in keys]
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp_path, self._entry_path(key))
+
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self._entry_path(key))
+
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.unlink(os.path.join(self.path, name))
+
+            except OSError:
+                pass
+
+
+class RedisBackend(object):
+    """Cache backend using a Redis server.
+
+    Args:
+        url (str): URL of the Redis server.
+        prefix (str): Prefix for the keys stored by the backend.
+    """
+
+    def __init__(self, url, prefix='akamatsu:cache:'):
+        # Redis is optional, import it here rather than globally
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+
+        if value is None:
+            return None
+
+        return pickle.loads(value)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+
+        return [
+            pickle.loads(v) if v is not None else None
+            for v in self._redis.mget([self.prefix + k for k in keys])
+        ]
+
+    def set(self, key, value, timeout=None):
+        self._redis.set(
+            self.prefix + key,
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            ex=timeout or None
+        )
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + '*'):
+            self._redis.delete(key)
+
+
+class ResponseCache(object):
+    """Full-page cache for public views requested by anonymous users.
+
+    Views opt in with the `cached` decorator and tag the response with the
+    entities it shows (see `tag()`). Purging a tag invalidates exactly the
+    cached responses that were tagged with it.
+
+    Each tag has a random version stored in the backend, and cached
+    responses record the versions of their tags. Purging a tag replaces its
+    version, so responses with the old version are treated as misses.
+
+    The tags of a response are only known once it has been rendered, so
+    purges also replace a global purge version. A response is not stored
+    if that version changed while it was being rendered, as it may contain
+    data read before the purge.
+
+    The cache expects the following configuration parameters:
+
+    - `RESPONSE_CACHE_TYPE`: Backend to use: `'memory'`, `'filesystem'` or
+        `'redis'`. The cache is disabled if not set (default). Note that
+        purges in the `'memory'` backend only reach the worker process that
+        handles them.
+    - `RESPONSE_CACHE_TIMEOUT`: Seconds after which cached responses expire
+        (defaults to 300). Set to 0 to keep them until purged.
+    - `RESPONSE_CACHE_SIZE`: Maximum number of entries kept by the
+        `'memory'` backend (defaults to 1024).
+    - `RESPONSE_CACHE_DIR`: Directory used by the `'filesystem'` backend.
+    - `RESPONSE_CACHE_REDIS_URL`: URL of the Redis server used by the
+        `'redis'` backend. Defaults to `CELERY_BROKER_URL`.
+    """
+
+    def __init__(self):
+        self._backend = None
+        self._timeout = None
+
+    @property
+    def enabled(self):
+        """Whether the cache has been configured."""
+        return self._backend is not None
+
+    def init_app(self, app):
+        """Setup the cache backend.
+
+        Args:
+            app: Application instance.
+
+        Raises:
+            `KeyError` if a configuration parameter is missing or
+            `ValueError` if the cache type is not valid.
+        """
+        cache_type = app.config.get('RESPONSE_CACHE_TYPE')
+        self._timeout = app.config.get('RESPONSE_CACHE_TIMEOUT', 300)
+
+        if not cache_type:
+            self._backend = None
+
+        elif cache_type == 'memory':
+            self._backend = MemoryBackend(
+                app.config.get('RESPONSE_CACHE_SIZE', 1024)
+            )
+
+        elif cache_type == 'filesystem':
+            self._backend = FileSystemBackend(app.config['RESPONSE_CACHE_DIR'])
+
+        elif cache_type == 'redis':
+            url = app.config.get('RESPONSE_CACHE_REDIS_URL')
+
+            if not url:
+                url = app.config['CELERY_BROKER_URL']
+
+            self._backend = RedisBackend(url)
+
+        else:
+            raise ValueError('Invalid response cache type: {}'.format(cache_type))
+
+    def cached(self, f):
+        """Decorator to cache the responses of a view.
+
+        Only successful responses to GET requests from anonymous users are
+        cached.
+        """
+        @wraps(f)
+        def decorator(*args, **kwargs):
+            if not self._is_cacheable():
+                return f(*args, **kwargs)
+
+            key = 'response:' + hashlib.sha1(
+                request.url.encode('utf-8')
+            ).hexdigest()
+
+            entry = self._backend.get(key)
+
+            if entry is not None and self._is_valid(entry):
+                return Response(
+                    entry['body'],
+                    status=entry['status'],
+                    headers=entry['headers']
+                )
+
+            g._response_cache_tags = set()
+            purge_version = self._purge_version()
+
+            response = make_response(f(*args, **kwargs))
+
+            if response.status_code == 200 and not response.is_streamed \
+                    and not response.direct_passthrough:
+                tags = sorted(g._response_cache_tags)
+                versions = self._tag_versions(tags)
+
+                # Check after reading the tag versions: a purge that
+                # happened while rendering changed the purge version first
+                if self._backend.get('purges') != purge_version:
+                    return response
+
+                self._backend.set(
+                    key,
+                    {
+                        'body': response.get_data(),
+                        'status': response.status_code,
+                        'headers': [
+                            (k, v) for k, v in response.headers
+                            if k.lower() not in ('set-cookie', 'content-length')
+                        ],
+                        'tags': dict(zip(tags, versions))
+                    },
+                    self._timeout
+                )
+
+            return response
+
+        return decorator
+
+    def tag(self, *tags):
+        """Tag the response of the current request.
+
+        Args:
+            tags (str): Tags to add (e.g. `'post:1'`).
+        """
+        tags_set = getattr(g, '_response_cache_tags', None)
+
+        if tags_set is not None:
+            tags_set.update(tags)
+
+    def purge(self, *tags):
+        """Invalidate all the cached responses tagged with the given tags.
+
+        Args:
+            tags (str): Tags to purge.
+        """
+        if not self.enabled:
+            return
+
+        # Replaced before the tags, see `cached()`
+        self._backend.set('purges', _new_version())
+
+        for tag in set(tags):
+            self._backend.set('tag:' + tag, _new_version())
+
+    def clear(self):
+        """Remove all the cached responses."""
+        if self.enabled:
+            self._backend.clear()
+
+    def _is_cacheable(self):
+        """Check whether the current request may be served from cache."""
+        return (
+            self.enabled
+            and request.method in ('GET', 'HEAD')
+            and not current_user.is_authenticated
+            # Flashed messages are shown in the layout
+            and '_flashes' not in session
+        )
+
+    def _is_valid(self, entry):
+        """Check that the tags of a cached entry have not been purged."""
+        tags = list(entry['tags'])
+        current = self._backend.get_many(['tag:' + t for t in tags])
+
+        return all(entry['tags'][t] == v for t, v in zip(tags, current))
+
+    def _purge_version(self):
+        """Obtain current purge version, creating it if missing."""
+        version = self._backend.get('purges')
+
+        if version is None:
+            version = _new_version()
+            self._backend.set('purges', version)
+
+        return version
+
+    def _tag_versions(self, tags):
+        """Obtain current versions of the tags, creating missing ones."""
+        versions = self._backend.get_many(['tag:' + t for t in tags])
+
+        for index, version in enumerate(versions):
+            if version is None:
+                versions[index] = _new_version()
+                self._backend.set('tag:' + tags[index], versions[index])
+
+        return versions
+
+
+PageRoute = namedtuple('PageRoute', ['id', 'is_published', 'is_ghost', 'target'])
+
+
+class PageRouteTable(object):
+    """In-process map of page routes.
+
+    Maps each route to a `PageRoute` with the ID of the page, whether it is
+    published and, for ghost pages, the route of the final page the ghost
+    redirects to. Ghost chains are followed when the table is built: ghosts
+    pointing to unpublished pages or taking part in a cycle get a `target`
+    of `None`.
+
+    The table is built on first use and rebuilt whenever the `'pages'`
+    version stamp (see `akamatsu.models.CacheVersion`) changes. The stamp is
+    checked at most once every `PAGE_ROUTES_CHECK_INTERVAL` seconds
+    (defaults to 5), which bounds how long other worker processes may serve
+    outdated routes.
+    """
+
+    VERSION_NAME = 'pages'
+
+    def __init__(self):
+        self._routes = None
+        self._version = None
+        self._checked_at = 0
+        self._check_interval = 5
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Setup the table.
+
+        Args:
+            app: Application instance.
+        """
+        self._check_interval = app.config.get('PAGE_ROUTES_CHECK_INTERVAL', 5)
+
+    def lookup(self, route):
+        """Obtain the information of a route.
+
+        Args:
+            route (str): Route of the page, including root slash.
+
+        Returns:
+            `PageRoute` instance or `None` if there is no page in that route.
+        """
+        self._refresh()
+
+        return self._routes.get(route)
+
+    def invalidate(self):
+        """Force a rebuild of the table on next lookup."""
+        self._version = None
+        self._checked_at = 0
+
+    def _refresh(self):
+        """Rebuild the table if it is outdated."""
+        if not self._needs_check():
+            return
+
+        from akamatsu.models import CacheVersion
+
+        with self._lock:
+            # Another thread may have refreshed the table already
+            if not self._needs_check():
+                return
+
+            # Read the version first: a change made while building is then
+            # noticed on next check
+            version = CacheVersion.get_version(self.VERSION_NAME)
+
+            if self._routes is None or version != self._version:
+                self._routes = _build_page_routes()
+                self._version = version
+
+            self._checked_at = time.monotonic()
+
+    def _needs_check(self):
+        return (
+            self._routes is None
+            or self._version is None
+            or time.monotonic() - self._checked_at >= self._check_interval
+        )
+
+
+def _build_page_routes():
+    """Build the route map of all the pages.
+
+    Returns:
+        Dictionary mapping routes to `PageRoute` instances.
+    """
+    from akamatsu import db
+    from akamatsu.models import Page
+
+    rows = (
+        db.session.query(
+            Page.id,
+            Page.route,
+            Page.is_published,
+            Page.ghosted_id
+        )
+    ).all()
+
+    pages = {row.id: row for row in rows}
+    routes = {}
+
+    for row in rows:
+        target = None
+
+        if row.ghosted_id is not None:
+            visited = {row.id}
+            current = pages.get(row.ghosted_id)
+
+            while current is not None:
+                if not current.is_published or current.id in visited:
+                    # Unpublished target or ghost cycle
+                    current = None
+
+                elif current.ghosted_id is None:
+                    break
+
+                else:
+                    visited.add(current.id)
+                    current = pages.get(current.ghosted_id)
+
+            if current is not None:
+                target = current.route
+
+        routes[row.route] = PageRoute(
+            row.id,
+            bool(row.is_published),
+            row.ghosted_id is not None,
+            target
+        )
+
+    return routes
+
+
+def _new_version():
+    """Generate a random tag version."""
+    return os.urandom(8).hex()
@@ -28,13 +28,20 @@
 """This file contains custom CLI commands."""
 
 import datetime
-import json
 import os
 
+from flask import current_app
 from flask.cli import FlaskGroup
 
-from akamatsu import db, crypto_manager, init_app
+from akamatsu import db, crypto_manager, init_app, search_index
+from akamatsu.backup import COMPRESSIONS, BackupExporter, BackupImporter, \
+        iter_backup
+from akamatsu.freeze import UPLOAD_MODES, Freezer
+from akamatsu.images import SOURCE_FORMATS, generate_variants
 from akamatsu.models import FileUpload, Page, Post, Role, User
+from akamatsu.storage import PartialUpload, legacy_path, resolve_upload, \
+        store_file
+from akamatsu.util import hash_file
 
 import click
 
@@ -368,125 +375,38 @@ def data():
 
 @data.command(name='import')
 @click.argument('source', type=click.Path(exists=True))
-def import_data(source):
+@click.option(
+    '--batch-size',
+    default=500,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of entities to insert per batch'
+)
+def import_data(source, batch_size):
     """Import a backup file into the database.
 
     This does not check the input nor overwrite any existing data,
     but may cause conflicts.
 
+    The file is read line by line and entities are inserted in batches,
+    all of them in a single transaction. Compressed files and sharded
+    backups (directory or manifest) are supported.
+
     \b
     Args:
-        source: backup file (JSON)
+        source: backup file (JSON), directory or manifest
     """
     if not click.confirm('Do you want to import data from {}?'.format(source)):
         click.echo('Operation cancelled')
         return
 
-    relations = {
-        'pages': {},
-        'posts': {}
-    }
-
-    with open(source, 'r', encoding='utf-8') as f:
-        for line in [l.strip() for l in f if l.strip()]:
-            struct = json.loads(line)
-            entity = struct.get('entity')
-            data = struct.get('data')
-
-            if not data or not isinstance(data, dict):
-                click.echo('[ERROR] Malformed data: {}'.format(line))
-                continue
-
-            if entity == 'user':
-                new_user = User(
-                    username=data['username'],
-                    password=data['password'],
-                    reset_password_token=data['reset_password_token'],
-                    email=data['email'],
-                    is_active=data['is_active'],
-                    first_name=data['first_name'],
-                    last_name=data['last_name'],
-                    personal_bio=data['personal_bio'],
-                    notify_login=data['notify_login'],
-                )
-
-                new_user.role_names = set(data['roles'])
-
-                db.session.add(new_user)
-
-            elif entity == 'page':
-                new_page = Page(
-                    title=data['title'],
-                    mini=data['mini'],
-                    route=data['route'],
-                    custom_head=data['custom_head'],
-                    content=data['content'],
-                    is_published=data['is_published'],
-                    comments_enabled=data['comments_enabled'],
-                    last_updated=datetime.datetime.strptime(
-                        data['last_updated'],
-                        '%Y-%m-%d %H:%M:%S'
-                    )
-                )
-
-                if data['ghosted']:
-                    relations['pages'][data['route']] = data['ghosted']
-
-                db.session.add(new_page)
-
-            elif entity == 'post':
-                new_post = Post(
-                    title=data['title'],
-                    slug=data['slug'],
-                    content=data['content'],
-                    is_published=data['is_published'],
-                    comments_enabled=data['comments_enabled'],
-                    last_updated=datetime.datetime.strptime(
-                        data['last_updated'],
-                        '%Y-%m-%d %H:%M:%S'
-                    ),
-                    tag_names=data['tags']
-                )
-
-                if data['ghosted']:
-                    if data['slug'] not in relations['posts']:
-                        relations['posts'][data['slug']] = {
-                            'ghost': None,
-                            'authors': None
-                        }
-
-                    relations['posts'][data['slug']]['ghost'] = data['ghosted']
-
-                if data['authors']:
-                    if data['slug'] not in relations['posts']:
-                        relations['posts'][data['slug']] = {
-                            'ghost': None,
-                            'authors': None
-                        }
-
-                    relations['posts'][data['slug']]['authors'] = data['authors']
-
-                db.session.add(new_post)
-
-            elif entity == 'upload':
-                new_upload = FileUpload(
-                    path=data['path'],
-                    description=data['description'],
-                    mime=data['mime'],
-                    uploaded_at=datetime.datetime.strptime(
-                        data['uploaded_at'],
-                        '%Y-%m-%d %H:%M:%S'
-                    )
-                )
-
-                db.session.add(new_upload)
-
-            else:
-                click.echo('[ERROR] Invalid entity: {}'.format(line))
-                continue
+    importer = BackupImporter(batch_size=batch_size, echo=click.echo)
 
     try:
         correct = True
+
+        importer.run(iter_backup(source))
+
         db.session.commit()
 
     except Exception as e:
@@ -501,42 +421,183 @@ def import_data(source):
         if not correct:
             db.session.rollback()
 
+    importer.invalidate_caches()
 
-    # Handle relations
-    for route in relations['pages']:
-        ghost_page = Page.query.filter_by(route=route).first()
+    click.echo(
+        'Finished data import! {} entities in {:.1f}s ({} errors)'.format(
+            importer.total,
+            importer.elapsed,
+            importer.errors
+        )
+    )
 
-        if not ghost_page:
-            continue
 
-        to_ghost = Page.query.filter_by(route=relations['pages'][route]).first()
+@data.command(name='export')
+@click.argument('output', type=click.Path())
+@click.option(
+    '--compress',
+    type=click.Choice(list(COMPRESSIONS)),
+    help='Compress the output'
+)
+@click.option(
+    '--shards',
+    is_flag=True,
+    help='Export each entity type to its own file in the OUTPUT directory'
+)
+@click.option(
+    '--jobs',
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of shards to export at the same time'
+)
+@click.option(
+    '--batch-size',
+    default=1000,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of entities to read per batch'
+)
+def export_data(output, compress, shards, jobs, batch_size):
+    """Export database data to a backup file.
+
+    This file is a newline-delimited JSON file, where each line is a data
+    entity.
 
-        if not to_ghost:
-            continue
+    When exporting shards, OUTPUT is a directory which will contain a file
+    per entity type and a manifest with their checksums. The directory (or
+    the manifest) can be imported as well.
+
+    \b
+    Args:
+        output: backup file (JSON) or directory
+    """
+    if not click.confirm('Do you want to export data to {}?'.format(output)):
+        click.echo('Operation cancelled')
+        return
+
+    try:
+        exporter = BackupExporter(
+            batch_size=batch_size,
+            compression=compress,
+            echo=click.echo
+        )
+
+    except RuntimeError as e:
+        click.echo(e)
+        return
+
+    if shards:
+        manifest = exporter.export_shards(output, jobs=jobs)
+        click.echo('Manifest written to {}'.format(manifest))
 
-        ghost_page.ghosted_id = to_ghost.id
+    else:
+        exporter.export(output)
 
 
-    for slug in relations['posts']:
-        post = Post.query.filter_by(slug=slug).first()
+@data.command()
+def rerender():
+    """Render the content of all pages and posts again.
 
-        if not post:
+    Rendered HTML is stored in the database when pages and posts are saved,
+    so this should be run whenever the markdown renderer configuration
+    changes.
+    """
+    rendered = 0
+
+    for model in (Page, Post):
+        for instance in model.query:
+            instance.render_content(force=True)
+            rendered += 1
+
+    try:
+        correct = True
+        db.session.commit()
+
+        click.echo('Rendered {} pages and posts'.format(rendered))
+
+    except Exception as e:
+        correct = False
+
+        click.echo('Error rendering content')
+        click.echo(e)
+
+    finally:
+        if not correct:
+            db.session.rollback()
+
+
+@data.command(name='hash-uploads')
+@click.option('--all', 'rehash', is_flag=True, help='Hash all the uploads again')
+def hash_uploads(rehash):
+    """Compute the content hash of uploaded files.
+
+    By default, only uploads without a hash are processed.
+    """
+    uploads = FileUpload.query
+
+    if not rehash:
+        uploads = uploads.filter(FileUpload.content_hash == None)
+
+    hashed = 0
+
+    for fupload in uploads:
+        file_path = resolve_upload(fupload)
+
+        if file_path is None:
+            click.echo('Missing file: {}'.format(fupload.path))
             continue
 
-        if relations['posts'][slug]['ghost']:
-            to_ghost = Post.query.filter_by(
-                slug=relations['posts'][slug]['ghost']
-            ).first()
+        with open(file_path, 'rb') as f:
+            fupload.content_hash = hash_file(f)
 
-            if to_ghost:
-                post.ghosted_id = to_ghost.id
+        hashed += 1
 
-        if relations['posts'][slug]['authors']:
-            authors = User.query.filter(
-                User.username.in_(relations['posts'][slug]['authors'])
-            )
+    try:
+        correct = True
+        db.session.commit()
 
-            post.authors = [a for a in authors]
+        click.echo('Hashed {} uploads'.format(hashed))
+
+    except Exception as e:
+        correct = False
+
+        click.echo('Error hashing uploads')
+        click.echo(e)
+
+    finally:
+        if not correct:
+            db.session.rollback()
+
+
+@cli.group()
+def files():
+    """Uploaded file commands."""
+    pass
+
+
+@files.command()
+def dedupe():
+    """Move uploaded files into the blob store.
+
+    Files stored at their logical path are hashed and moved into the blob
+    store. Files whose contents are already stored are removed.
+    """
+    uploads = FileUpload.query.order_by(FileUpload.id).all()
+    pending = []
+
+    # Hash first and store the hashes, so that files are only moved once
+    # the database knows where to find them
+    for fupload in uploads:
+        file_path = legacy_path(fupload)
+
+        if file_path is None or not os.path.isfile(file_path):
+            continue
+
+        with open(file_path, 'rb') as f:
+            fupload.content_hash = hash_file(f)
+
+        pending.append((fupload, file_path))
 
     try:
         correct = True
@@ -545,7 +606,7 @@ def import_data(source):
     except Exception as e:
         correct = False
 
-        click.echo('Error processing relations')
+        click.echo('Error hashing uploads')
         click.echo(e)
 
         return
@@ -554,92 +615,174 @@ def import_data(source):
         if not correct:
             db.session.rollback()
 
-    click.echo('Finished data import!')
+    root = os.path.abspath(current_app.config['UPLOADS_PATH'])
+    moved = 0
+    reclaimed = 0
 
+    for fupload, file_path in pending:
+        size = os.path.getsize(file_path)
 
-@data.command(name='export')
-@click.argument('output', type=click.Path())
-def export_data(output):
-    """Export database data to a backup file.
+        if not store_file(file_path, fupload.content_hash):
+            # Duplicate contents
+            reclaimed += size
 
-    This file is a newline-delimited JSON file, where each line is a data
-    entity.
+        moved += 1
+
+        # Remove subdirectories left empty
+        file_dir = os.path.dirname(file_path)
+
+        if file_dir != root and not os.listdir(file_dir):
+            os.rmdir(file_dir)
+
+    click.echo('Moved {} files to the blob store'.format(moved))
+    click.echo('Reclaimed {} bytes'.format(reclaimed))
+
+
+@files.command(name='clean-partial')
+@click.option('--hours', default=24, help='Age of the uploads to remove')
+def clean_partial(hours):
+    """Remove chunked uploads that were never completed."""
+    limit = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    removed = 0
+
+    for upload in PartialUpload.all():
+        if upload.created_at < limit:
+            upload.discard()
+            removed += 1
+
+    click.echo('Removed {} partial uploads'.format(removed))
+
+
+@files.command()
+def variants():
+    """Generate missing variants of uploaded images.
+
+    Only images stored in the blob store are processed (see `dedupe`).
+    """
+    images = (
+        FileUpload.query
+        .filter(FileUpload.mime.in_(list(SOURCE_FORMATS)))
+        .filter(FileUpload.content_hash != None)
+    )
+
+    generated = 0
+    seen = set()
+
+    for fupload in images:
+        if fupload.content_hash in seen:
+            # Shared blob
+            continue
+
+        seen.add(fupload.content_hash)
+
+        try:
+            generated += generate_variants(fupload.content_hash, fupload.mime)
+
+        except (OSError, RuntimeError) as e:
+            click.echo('Failed to process {}: {}'.format(fupload.path, e))
+
+    click.echo('Generated {} variants'.format(generated))
+
+
+# Begin search commands
+@cli.group()
+def search():
+    """Search index related commands."""
+    pass
+
+
+@search.command()
+def reindex():
+    """Rebuild the full-text search index.
+
+    Should be run after changing the search configuration or modifying
+    posts and pages outside of the application.
+    """
+    try:
+        correct = True
+
+        count = search_index.rebuild(db.session.connection())
+        db.session.commit()
+
+        click.echo('Indexed {} posts and pages ({} backend)'.format(
+            count,
+            search_index.backend_name
+        ))
+
+    except Exception as e:
+        # Catch anything unknown
+        correct = False
+
+        click.echo('Error rebuilding search index')
+        click.echo(e)
+
+    finally:
+        if not correct:
+            # Cleanup
+            db.session.rollback()
+
+
+# Begin static export commands
+@cli.command()
+@click.argument('destination', type=click.Path(file_okay=False))
+@click.option(
+    '--base-url',
+    help='Public URL of the site (defaults to FREEZE_BASE_URL)'
+)
+@click.option(
+    '--jobs',
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of processes rendering documents'
+)
+@click.option(
+    '--uploads',
+    default='link',
+    show_default=True,
+    type=click.Choice(UPLOAD_MODES),
+    help='Hard link (or copy if not possible), symlink or copy uploads'
+)
+@click.option('--force', is_flag=True, help='Render every document again')
+def freeze(destination, base_url, jobs, uploads, force):
+    """Render public content into a static directory.
+
+    Only documents which changed since the previous run (tracked by a
+    manifest in the directory) are rendered again.
 
     \b
     Args:
-        output: backup file (JSON)
+        destination: directory to write to
     """
-    if not click.confirm('Do you want to export data to {}?'.format(output)):
-        click.echo('Operation cancelled')
-        return
+    freezer = Freezer(
+        destination,
+        base_url or current_app.config.get(
+            'FREEZE_BASE_URL',
+            'http://localhost/'
+        ),
+        jobs=jobs,
+        uploads=uploads,
+        echo=click.echo
+    )
+
+    try:
+        failed = freezer.run(force=force)
 
-    out = open(output, 'w', encoding='utf-8')
-
-    # Backup users
-    for u in User.query:
-        user = {
-            'username': u.username,
-            'password': u.password,
-            'reset_password_token': u.reset_password_token,
-            'email': u.email,
-            'is_active': u.is_active,
-            'first_name': u.first_name,
-            'last_name': u.last_name,
-            'personal_bio': u.personal_bio,
-            'notify_login': u.notify_login,
-            'roles': [r for r in u.role_names]
-        }
-
-        out.write(json.dumps({'entity': 'user', 'data': user})+'\n')
-
-    # Backup pages
-    for p in Page.query:
-        page = {
-            'title': p.title,
-            'mini': p.mini,
-            'route': p.route,
-            'custom_head': p.custom_head,
-            'content': p.content,
-            'is_published': p.is_published,
-            'comments_enabled': p.comments_enabled,
-            'ghosted': None, # Should be route
-            'last_updated': p.last_updated.strftime('%Y-%m-%d %H:%M:%S'),
-        }
-
-        if p.ghosted_id:
-            page['ghosted'] = p.ghosted.route
-
-        out.write(json.dumps({'entity': 'page', 'data': page})+'\n')
-
-    # Backup posts
-    for p in Post.query:
-        post = {
-            'title': p.title,
-            'slug': p.slug,
-            'content': p.content,
-            'is_published': p.is_published,
-            'comments_enabled': p.comments_enabled,
-            'last_updated': p.last_updated.strftime('%Y-%m-%d %H:%M:%S'),
-            'authors': [a.username for a in p.authors],
-            'ghosted': None, # Should be slug
-            'tags': [t for t in p.tag_names]
-        }
-
-        if p.ghosted_id:
-            post['ghosted'] = p.ghosted.slug
-
-
-        out.write(json.dumps({'entity': 'post', 'data': post})+'\n')
-
-    # Backup uploads
-    for f in FileUpload.query:
-        upload = {
-            'path': f.path,
-            'description': f.description,
-            'mime': f.mime,
-            'uploaded_at': f.uploaded_at.strftime('%Y-%m-%d %H:%M:%S')
-        }
-
-        out.write(json.dumps({'entity': 'upload', 'data': upload})+'\n')
-
-    out.close()
+    except Exception as e:
+        # Catch anything unknown
+        click.echo('Error freezing site')
+        click.echo(e)
+
+        raise SystemExit(1)
+
+    if failed:
+        click.echo('{} documents could not be rendered'.format(failed))
+
+
+# Benchmark commands (only available in a source checkout)
+try:
+    from benchmarks.cli import bench
+    cli.add_command(bench)
+
+except ImportError:
+    pass
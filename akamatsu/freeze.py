@@ -0,0 +1,749 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the static export ("freezing") of public content.
+
+Published pages, posts, tag and author listings (all their pages), the blog
+index and the RSS feed are rendered through the application into a
+directory that can be served by the web server, leaving only the
+administration (and search) to the application. Uploads are linked or
+copied into the same directory.
+
+Freezing is incremental: a manifest stores a fingerprint of each rendered
+URL, derived from the title, content hash and `last_updated` date of the
+content and everything else shown along with it (authors, tags, ghost
+targets, summaries of listed posts...), so that only outdated URLs are
+rendered again. Changes to the templates,
+the version or the relevant configuration cause a full rebuild.
+
+URLs are mapped to files as follows:
+
+- HTML documents: `<path>/index.html`, or `<path>/index.page-<n>.html` for
+    page `n` (> 1) of a listing.
+- Other documents (the RSS feed): `<path>`.
+- Uploads: `_uploads/<path>` and `_uploads/<fingerprint>/<path>`.
+- Redirections (ghosts): written to `redirects.map`, to be included in an
+    nginx `map` block.
+
+For instance, with nginx:
+
+    map $uri $akamatsu_redirect {
+        include /srv/akamatsu/redirects.map;
+    }
+
+    server {
+        root /srv/akamatsu;
+
+        location /admin { proxy_pass http://akamatsu; }
+        location = /blog/search { proxy_pass http://akamatsu; }
+        location = /blog/_rss { default_type text/xml; }
+
+        location / {
+            if ($akamatsu_redirect) {
+                return 301 $akamatsu_redirect;
+            }
+
+            set $page_suffix "";
+
+            if ($arg_page ~ "^[0-9]+$") {
+                set $page_suffix ".page-$arg_page";
+            }
+
+            try_files $uri/index$page_suffix.html $uri/index.html $uri =404;
+        }
+    }
+"""
+
+from multiprocessing import get_context
+import hashlib
+import json
+import math
+import os
+import shutil
+import time
+
+from flask import current_app
+from sqlalchemy.orm import aliased
+from werkzeug.security import safe_join
+from werkzeug.urls import url_quote, url_unquote
+
+from akamatsu import db, page_routes
+from akamatsu.models import FileUpload, Page, Post, Tag, User, post_tags, \
+        user_posts
+from akamatsu.storage import resolve_upload
+
+
+# Name of the manifest in the destination directory
+MANIFEST_NAME = '.freeze-manifest.json'
+
+# Name of the nginx map of redirections
+REDIRECTS_NAME = 'redirects.map'
+
+# Ways of placing uploads in the destination directory
+UPLOAD_MODES = ('link', 'symlink', 'copy')
+
+# Number of posts in the RSS feed (see `akamatsu.views.blog`)
+FEED_ITEMS = 15
+
+# Configuration parameters affecting every rendered document
+_SITE_CONFIG = (
+    'SITENAME', 'LOCALE', 'TIMEZONE', 'PAGE_ITEMS', 'NAVBAR', 'SOCIAL',
+    'FAVICON_DIR', 'FAVICON_EXTRAS', 'USE_ANALYTICS'
+)
+
+# Application used by worker processes (inherited when forking)
+_worker_app = None
+_worker_client = None
+_worker_options = None
+
+
+class Freezer(object):
+    """Renders public content into a static directory.
+
+    Attributes:
+        destination (str): Directory to write to.
+        base_url (str): Public URL of the site, used for absolute URLs.
+        jobs (int): Number of processes rendering documents.
+        uploads (str): How to place uploads (see `UPLOAD_MODES`).
+        counts (dict): Number of rendered, unchanged, removed and failed
+            documents and of placed uploads.
+
+    Args:
+        destination (str): Directory to write to.
+        base_url (str): Public URL of the site.
+        jobs (int): Number of processes rendering documents.
+        uploads (str): How to place uploads: `'link'` (hard links, copied
+            if not possible), `'symlink'` or `'copy'`.
+        echo (callable): Function used to report progress.
+    """
+
+    def __init__(self, destination, base_url, jobs=4, uploads='link', echo=print):
+        if uploads not in UPLOAD_MODES:
+            raise ValueError('Invalid uploads mode: {}'.format(uploads))
+
+        self.destination = os.path.abspath(destination)
+        self.base_url = base_url
+        self.jobs = jobs
+        self.uploads = uploads
+        self.echo = echo
+
+        self.counts = {
+            'rendered': 0,
+            'unchanged': 0,
+            'removed': 0,
+            'failed': 0,
+            'uploads': 0
+        }
+
+    def run(self, force=False):
+        """Freeze the site.
+
+        Must be run within an application context.
+
+        Args:
+            force (bool): Render every document even if it did not change.
+
+        Returns:
+            Number of documents which could not be rendered.
+        """
+        started = time.monotonic()
+        os.makedirs(self.destination, exist_ok=True)
+
+        manifest = self._load_manifest()
+        site = self._site_fingerprint()
+
+        if force or manifest.get('site') != site:
+            previous = {}
+
+        else:
+            previous = manifest.get('documents', {})
+
+        # Documents to render
+        targets = self._collect_targets()
+        stale = [
+            (url, fingerprint)
+            for url, fingerprint in targets.items()
+            if url not in previous or previous[url]['fingerprint'] != fingerprint
+        ]
+
+        self.counts['unchanged'] = len(targets) - len(stale)
+        self.echo('Rendering {} of {} documents...'.format(len(stale), len(targets)))
+
+        documents = {
+            url: entry
+            for url, entry in previous.items()
+            if url in targets
+        }
+
+        for url, entry in self._render(stale):
+            if entry is None:
+                self.counts['failed'] += 1
+                documents.pop(url, None)
+
+            else:
+                self.counts['rendered'] += 1
+                documents[url] = entry
+
+        # Files of documents which no longer exist (or moved)
+        self._remove_stale(manifest.get('documents', {}), documents)
+        self._write_redirects(documents)
+
+        # Uploads
+        self.echo('Placing uploads...')
+        uploads = self._place_uploads(manifest.get('uploads', {}), force)
+        self._remove_stale(manifest.get('uploads', {}), uploads)
+
+        self._save_manifest({
+            'version': 1,
+            'site': site,
+            'documents': documents,
+            'uploads': uploads
+        })
+
+        self.echo('Frozen in {:.1f}s: {}'.format(
+            time.monotonic() - started,
+            ', '.join('{} {}'.format(v, k) for k, v in self.counts.items())
+        ))
+
+        return self.counts['failed']
+
+    def _collect_targets(self):
+        """Obtain the URLs to freeze and their fingerprints.
+
+        Returns:
+            Dictionary mapping URLs to fingerprints.
+        """
+        targets = {}
+        per_page = current_app.config['PAGE_ITEMS']
+
+        # Authors are shown in posts and listings
+        authors = {
+            row.id: _fingerprint(row.username, row.first_name, row.last_name,
+                                 row.personal_bio)
+            for row in db.session.query(
+                User.id,
+                User.username,
+                User.first_name,
+                User.last_name,
+                User.personal_bio
+            )
+        }
+
+        post_authors = {}
+
+        for post_id, user_id in db.session.query(
+                user_posts.c.post_id, user_posts.c.user_id):
+            post_authors.setdefault(post_id, []).append(user_id)
+
+        post_tag_names = {}
+
+        for post_id, name in (
+                db.session.query(post_tags.c.post_id, Tag.name)
+                .join(Tag, Tag.id == post_tags.c.tag_id)):
+            post_tag_names.setdefault(post_id, []).append(name)
+
+        # Posts, newest first (same order as listings)
+        ghosted = aliased(Post)
+
+        posts = (
+            db.session.query(
+                Post.id,
+                Post.slug,
+                Post.title,
+                Post.content_hash,
+                Post.summary_html,
+                Post.last_updated,
+                Post.comments_enabled,
+                Post.ghosted_id,
+                ghosted.slug
+            )
+            .outerjoin(
+                ghosted,
+                (ghosted.id == Post.ghosted_id) & (ghosted.is_published == True)
+            )
+            .filter(Post.is_published == True)
+            .order_by(Post.last_updated.desc(), Post.id.desc())
+        )
+
+        listed = []
+        tagged = {}
+        by_user = {}
+
+        for post_id, slug, title, content_hash, summary_html, last_updated, \
+                comments, ghosted_id, target in posts:
+            url = '/blog/{}'.format(slug)
+
+            if ghosted_id is not None:
+                # Redirection (not found if the target is not published)
+                if target is not None and ghosted_id != post_id:
+                    targets[url] = _fingerprint('ghost', target)
+
+                continue
+
+            user_ids = sorted(post_authors.get(post_id, []))
+            tag_names = sorted(post_tag_names.get(post_id, []))
+
+            fingerprint = _fingerprint(
+                slug,
+                title,
+                content_hash,
+                last_updated,
+                comments,
+                tag_names,
+                [authors[user_id] for user_id in user_ids]
+            )
+
+            targets[url] = fingerprint
+
+            # Listings show the summary instead of the content
+            entry = _fingerprint(fingerprint, summary_html)
+            listed.append(entry)
+
+            for name in tag_names:
+                tagged.setdefault(name, []).append(entry)
+
+            for user_id in user_ids:
+                by_user.setdefault(user_id, []).append(entry)
+
+        # Listings
+        usernames = dict(db.session.query(User.id, User.username))
+
+        targets.update(_listing_targets('/blog/', listed, per_page))
+
+        for name, fingerprints in tagged.items():
+            targets.update(_listing_targets(
+                '/blog/tagged/{}'.format(url_quote(name)),
+                fingerprints,
+                per_page
+            ))
+
+        for user_id, fingerprints in by_user.items():
+            targets.update(_listing_targets(
+                '/blog/by/{}'.format(url_quote(usernames[user_id])),
+                fingerprints,
+                per_page
+            ))
+
+        # Feed (contributors may be any user)
+        targets['/blog/_rss'] = _fingerprint(
+            listed[:FEED_ITEMS],
+            sorted(authors.values())
+        )
+
+        # Pages (ghost chains are resolved by the route table)
+        pages = (
+            db.session.query(
+                Page.route,
+                Page.title,
+                Page.content_hash,
+                Page.last_updated,
+                Page.ghosted_id
+            )
+            .filter(Page.is_published == True)
+        )
+
+        for route, title, content_hash, last_updated, ghosted_id in pages:
+            if ghosted_id is not None:
+                entry = page_routes.lookup(route)
+
+                if entry is not None and entry.target is not None:
+                    targets[route] = _fingerprint('ghost', entry.target)
+
+                continue
+
+            targets[route] = _fingerprint(route, title, content_hash, last_updated)
+
+        return targets
+
+    def _render(self, jobs):
+        """Render documents, in parallel if possible.
+
+        Args:
+            jobs (list): URLs to render and their fingerprints.
+
+        Yields:
+            Tuple with the URL and its manifest entry (`None` on failure).
+        """
+        global _worker_app, _worker_client, _worker_options
+
+        if not jobs:
+            return
+
+        _worker_app = current_app._get_current_object()
+        _worker_client = None
+        _worker_options = (self.destination, self.base_url)
+
+        # The first document is rendered here, so that assets are built
+        # before forking
+        yield self._check(_render_document(jobs[0]))
+
+        if self.jobs < 2 or len(jobs) < 2:
+            for job in jobs[1:]:
+                yield self._check(_render_document(job))
+
+            return
+
+        # Connections must not be shared with the worker processes
+        db.session.remove()
+        db.engine.dispose()
+
+        with get_context('fork').Pool(self.jobs, initializer=_init_worker) as pool:
+            for result in pool.imap_unordered(_render_document, jobs[1:], chunksize=8):
+                yield self._check(result)
+
+    def _check(self, result):
+        """Report documents which could not be rendered."""
+        url, entry = result
+
+        if entry is None:
+            self.echo('Failed to render {}'.format(url))
+
+        return result
+
+    def _place_uploads(self, previous, force):
+        """Link or copy uploads into the destination directory.
+
+        Args:
+            previous (dict): Uploads placed in the previous run.
+            force (bool): Place every upload even if it did not change.
+
+        Returns:
+            Dictionary with the manifest entries of the uploads.
+        """
+        uploads = {}
+
+        for fupload in FileUpload.query.order_by(FileUpload.id).yield_per(500):
+            key = fupload.path
+            entry = previous.get(key)
+
+            if (not force and entry is not None
+                    and entry['fingerprint'] == fupload.content_hash
+                    and all(os.path.exists(self._path(f)) for f in entry['files'])):
+                uploads[key] = entry
+                continue
+
+            source = resolve_upload(fupload)
+
+            if source is None:
+                self.echo('Missing contents of {}'.format(fupload.path))
+                continue
+
+            files = ['_uploads/{}'.format(fupload.path)]
+
+            if fupload.fingerprint:
+                files.append('_uploads/{}/{}'.format(fupload.fingerprint, fupload.path))
+
+            try:
+                for name in files:
+                    self._place(source, name)
+
+            except (OSError, ValueError) as e:
+                self.echo('Failed to place {}: {}'.format(fupload.path, e))
+                continue
+
+            uploads[key] = {'fingerprint': fupload.content_hash, 'files': files}
+            self.counts['uploads'] += 1
+
+        return uploads
+
+    def _place(self, source, name):
+        """Place the contents of an upload in the destination directory.
+
+        Args:
+            source (str): Path of the contents.
+            name (str): Relative path in the destination directory.
+        """
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+
+        if self.uploads == 'symlink':
+            os.symlink(source, tmp_path)
+
+        elif self.uploads == 'link':
+            try:
+                os.link(source, tmp_path)
+
+            except OSError:
+                # Different filesystem
+                shutil.copyfile(source, tmp_path)
+
+        else:
+            shutil.copyfile(source, tmp_path)
+
+        os.replace(tmp_path, path)
+
+    def _remove_stale(self, previous, current):
+        """Remove the files of entries which are no longer present.
+
+        Args:
+            previous (dict): Entries of the previous manifest.
+            current (dict): Entries of the new manifest.
+        """
+        keep = set()
+
+        for entry in current.values():
+            keep.update(entry['files'])
+
+        for entry in previous.values():
+            for name in entry['files']:
+                if name in keep:
+                    continue
+
+                try:
+                    path = self._path(name)
+                    os.remove(path)
+                    self.counts['removed'] += 1
+
+                except (OSError, ValueError):
+                    continue
+
+                # Remove empty directories (up to the destination)
+                directory = os.path.dirname(path)
+
+                while directory != self.destination:
+                    try:
+                        os.rmdir(directory)
+
+                    except OSError:
+                        break
+
+                    directory = os.path.dirname(directory)
+
+    def _write_redirects(self, documents):
+        """Write the nginx map of redirections.
+
+        Args:
+            documents (dict): Manifest entries of the documents.
+        """
+        lines = [
+            '{} {};\n'.format(_quote(url), _quote(entry['redirect']))
+            for url, entry in sorted(documents.items())
+            if entry.get('redirect')
+        ]
+
+        _write_atomic(self._path(REDIRECTS_NAME), ''.join(lines).encode('utf-8'))
+
+    def _site_fingerprint(self):
+        """Obtain the fingerprint of everything shared by all documents."""
+        config = current_app.config
+        templates = []
+
+        for loader_path in _template_dirs(current_app):
+            for root, _dirs, files in os.walk(loader_path):
+                for name in files:
+                    path = os.path.join(root, name)
+                    templates.append((path, os.path.getmtime(path)))
+
+        return _fingerprint(
+            config.get('__version__'),
+            self.base_url,
+            [repr(config.get(key)) for key in _SITE_CONFIG],
+            sorted(templates)
+        )
+
+    def _load_manifest(self):
+        path = self._path(MANIFEST_NAME)
+
+        if not os.path.isfile(path):
+            return {}
+
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+
+        if manifest.get('version') != 1:
+            return {}
+
+        return manifest
+
+    def _save_manifest(self, manifest):
+        _write_atomic(
+            self._path(MANIFEST_NAME),
+            json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8')
+        )
+
+    def _path(self, name):
+        """Obtain the absolute path of a file in the destination directory.
+
+        Raises:
+            `ValueError` if the name is not safe.
+        """
+        path = safe_join(self.destination, name)
+
+        if path is None:
+            raise ValueError('Unsafe path: {}'.format(name))
+
+        return path
+
+
+def _init_worker():
+    """Initialize a rendering process."""
+    global _worker_client
+
+    # Use a client of its own
+    _worker_client = None
+
+
+def _render_document(job):
+    """Render a document and write it to the destination directory.
+
+    Args:
+        job (tuple): URL and fingerprint of the document.
+
+    Returns:
+        Tuple with the URL and its manifest entry (`None` on failure).
+    """
+    global _worker_client
+
+    url, fingerprint = job
+    destination, base_url = _worker_options
+
+    if _worker_client is None:
+        _worker_client = _worker_app.test_client()
+
+    try:
+        response = _worker_client.get(url, base_url=base_url)
+
+    except Exception:
+        _worker_app.logger.exception('Failed to render %s', url)
+        return url, None
+
+    try:
+        if response.status_code in (301, 302, 303, 307, 308):
+            return url, {
+                'fingerprint': fingerprint,
+                'files': [],
+                'redirect': response.headers['Location']
+            }
+
+        if response.status_code != 200:
+            return url, None
+
+        name = _document_file(url, response.mimetype)
+        path = safe_join(destination, name)
+
+        if path is None:
+            return url, None
+
+        _write_atomic(path, response.get_data())
+
+        return url, {'fingerprint': fingerprint, 'files': [name]}
+
+    finally:
+        response.close()
+
+
+def _document_file(url, mimetype):
+    """Obtain the relative path of the file of a document.
+
+    Args:
+        url (str): URL of the document (optionally with a `page` query).
+        mimetype (str): Type of the rendered document.
+
+    Returns:
+        Relative path.
+    """
+    path, _sep, query = url.partition('?')
+
+    # The web server looks for the decoded path
+    path = url_unquote(path).strip('/')
+
+    if mimetype != 'text/html':
+        return path
+
+    name = 'index.html'
+
+    if query.startswith('page='):
+        name = 'index.page-{}.html'.format(query[5:])
+
+    return '{}/{}'.format(path, name) if path else name
+
+
+def _listing_targets(url, fingerprints, per_page):
+    """Obtain the URLs of all the pages of a listing.
+
+    Args:
+        url (str): URL of the first page.
+        fingerprints (list): Fingerprints of the listed posts, in order.
+        per_page (int): Number of posts per page.
+
+    Returns:
+        Dictionary mapping URLs to fingerprints.
+    """
+    pages = max(1, math.ceil(len(fingerprints) / per_page))
+    targets = {}
+
+    for page in range(1, pages + 1):
+        page_url = url if page == 1 else '{}?page={}'.format(url, page)
+
+        # The number of pages determines the pagination links
+        targets[page_url] = _fingerprint(
+            pages,
+            fingerprints[(page - 1) * per_page:page * per_page]
+        )
+
+    return targets
+
+
+def _template_dirs(app):
+    """Obtain the template directories of the application and blueprints."""
+    dirs = []
+
+    for scaffold in [app] + list(app.blueprints.values()):
+        if scaffold.template_folder:
+            path = os.path.join(scaffold.root_path, scaffold.template_folder)
+
+            if os.path.isdir(path):
+                dirs.append(path)
+
+    return dirs
+
+
+def _fingerprint(*values):
+    """Hash the given JSON serializable values (dates are converted)."""
+    data = json.dumps(values, sort_keys=True, default=str).encode('utf-8')
+
+    return hashlib.sha256(data).hexdigest()[:20]
+
+
+def _quote(value):
+    """Quote a string for nginx configuration files."""
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _write_atomic(path, data):
+    """Write a file, replacing any previous version atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+
+    os.replace(tmp_path, path)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""This file contains the image derivative pipeline.
+
+Uploaded images are resized to several widths and converted to modern
+formats in the background, after being uploaded. Derivatives (variants) are
+stored beside the blob of the original image:
+`_variants/<hash>/<width or "orig">.<format>`, and are only generated once.
+
+Generation requires Pillow (`pip install akamatsu[images]`), but variants
+can be served without it (e.g. when generated by Celery workers in another
+host).
+
+The pipeline expects the following configuration parameters:
+
+- `IMAGE_VARIANT_WIDTHS`: Widths (in pixels) to generate. Defaults to
+    `(320, 640, 1280)`.
+- `IMAGE_VARIANT_FORMATS`: Additional formats to generate (`'webp'` and/or
+    `'avif'`). Defaults to `('webp',)`.
+- `IMAGE_WORKERS`: Number of threads used to generate variants when Celery
+    is not enabled. Defaults to 2.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import tempfile
+import threading
+
+from flask import current_app
+
+from akamatsu.storage import VARIANTS_DIR, blob_path, uploads_root
+
+try:
+    from PIL import Image, ImageOps
+    _HAS_PILLOW = True
+
+except ImportError:
+    _HAS_PILLOW = False
+
+
+# Formats of the images for which variants are generated
+SOURCE_FORMATS = {
+    'image/jpeg': 'jpeg',
+    'image/png': 'png',
+    'image/webp': 'webp'
+}
+
+FORMAT_MIMES = {
+    'avif': 'image/avif',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp'
+}
+
+# Preferred formats when negotiating with the `Accept` header
+_NEGOTIATED_FORMATS = ('avif', 'webp')
+
+_SAVE_OPTIONS = {
+    'avif': {'quality': 60},
+    'jpeg': {'quality': 82, 'optimize': True, 'progressive': True},
+    'png': {'optimize': True},
+    'webp': {'quality': 80, 'method': 4}
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def variant_path(content_hash, width, fmt):
+    """Obtain the path of an image variant.
+
+    Args:
+        content_hash (str): Hash of the original image.
+        width (int): Width of the variant, `None` for the original size.
+        fmt (str): Format of the variant.
+
+    Returns:
+        Absolute path (the variant may not exist).
+    """
+    return os.path.join(
+        uploads_root(),
+        VARIANTS_DIR,
+        content_hash,
+        '{}.{}'.format(width or 'orig', fmt)
+    )
+
+
+def schedule_variants(fupload):
+    """Generate the variants of an uploaded image in the background.
+
+    Uses Celery if enabled, or a local thread pool otherwise. Does nothing
+    if the upload is not a supported image or Pillow is not installed.
+
+    Args:
+        fupload (FileUpload): Uploaded file.
+    """
+    if fupload.mime not in SOURCE_FORMATS or not fupload.content_hash:
+        return
+
+    if current_app.config.get('USE_CELERY', False):
+        from akamatsu.async_tasks import async_image_variants
+
+        async_image_variants.delay(fupload.content_hash, fupload.mime)
+        return
+
+    if not _HAS_PILLOW:
+        return
+
+    app = current_app._get_current_object()
+    paths = _variant_paths(fupload.content_hash, fupload.mime)
+
+    _get_executor(app).submit(
+        _generate_logged,
+        app,
+        blob_path(fupload.content_hash),
+        paths
+    )
+
+
+def generate_variants(content_hash, mime):
+    """Generate the missing variants of an image.
+
+    Args:
+        content_hash (str): Hash of the original image.
+        mime (str): MIME type of the original image.
+
+    Returns:
+        Number of variants generated.
+
+    Raises:
+        `RuntimeError` if Pillow is not installed.
+    """
+    if not _HAS_PILLOW:
+        raise RuntimeError('Pillow is required to generate image variants')
+
+    return _generate(
+        blob_path(content_hash),
+        _variant_paths(content_hash, mime)
+    )
+
+
+def select_variant(fupload, width=None, fmt=None, accept=None):
+    """Select the best variant of an image for a request.
+
+    Args:
+        fupload (FileUpload): Requested image.
+        width (int): Requested width. The smallest variant at least as wide
+            is selected.
+        fmt (str): Requested format. If not specified, the best format
+            accepted by the client is used.
+        accept: `Accept` header of the request (`MIMEAccept`).
+
+    Returns:
+        Tuple with the path and format of the variant, or `None` if the
+        original image should be served.
+    """
+    source_fmt = SOURCE_FORMATS.get(fupload.mime)
+
+    if not source_fmt or not fupload.content_hash:
+        return None
+
+    if fmt:
+        if fmt not in FORMAT_MIMES:
+            return None
+
+        formats = [fmt]
+
+    else:
+        # Only formats explicitly listed, as most browsers also send `*/*`
+        accepted = set(value for value, quality in accept or () if quality > 0)
+
+        formats = [f for f in _NEGOTIATED_FORMATS if FORMAT_MIMES[f] in accepted]
+        formats.append(source_fmt)
+
+    widths = [None]
+
+    if width:
+        larger = [
+            w for w in sorted(_config_widths(current_app.config))
+            if w >= width
+        ]
+
+        if larger:
+            widths.insert(0, larger[0])
+
+    # Prefer smaller images over better formats
+    for variant_width in widths:
+        for variant_fmt in formats:
+            if variant_width is None and variant_fmt == source_fmt:
+                # Original image
+                return None
+
+            path = variant_path(fupload.content_hash, variant_width, variant_fmt)
+
+            if os.path.isfile(path):
+                return path, variant_fmt
+
+    return None
+
+
+def _config_widths(config):
+    return config.get('IMAGE_VARIANT_WIDTHS', (320, 640, 1280))
+
+
+def _variant_paths(content_hash, mime):
+    """Obtain the paths of all the variants of an image.
+
+    Returns:
+        List of tuples with width, format and path of each variant.
+    """
+    source_fmt = SOURCE_FORMATS[mime]
+    formats = [
+        f for f in current_app.config.get('IMAGE_VARIANT_FORMATS', ('webp',))
+        if f != source_fmt and f in FORMAT_MIMES and _can_save(f)
+    ]
+
+    paths = []
+
+    for width in [None] + sorted(set(_config_widths(current_app.config))):
+        variant_formats = formats if width is None else [source_fmt] + formats
+
+        for fmt in variant_formats:
+            paths.append((width, fmt, variant_path(content_hash, width, fmt)))
+
+    return paths
+
+
+def _can_save(fmt):
+    """Check whether the installed Pillow can save images in a format."""
+    if not _HAS_PILLOW:
+        return False
+
+    Image.init()
+
+    return fmt.upper() in Image.SAVE
+
+
+def _generate(source_path, paths):
+    """Generate the missing variants of an image.
+
+    Args:
+        source_path (str): Path of the original image.
+        paths (list): Variants to generate (see `_variant_paths()`).
+
+    Returns:
+        Number of variants generated.
+    """
+    missing = [p for p in paths if not os.path.isfile(p[2])]
+
+    if not missing:
+        return 0
+
+    with Image.open(source_path) as source:
+        image = ImageOps.exif_transpose(source)
+        image.load()
+
+    if image.mode == 'P':
+        # Palette images cannot be resampled
+        image = image.convert('RGBA')
+
+    resized = {None: image}
+    generated = 0
+
+    for width, fmt, path in missing:
+        if width is not None and width >= image.width:
+            # Never upscale
+            continue
+
+        if width not in resized:
+            height = max(1, round(image.height * width / image.width))
+            resized[width] = image.resize((width, height), Image.LANCZOS)
+
+        _save(resized[width], path, fmt)
+        generated += 1
+
+    return generated
+
+
+def _generate_logged(app, source_path, paths):
+    """Generate variants in a worker thread, logging any error."""
+    try:
+        _generate(source_path, paths)
+
+    except Exception:
+        app.logger.exception('Failed to generate variants of %s', source_path)
+
+
+def _save(image, path, fmt):
+    """Save an image atomically."""
+    if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    dst_dir = os.path.dirname(path)
+
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir, 0o755, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=dst_dir, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, fmt.upper(), **_SAVE_OPTIONS.get(fmt, {}))
+
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+        raise
+
+
+def _get_executor(app):
+    """Obtain the thread pool used when Celery is not enabled."""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config.get('IMAGE_WORKERS', 2),
+                thread_name_prefix='akamatsu-images'
+            )
+
+    return _executor
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the background delivery of emails.
+
+Sending an email synchronously blocks the request until the SMTP server
+replies, and opening a new SMTP connection for every message adds several
+round trips. Messages can instead be handed to a `MailQueue`, delivered by
+a background thread through a reused `SMTPConnection`.
+"""
+
+import atexit
+import os
+import queue
+import smtplib
+import threading
+import time
+
+
+# Errors which will not be fixed by sending the message again
+PERMANENT_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused
+)
+
+# Errors which may be fixed by reconnecting and sending the message again
+RETRY_ERRORS = (smtplib.SMTPException, OSError)
+
+# Sentinel used to stop the worker thread
+_STOP = object()
+
+
+class SMTPConnection(object):
+    """SMTP connection reused across messages.
+
+    The connection is opened on the first message and kept open until it
+    has been idle for longer than `idle_timeout` seconds (servers usually
+    drop idle clients). Flask-Mail reconnects by itself after sending
+    `MAIL_MAX_EMAILS` messages.
+
+    Messages must be sent within an application context.
+
+    Args:
+        idle_timeout (int): Seconds after which an idle connection is not
+            reused.
+    """
+
+    def __init__(self, idle_timeout=30):
+        self.idle_timeout = idle_timeout
+
+        self._connection = None
+        self._last_used = 0
+        self._lock = threading.RLock()
+
+    @property
+    def is_open(self):
+        """Whether the connection is currently open."""
+        return self._connection is not None
+
+    @property
+    def idle(self):
+        """Seconds elapsed since the connection was last used."""
+        return time.monotonic() - self._last_used
+
+    def send(self, message):
+        """Send a message, opening the connection if needed.
+
+        The connection is closed if sending fails (unless the message itself
+        was refused), so that the next message starts with a new one.
+
+        Args:
+            message: Flask-Mail `Message` instance.
+
+        Raises:
+            `smtplib.SMTPException` or `OSError` on delivery errors.
+        """
+        from akamatsu import mail
+
+        with self._lock:
+            if self._connection is not None and self.idle > self.idle_timeout:
+                self.close()
+
+            if self._connection is None:
+                connection = mail.connect()
+                self._connection = connection.__enter__()
+
+            try:
+                self._connection.send(message)
+
+            except PERMANENT_ERRORS:
+                # The server resets the transaction, so the connection can be
+                # used for other messages
+                raise
+
+            except Exception:
+                self.close()
+                raise
+
+            self._last_used = time.monotonic()
+
+    def close(self):
+        """Close the connection (if open)."""
+        with self._lock:
+            if self._connection is None:
+                return
+
+            connection, self._connection = self._connection, None
+
+        try:
+            connection.__exit__(None, None, None)
+
+        except RETRY_ERRORS:
+            # Connection already broken
+            pass
+
+
+class MailQueue(object):
+    """In-process queue of emails delivered by a background thread.
+
+    The worker thread is started on the first message (in each process, as
+    threads do not survive forking) and sends messages in batches through
+    the same SMTP connection, retrying failed messages with exponential
+    backoff.
+
+    The queue expects the following configuration variables:
+
+    - `MAIL_QUEUE_SIZE`: Maximum number of messages waiting to be sent
+        (defaults to 100). If the queue is full, messages are sent in the
+        calling thread.
+    - `MAIL_BATCH_SIZE`: Maximum number of messages sent each time the
+        worker wakes up (defaults to 20).
+    - `MAIL_MAX_RETRIES`: Number of times a message is sent again after
+        failing (defaults to 3).
+    - `MAIL_RETRY_BACKOFF`: Seconds to wait before the first retry, doubled
+        on each subsequent retry (defaults to 2).
+    - `MAIL_IDLE_TIMEOUT`: Seconds to keep the SMTP connection open while
+        there are no messages (defaults to 30).
+    """
+
+    def __init__(self):
+        self._app = None
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.queue_size = 100
+        self.batch_size = 20
+        self.max_retries = 3
+        self.retry_backoff = 2
+        self.idle_timeout = 30
+
+    def init_app(self, app):
+        """Configure the queue.
+
+        Args:
+            app: Flask application.
+        """
+        self._app = app
+
+        self.queue_size = app.config.get('MAIL_QUEUE_SIZE', 100)
+        self.batch_size = app.config.get('MAIL_BATCH_SIZE', 20)
+        self.max_retries = app.config.get('MAIL_MAX_RETRIES', 3)
+        self.retry_backoff = app.config.get('MAIL_RETRY_BACKOFF', 2)
+        self.idle_timeout = app.config.get('MAIL_IDLE_TIMEOUT', 30)
+
+    @property
+    def pending(self):
+        """Number of messages waiting to be sent."""
+        if self._queue is None:
+            return 0
+
+        return self._queue.qsize()
+
+    def send(self, message):
+        """Queue a message for delivery.
+
+        Args:
+            message: Flask-Mail `Message` instance.
+        """
+        self._ensure_worker()
+
+        try:
+            self._queue.put_nowait(message)
+
+        except queue.Full:
+            from akamatsu import mail
+
+            self._app.logger.warning('Mail queue is full, sending synchronously')
+            mail.send(message)
+
+    def stop(self, timeout=10):
+        """Stop the worker thread after sending the queued messages.
+
+        Args:
+            timeout (int): Maximum seconds to wait for the worker.
+        """
+        with self._lock:
+            thread = self._thread
+
+            if thread is None or self._pid != os.getpid():
+                return
+
+            self._queue.put(_STOP)
+            self._thread = None
+
+        thread.join(timeout)
+
+    def _ensure_worker(self):
+        """Start the worker thread if it is not running in this process."""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.queue_size)
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self._queue,),
+                name='akamatsu-mail',
+                daemon=True
+            )
+            self._thread.start()
+
+        atexit.register(self.stop)
+
+    def _run(self, messages):
+        """Deliver queued messages until stopped.
+
+        Args:
+            messages: Queue to read the messages from.
+        """
+        with self._app.app_context():
+            connection = SMTPConnection(self.idle_timeout)
+
+            while True:
+                try:
+                    message = messages.get(
+                        timeout=self.idle_timeout if connection.is_open else None
+                    )
+
+                except queue.Empty:
+                    connection.close()
+                    continue
+
+                batch = [message]
+
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(messages.get_nowait())
+
+                    except queue.Empty:
+                        break
+
+                for message in batch:
+                    if message is _STOP:
+                        connection.close()
+                        return
+
+                    self._deliver(connection, message)
+
+    def _deliver(self, connection, message):
+        """Send a message, retrying with backoff if it fails.
+
+        Args:
+            connection: `SMTPConnection` to send the message through.
+            message: Flask-Mail `Message` instance.
+
+        Returns:
+            `True` if the message was sent, otherwise `False`.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                connection.send(message)
+                return True
+
+            except PERMANENT_ERRORS:
+                self._app.logger.exception(
+                    'Failed to send email to %s', message.recipients
+                )
+                return False
+
+            except RETRY_ERRORS:
+                if attempt == self.max_retries:
+                    self._app.logger.exception(
+                        'Failed to send email to %s after %d attempts',
+                        message.recipients,
+                        attempt + 1
+                    )
+                    return False
+
+                time.sleep(self.retry_backoff * 2 ** attempt)
+
+        return False
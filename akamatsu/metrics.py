@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the instrumentation of requests.
+
+Requests are timed along with the SQL statements, templates and markdown
+rendered while handling them. Measurements are aggregated in-process into
+histograms labelled by endpoint and exposed in the Prometheus text format,
+as well as summarized for each response in the `Server-Timing` header.
+
+As measurements are kept in memory, each worker process exposes its own
+metrics (the scraper should target every process or use a single one).
+"""
+
+from bisect import bisect_left
+import hmac
+import threading
+import time
+
+from flask import Response, abort, g, has_request_context, request
+from flask.signals import before_render_template, signals_available, \
+        template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Buckets of duration histograms (seconds)
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+# Buckets of the number of SQL statements per request
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    """Histogram of observations grouped by label values.
+
+    Args:
+        name (str): Name of the metric.
+        description (str): Help text of the metric.
+        labels (tuple): Names of the labels.
+        buckets (tuple): Upper bounds of the buckets (sorted).
+    """
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        """Record an observation.
+
+        Args:
+            label_values (tuple): Values of the labels.
+            value (float): Observed value.
+        """
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(label_values)
+
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0, 0
+                ]
+
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        """Obtain the metric in the Prometheus text format.
+
+        Returns:
+            List of lines.
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} histogram'.format(self.name)
+        ]
+
+        with self._lock:
+            series = sorted(
+                (k, (list(v[0]), v[1], v[2])) for k, v in self._series.items()
+            )
+
+        for label_values, (counts, total, count) in series:
+            labels = list(zip(self.labels, label_values))
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(labels + [('le', bound)]),
+                    cumulative
+                ))
+
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(labels), count))
+
+        return lines
+
+
+class Metrics(object):
+    """Request instrumentation.
+
+    The extension expects the following configuration parameters:
+
+    - `METRICS_ENABLED`: Whether to instrument requests (defaults to
+        `False`).
+    - `METRICS_SERVER_TIMING`: Whether to add the `Server-Timing` header to
+        responses (defaults to `True`).
+    - `METRICS_ENDPOINT`: URL of the Prometheus endpoint (defaults to
+        `/_metrics`). Set to `None` to disable the endpoint.
+    - `METRICS_ALLOWED_IPS`: Addresses allowed to access the endpoint
+        (defaults to none).
+    - `METRICS_TOKEN`: Bearer token which also grants access to the
+        endpoint (optional).
+
+    The endpoint is denied to everyone unless one of them is set. Addresses
+    are checked against `request.remote_addr`, which is the address of the
+    proxy when running behind one (e.g. nginx): wrap the application with
+    `werkzeug.middleware.proxy_fix.ProxyFix` before allowing addresses, or
+    use a token instead.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+        self.requests = Histogram(
+            'akamatsu_request_duration_seconds',
+            'Time spent handling requests.',
+            ('endpoint', 'method', 'status'),
+            DURATION_BUCKETS
+        )
+        self.queries = Histogram(
+            'akamatsu_sql_queries_per_request',
+            'Number of SQL statements executed per request.',
+            ('endpoint',),
+            QUERY_BUCKETS
+        )
+        self.query_time = Histogram(
+            'akamatsu_sql_duration_seconds',
+            'Time spent executing each SQL statement.',
+            ('endpoint',),
+            DURATION_BUCKETS
+        )
+        self.templates = Histogram(
+            'akamatsu_template_render_seconds',
+            'Time spent rendering each template.',
+            ('template',),
+            DURATION_BUCKETS
+        )
+        self.markdown = Histogram(
+            'akamatsu_markdown_render_seconds',
+            'Time spent rendering markdown.',
+            (),
+            DURATION_BUCKETS
+        )
+
+        self._server_timing = True
+        self._allowed_ips = ()
+        self._token = None
+
+    def init_app(self, app):
+        """Register the instrumentation hooks.
+
+        Args:
+            app: Application instance.
+        """
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+
+        if not self.enabled:
+            return
+
+        self._server_timing = app.config.get('METRICS_SERVER_TIMING', True)
+        self._allowed_ips = app.config.get('METRICS_ALLOWED_IPS', ())
+        self._token = app.config.get('METRICS_TOKEN')
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+        # Engine events apply to every engine (created lazily)
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+        if signals_available:
+            before_render_template.connect(self._before_render_template, app)
+            template_rendered.connect(self._template_rendered, app)
+
+        else:
+            app.logger.warning('blinker is not installed, templates will not be timed')
+
+        from akamatsu import md
+        md.on_render = self._markdown_rendered
+
+        endpoint = app.config.get('METRICS_ENDPOINT', '/_metrics')
+
+        if endpoint:
+            app.add_url_rule(endpoint, 'metrics', self._expose)
+
+    def _before_request(self):
+        """Start measuring a request."""
+        g._metrics = {
+            'start': time.perf_counter(),
+            'queries': 0,
+            'sql': 0,
+            'templates': [],
+            'template': 0,
+            'markdown': 0
+        }
+
+    def _after_request(self, response):
+        """Record the measurements of a request.
+
+        Args:
+            response: Response of the request.
+
+        Returns:
+            Response, with the `Server-Timing` header if enabled.
+        """
+        measures = g.pop('_metrics', None)
+
+        if measures is None:
+            return response
+
+        elapsed = time.perf_counter() - measures['start']
+        endpoint = request.endpoint or 'none'
+
+        self.requests.observe(
+            (endpoint, request.method, str(response.status_code)),
+            elapsed
+        )
+        self.queries.observe((endpoint,), measures['queries'])
+
+        if self._server_timing:
+            response.headers.add(
+                'Server-Timing',
+                'app;dur={:.1f}, db;dur={:.1f};desc="{} queries", '
+                'tpl;dur={:.1f}, md;dur={:.1f}'.format(
+                    elapsed * 1000,
+                    measures['sql'] * 1000,
+                    measures['queries'],
+                    measures['template'] * 1000,
+                    measures['markdown'] * 1000
+                )
+            )
+
+        return response
+
+    def _query_executed(self, elapsed):
+        """Record the execution of a SQL statement.
+
+        Args:
+            elapsed (float): Seconds spent executing the statement.
+        """
+        measures = g.get('_metrics')
+
+        if measures is None:
+            return
+
+        measures['queries'] += 1
+        measures['sql'] += elapsed
+
+        self.query_time.observe((request.endpoint or 'none',), elapsed)
+
+    def _before_render_template(self, sender, template, context, **extra):
+        """Start measuring the rendering of a template."""
+        measures = g.get('_metrics')
+
+        if measures is not None:
+            measures['templates'].append(time.perf_counter())
+
+    def _template_rendered(self, sender, template, context, **extra):
+        """Record the rendering of a template."""
+        measures = g.get('_metrics')
+
+        if measures is None or not measures['templates']:
+            return
+
+        elapsed = time.perf_counter() - measures['templates'].pop()
+
+        # Nested renders are already included in the outer template
+        if not measures['templates']:
+            measures['template'] += elapsed
+
+        self.templates.observe((template.name or 'string',), elapsed)
+
+    def _markdown_rendered(self, elapsed):
+        """Record the rendering of markdown content.
+
+        Args:
+            elapsed (float): Seconds spent rendering.
+        """
+        self.markdown.observe((), elapsed)
+
+        if has_request_context():
+            measures = g.get('_metrics')
+
+            if measures is not None:
+                measures['markdown'] += elapsed
+
+    def _expose(self):
+        """Expose the metrics in the Prometheus text format."""
+        if not self._is_allowed():
+            abort(404)
+
+        lines = []
+
+        for histogram in (
+                self.requests, self.queries, self.query_time,
+                self.templates, self.markdown):
+            lines.extend(histogram.expose())
+
+        lines.extend(_component_metrics())
+
+        return Response(
+            '\n'.join(lines) + '\n',
+            mimetype='text/plain; version=0.0.4'
+        )
+
+    def _is_allowed(self):
+        """Check whether the current request can access the metrics.
+
+        Returns:
+            `True` if allowed, otherwise `False`.
+        """
+        if self._allowed_ips and request.remote_addr in self._allowed_ips:
+            return True
+
+        if self._token:
+            return hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                'Bearer {}'.format(self._token)
+            )
+
+        return False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Start measuring a SQL statement."""
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Record the execution of a SQL statement within a request."""
+    start = getattr(context, '_metrics_start', None)
+
+    if start is None or not has_request_context():
+        return
+
+    from akamatsu import metrics
+    metrics._query_executed(time.perf_counter() - start)
+
+
+def _component_metrics():
+    """Obtain metrics of other components of the application.
+
+    Returns:
+        List of lines in the Prometheus text format.
+    """
+    from akamatsu import crypto_manager, feed_cache, identity_cache, \
+            mail_queue, md
+
+    caches = (
+        ('markdown', md.cache),
+        ('feed', feed_cache),
+        ('identity', identity_cache)
+    )
+    lines = []
+
+    for name, kind, description in (
+            ('akamatsu_cache_hits_total', 'counter', 'Cache hits.'),
+            ('akamatsu_cache_misses_total', 'counter', 'Cache misses.'),
+            ('akamatsu_cache_entries', 'gauge', 'Entries in the cache.')):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+        for cache_name, cache in caches:
+            info = cache.info()
+            value = {
+                'akamatsu_cache_hits_total': info.hits,
+                'akamatsu_cache_misses_total': info.misses,
+                'akamatsu_cache_entries': info.currsize
+            }[name]
+
+            lines.append('{}{} {}'.format(
+                name,
+                _format_labels([('cache', cache_name)]),
+                value
+            ))
+
+    stats = crypto_manager.stats()
+
+    lines.append('# HELP akamatsu_passlib_operations_total Password hashing operations.')
+    lines.append('# TYPE akamatsu_passlib_operations_total counter')
+
+    for operation, values in sorted(stats.items()):
+        if isinstance(values, dict):
+            lines.append('akamatsu_passlib_operations_total{} {}'.format(
+                _format_labels([('operation', operation)]),
+                values['count']
+            ))
+
+    lines.append('# HELP akamatsu_passlib_seconds_total Time spent in password hashing operations.')
+    lines.append('# TYPE akamatsu_passlib_seconds_total counter')
+
+    for operation, values in sorted(stats.items()):
+        if isinstance(values, dict):
+            lines.append('akamatsu_passlib_seconds_total{} {}'.format(
+                _format_labels([('operation', operation)]),
+                values['total']
+            ))
+
+    lines.append('# HELP akamatsu_passlib_pending Password hashing operations in progress.')
+    lines.append('# TYPE akamatsu_passlib_pending gauge')
+    lines.append('akamatsu_passlib_pending {}'.format(stats.get('pending', 0)))
+
+    lines.append('# HELP akamatsu_mail_queue_pending Emails waiting to be sent.')
+    lines.append('# TYPE akamatsu_mail_queue_pending gauge')
+    lines.append('akamatsu_mail_queue_pending {}'.format(mail_queue.pending))
+
+    return lines
+
+
+def _format_labels(labels):
+    """Format labels for the Prometheus text format.
+
+    Args:
+        labels (list): Tuples with the name and value of each label.
+
+    Returns:
+        Formatted labels (empty if there are no labels).
+    """
+    if not labels:
+        return ''
+
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for name, value in labels
+    ))
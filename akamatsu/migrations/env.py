@@ -22,12 +22,27 @@ config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+from akamatsu.search import TABLE_NAME as SEARCH_TABLE
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    """Skip the search index in autogenerate.
+
+    The index is created and rebuilt by `akamatsu.search` (an FTS5 virtual
+    table and its shadow tables in SQLite), so it is not in the metadata.
+    """
+    if type_ == 'table' and reflected and compare_to is None \
+            and (name == SEARCH_TABLE or name.startswith(SEARCH_TABLE + '_')):
+        return False
+
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -41,7 +56,7 @@ def run_migrations_offline():
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    context.configure(url=url)
+    context.configure(url=url, include_object=include_object)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -73,6 +88,7 @@ def run_migrations_online():
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      include_object=include_object,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
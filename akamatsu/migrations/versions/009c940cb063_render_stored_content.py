@@ -0,0 +1,54 @@
+"""Render stored content of pages and posts
+
+Revision ID: 009c940cb063
+Revises: 4fb51043126a
+Create Date: 2026-10-17 21:14:05.827163
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '009c940cb063'
+down_revision = '4fb51043126a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Content saved before 3aca20acfe7a would be rendered on every request
+    # (and loaded even by the queries that defer it)
+    from akamatsu import md
+    from akamatsu.models import hash_content
+
+    connection = op.get_bind()
+
+    for name in ('pages', 'posts'):
+        table = sa.table(
+            name,
+            sa.column('id', sa.Integer),
+            sa.column('content', sa.Text),
+            sa.column('content_html', sa.Text),
+            sa.column('content_hash', sa.String)
+        )
+
+        rows = connection.execute(
+            sa.select([table.c.id, table.c.content])
+            .where(table.c.content_html == None)
+        ).fetchall()
+
+        for row_id, content in rows:
+            content = content or ''
+
+            connection.execute(
+                table.update()
+                .where(table.c.id == row_id)
+                .values(
+                    content_html=str(md.render(content)),
+                    content_hash=hash_content(content)
+                )
+            )
+
+
+def downgrade():
+    # Rendered content is derived from the markdown, nothing to undo
+    pass
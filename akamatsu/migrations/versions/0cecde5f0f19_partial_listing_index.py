@@ -0,0 +1,38 @@
+"""Make the public listing index partial
+
+Revision ID: 0cecde5f0f19
+Revises: 308f4aa9580d
+Create Date: 2026-10-17 16:40:12.927305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0cecde5f0f19'
+down_revision = '308f4aa9580d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Only published posts that are not ghosts are listed, so the index only
+    # needs to cover those (engines without partial indexes index all rows).
+    # The filtered columns are kept first: otherwise SQLite prefers the
+    # index on ghosted_id and sorts the rows
+    op.drop_index('ix_posts_listing', table_name='posts')
+    op.create_index(
+        'ix_posts_listing',
+        'posts',
+        ['is_published', 'ghosted_id', 'last_updated', 'id'],
+        sqlite_where=sa.text('is_published = 1 AND ghosted_id IS NULL'),
+        postgresql_where=sa.text('is_published AND ghosted_id IS NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_posts_listing', table_name='posts')
+    op.create_index(
+        'ix_posts_listing',
+        'posts',
+        ['is_published', 'ghosted_id', 'last_updated', 'id']
+    )
@@ -0,0 +1,77 @@
+"""Add full-text search index
+
+Revision ID: 308f4aa9580d
+Revises: e6ef33cc80db
+Create Date: 2026-10-17 15:02:41.508316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '308f4aa9580d'
+down_revision = 'e6ef33cc80db'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+SUMMARY_BREAK = '<!--aka-break-->'
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    if bind.dialect.name == 'sqlite':
+        try:
+            op.execute(
+                "CREATE VIRTUAL TABLE search_index USING fts5("
+                "kind UNINDEXED, item_id UNINDEXED, title, content, "
+                "tokenize='porter unicode61')"
+            )
+
+        except sa.exc.OperationalError:
+            # SQLite built without FTS5, the in-process index is used instead
+            return
+
+        # The rowid is derived from the kind and ID of each document
+        for offset, kind, table in ((0, 'post', 'posts'), (1, 'page', 'pages')):
+            bind.execute(sa.text(
+                "INSERT INTO search_index (rowid, kind, item_id, title, content) "
+                "SELECT id * 2 + {}, '{}', id, title, "
+                "REPLACE(content, :summary_break, '') "
+                "FROM {} WHERE is_published = 1 AND ghosted_id IS NULL"
+                .format(offset, kind, table)
+            ), {'summary_break': SUMMARY_BREAK})
+
+    elif bind.dialect.name == 'postgresql':
+        op.create_table(
+            'search_index',
+            sa.Column('kind', sa.String(length=8), nullable=False),
+            sa.Column('item_id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=255), nullable=True),
+            sa.Column('content', sa.Text(), nullable=True),
+            sa.Column('document', postgresql.TSVECTOR(), nullable=False),
+            sa.PrimaryKeyConstraint('kind', 'item_id')
+        )
+        op.create_index(
+            'ix_search_index_document',
+            'search_index',
+            ['document'],
+            postgresql_using='gin'
+        )
+
+        for kind, table in (('post', 'posts'), ('page', 'pages')):
+            content = "replace(content, :summary_break, '')"
+
+            bind.execute(sa.text(
+                "INSERT INTO search_index (kind, item_id, title, content, document) "
+                "SELECT '{kind}', id, title, {content}, "
+                "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                "setweight(to_tsvector('english', coalesce({content}, '')), 'B') "
+                "FROM {table} WHERE is_published AND ghosted_id IS NULL"
+                .format(kind=kind, content=content, table=table)
+            ), {'summary_break': SUMMARY_BREAK})
+
+
+def downgrade():
+    op.execute('DROP TABLE IF EXISTS search_index')
@@ -0,0 +1,27 @@
+"""Add content hash to uploads
+
+Revision ID: 3a7fed928b90
+Revises: 4b0be5b3ba95
+Create Date: 2026-10-17 13:41:09.502871
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a7fed928b90'
+down_revision = '4b0be5b3ba95'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Existing uploads are hashed with `data hash-uploads`
+    op.add_column(
+        'uploads',
+        sa.Column('content_hash', sa.String(length=64), nullable=True)
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('uploads') as batch_op:
+        batch_op.drop_column('content_hash')
@@ -0,0 +1,32 @@
+"""Store rendered content of pages and posts
+
+Revision ID: 3aca20acfe7a
+Revises: 7cc292cfbb0a
+Create Date: 2026-10-17 10:12:31.402215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3aca20acfe7a'
+down_revision = '7cc292cfbb0a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Existing content is rendered in 009c940cb063
+    op.add_column('pages', sa.Column('content_html', sa.Text(), nullable=True))
+    op.add_column('pages', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.add_column('posts', sa.Column('content_html', sa.Text(), nullable=True))
+    op.add_column('posts', sa.Column('content_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('content_hash')
+        batch_op.drop_column('content_html')
+
+    with op.batch_alter_table('pages') as batch_op:
+        batch_op.drop_column('content_hash')
+        batch_op.drop_column('content_html')
@@ -0,0 +1,29 @@
+"""Add version stamps for in-process caches
+
+Revision ID: 4b0be5b3ba95
+Revises: 4fce96e77c90
+Create Date: 2026-10-17 13:02:41.318457
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b0be5b3ba95'
+down_revision = '4fce96e77c90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    cache_versions = op.create_table(
+        'cache_versions',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+    op.bulk_insert(cache_versions, [{'name': 'pages', 'version': 0}])
+
+
+def downgrade():
+    op.drop_table('cache_versions')
@@ -0,0 +1,24 @@
+"""Add dates of change to cache versions
+
+Revision ID: 4fb51043126a
+Revises: 0cecde5f0f19
+Create Date: 2026-10-17 17:05:48.310592
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4fb51043126a'
+down_revision = '0cecde5f0f19'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('cache_versions') as batch_op:
+        batch_op.add_column(sa.Column('changed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('cache_versions') as batch_op:
+        batch_op.drop_column('changed_at')
@@ -0,0 +1,41 @@
+"""Add indexes for public listings and association tables
+
+Revision ID: 4fce96e77c90
+Revises: 98c1eb6bcee7
+Create Date: 2026-10-17 12:20:05.664310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4fce96e77c90'
+down_revision = '98c1eb6bcee7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Published posts that are not ghosts, sorted by date (and ID for keyset
+    # pagination). B-tree indexes can be scanned backwards for DESC ordering
+    op.create_index(
+        'ix_posts_listing',
+        'posts',
+        ['is_published', 'ghosted_id', 'last_updated', 'id']
+    )
+
+    # Ghost listings and ghost relationships
+    op.create_index('ix_posts_ghosted_id', 'posts', ['ghosted_id'])
+    op.create_index('ix_pages_ghosted_id', 'pages', ['ghosted_id'])
+
+    # Reverse lookups in association tables (the primary keys already cover
+    # the first column)
+    op.create_index('ix_post_tags_tag_id', 'post_tags', ['tag_id'])
+    op.create_index('ix_user_posts_post_id', 'user_posts', ['post_id'])
+
+
+def downgrade():
+    op.drop_index('ix_user_posts_post_id', table_name='user_posts')
+    op.drop_index('ix_post_tags_tag_id', table_name='post_tags')
+    op.drop_index('ix_pages_ghosted_id', table_name='pages')
+    op.drop_index('ix_posts_ghosted_id', table_name='posts')
+    op.drop_index('ix_posts_listing', table_name='posts')
@@ -0,0 +1,47 @@
+"""Render stored summaries of posts
+
+Revision ID: 9402323b755a
+Revises: 009c940cb063
+Create Date: 2026-10-17 21:26:43.194508
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9402323b755a'
+down_revision = '009c940cb063'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Listings defer the content of posts, which would otherwise be loaded
+    # (and summarized) for each post saved before 98c1eb6bcee7
+    from akamatsu import md
+    from akamatsu.models import summarize
+
+    connection = op.get_bind()
+
+    posts = sa.table(
+        'posts',
+        sa.column('id', sa.Integer),
+        sa.column('content', sa.Text),
+        sa.column('summary_html', sa.Text)
+    )
+
+    rows = connection.execute(
+        sa.select([posts.c.id, posts.c.content])
+        .where(posts.c.summary_html == None)
+    ).fetchall()
+
+    for post_id, content in rows:
+        connection.execute(
+            posts.update()
+            .where(posts.c.id == post_id)
+            .values(summary_html=str(md.render(summarize(content or ''))))
+        )
+
+
+def downgrade():
+    # Rendered summaries are derived from the markdown, nothing to undo
+    pass
@@ -0,0 +1,24 @@
+"""Store rendered summary of posts
+
+Revision ID: 98c1eb6bcee7
+Revises: 3aca20acfe7a
+Create Date: 2026-10-17 11:02:47.118930
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '98c1eb6bcee7'
+down_revision = '3aca20acfe7a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Existing summaries are rendered in 9402323b755a
+    op.add_column('posts', sa.Column('summary_html', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('summary_html')
@@ -0,0 +1,23 @@
+"""Add index on upload content hashes
+
+Revision ID: e6ef33cc80db
+Revises: 3a7fed928b90
+Create Date: 2026-10-17 14:10:37.184520
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6ef33cc80db'
+down_revision = '3a7fed928b90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Blob references are checked when deleting uploads
+    op.create_index('ix_uploads_content_hash', 'uploads', ['content_hash'])
+
+
+def downgrade():
+    op.drop_index('ix_uploads_content_hash', table_name='uploads')
@@ -28,16 +28,31 @@
 """This file contains SQLAlchemy model declarations."""
 
 import datetime
+import hashlib
+import time
 
 import slugify
 
+from flask import Markup
 from flask_login import UserMixin
 from sqlalchemy import event
 from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import Session, joinedload, make_transient_to_detached, \
+        object_session
 
-from akamatsu import db, hashids_hasher
+from akamatsu import db, feed_cache, hashids_hasher, identity_cache, md, \
+        page_routes, search_index
 
 
+# Marker used to separate the summary of a post from the rest of its content
+SUMMARY_BREAK = '<!--aka-break-->'
+
+# Length of the content hash prefix used in fingerprinted upload URLs
+FINGERPRINT_LENGTH = 16
+
+# Name of the version stamp of the blog feed (see `CacheVersion`)
+FEED_VERSION = 'feed'
+
 # Intermediate user-role table
 user_roles = db.Table(
     'user_roles',
@@ -70,7 +85,9 @@ user_posts = db.Table(
         db.Integer,
         db.ForeignKey('posts.id', name='fk_user_posts_post'),
         primary_key=True
-    )
+    ),
+    # Primary key already covers lookups by user
+    db.Index('ix_user_posts_post_id', 'post_id')
 )
 
 
@@ -88,7 +105,9 @@ post_tags = db.Table(
         db.Integer,
         db.ForeignKey('tags.id', name='fk_post_tags_tag'),
         primary_key=True
-    )
+    ),
+    # Primary key already covers lookups by post
+    db.Index('ix_post_tags_tag_id', 'tag_id')
 )
 
 
@@ -142,17 +161,89 @@ class BaseModel(db.Model):
             setattr(self, k, v)
 
 
+class RenderedContentMixin(object):
+    """Mixin for models whose markdown content is rendered on save.
+
+    Rendering markdown on every request is expensive, so the resulting HTML
+    is stored alongside a hash of the source it was rendered from. The
+    content is rendered again only when the source changes (or when forced,
+    e.g. after modifying the renderer configuration).
+
+    Attributes:
+        content_html (str): HTML rendered from the content.
+        content_hash (str): SHA-256 hex digest of the rendered content.
+    """
+    content_html = db.Column(db.Text, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+
+    @property
+    def html(self):
+        """Obtain the rendered HTML of the content.
+
+        Falls back to rendering on the fly if the content has not been
+        rendered yet (e.g. right after a migration).
+
+        Returns:
+            `Markup` instance.
+        """
+        if self.content_html is None:
+            return md.render(self.content or '')
+
+        return Markup(self.content_html)
+
+    @classmethod
+    def render_fields(cls, content):
+        """Render the given content.
+
+        Args:
+            content (str): Markdown content to render.
+
+        Returns:
+            Dictionary with the values of the rendered attributes.
+        """
+        content = content or ''
+
+        return {
+            'content_html': str(md.render(content)),
+            'content_hash': hash_content(content)
+        }
+
+    def render_content(self, force=False):
+        """Render the content of the instance if it has changed.
+
+        Args:
+            force (bool): Render even if the content has not changed.
+
+        Returns:
+            `True` if the content was rendered, otherwise `False`.
+        """
+        if not force and self.content_html is not None and \
+                self.content_hash == hash_content(self.content or ''):
+            return False
+
+        self.update(**self.render_fields(self.content))
+
+        return True
+
+
 # CMS models
 class FileUpload(BaseModel):
     """Model for static file uploads.
 
     Attributes:
         id (int): Unique ID of the record.
-        path (str): Path to the file relative to the uploads directory.
+        path (str): Logical path of the file, used in its URL.
         description (str): Optional description of the file.
         uploaded_at (datetime): UTC datetime in which the file was uploaded.
+        content_hash (str): SHA-256 hash of the contents of the file. Used
+            to locate the contents in the blob store, as strong ETag and to
+            build fingerprinted URLs.
     """
     __tablename__ = 'uploads'
+    __table_args__ = (
+        # Blob references
+        db.Index('ix_uploads_content_hash', 'content_hash'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -164,7 +255,20 @@ class FileUpload(BaseModel):
         nullable=False,
         default=datetime.datetime.utcnow()
     )
+    content_hash = db.Column(db.String(64), nullable=True)
+
+    @property
+    def fingerprint(self):
+        """Obtain the fingerprint used in immutable URLs of the file.
+
+        Returns:
+            First 16 characters of the content hash or `None` if the hash
+            has not been computed.
+        """
+        if not self.content_hash:
+            return None
 
+        return self.content_hash[:FINGERPRINT_LENGTH]
 
     @classmethod
     def get_by_path(cls, path):
@@ -176,7 +280,7 @@ class FileUpload(BaseModel):
         return cls.query.filter_by(path=path).first()
 
 
-class Page(BaseModel):
+class Page(BaseModel, RenderedContentMixin):
     """Model for dynamic pages.
 
     Pages may be written in markdown (default) or in html. Security should
@@ -202,8 +306,16 @@ class Page(BaseModel):
         is_published (bool): Whether the page is published.
         comments_enabled (bool): Whether comments are enabled for this page.
         last_updated (datetime): UTC datetime in which the page was last edited.
+        content_html (str): Rendered content of the page.
+        content_hash (str): Hash of the rendered content.
     """
     __tablename__ = 'pages'
+    __table_args__ = (
+        db.Index('ix_pages_ghosted_id', 'ghosted_id'),
+    )
+
+    # Kind of document in the search index
+    SEARCH_KIND = 'page'
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -232,8 +344,17 @@ class Page(BaseModel):
     def __str__(self):
         return self.title
 
+    @property
+    def cache_tags(self):
+        """Obtain the tags of the cached responses showing this page.
+
+        Returns:
+            List of tags (see `akamatsu.cache.ResponseCache`).
+        """
+        return ['page:{}'.format(self.id)]
 
-class Post(BaseModel):
+
+class Post(BaseModel, RenderedContentMixin):
     """Model for blog posts.
 
     Posts are written in markdown.
@@ -245,11 +366,29 @@ class Post(BaseModel):
             be a ghost post.
         title (str): Title of the post.
         slug (str): Slug of the post. Can be automatically generated.
+        content (str): Content of the post in markdown.
         is_published (bool): Whether the post is published.
         comments_enabled (bool): Whether comments are enabled for this post.
         last_updated (datetime): UTC datetime in which the post was last edited.
+        content_html (str): Rendered content of the post.
+        content_hash (str): Hash of the rendered content.
+        summary_html (str): Rendered summary of the post (content up to the
+            first break marker).
     """
     __tablename__ = 'posts'
+    __table_args__ = (
+        # Public listings: published, not ghosts, newest first
+        db.Index(
+            'ix_posts_listing',
+            'is_published', 'ghosted_id', 'last_updated', 'id',
+            sqlite_where=db.text('is_published = 1 AND ghosted_id IS NULL'),
+            postgresql_where=db.text('is_published AND ghosted_id IS NULL')
+        ),
+        db.Index('ix_posts_ghosted_id', 'ghosted_id'),
+    )
+
+    # Kind of document in the search index
+    SEARCH_KIND = 'post'
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -264,6 +403,7 @@ class Post(BaseModel):
     is_published = db.Column(db.Boolean, default=False)
     comments_enabled = db.Column(db.Boolean, default=False)
     last_updated = db.Column(db.DateTime)
+    summary_html = db.Column(db.Text, nullable=True)
 
     # Relationships
     ghosts = db.relationship(
@@ -295,6 +435,54 @@ class Post(BaseModel):
     def __str__(self):
         return self.title
 
+    @property
+    def cache_tags(self):
+        """Obtain the tags of the cached responses showing this post.
+
+        This includes the post itself and the listings it appears in.
+
+        Returns:
+            List of tags (see `akamatsu.cache.ResponseCache`).
+        """
+        tags = ['post:{}'.format(self.id), 'listing:index']
+        tags.extend('listing:tag:{}'.format(t) for t in self.tag_names)
+
+        for author in self.authors:
+            tags.append('listing:user:{}'.format(author.username))
+            tags.append('author:{}'.format(author.id))
+
+        return tags
+
+    @property
+    def summary(self):
+        """Obtain the rendered HTML of the summary.
+
+        Falls back to rendering on the fly if the content has not been
+        rendered yet.
+
+        Returns:
+            `Markup` instance.
+        """
+        if self.summary_html is None:
+            return md.render(summarize(self.content or ''))
+
+        return Markup(self.summary_html)
+
+    @classmethod
+    def render_fields(cls, content):
+        """Render the given content and its summary.
+
+        Args:
+            content (str): Markdown content to render.
+
+        Returns:
+            Dictionary with the values of the rendered attributes.
+        """
+        fields = super(Post, cls).render_fields(content)
+        fields['summary_html'] = str(md.render(summarize(content or '')))
+
+        return fields
+
 
 class Tag(db.Model):
     """Post taggings.
@@ -408,6 +596,34 @@ class User(BaseModel, UserMixin):
     def __str__(self):
         return '[{}] {} {}'.format(self.username, self.first_name, self.last_name)
 
+    @property
+    def cache_tags(self):
+        """Obtain the tags of the cached responses showing this user.
+
+        Returns:
+            List of tags (see `akamatsu.cache.ResponseCache`).
+        """
+        return [
+            'author:{}'.format(self.id),
+            'listing:user:{}'.format(self.username)
+        ]
+
+    @property
+    def role_set(self):
+        """Obtain the names of the roles of the user.
+
+        The names are cached in the instance until the roles change.
+
+        Returns:
+            `frozenset` of role names.
+        """
+        role_set = getattr(self, '_role_set', None)
+
+        if role_set is None:
+            role_set = self._role_set = frozenset(self.role_names)
+
+        return role_set
+
     def has_role(self, role):
         """Check whether the user has the specified role.
 
@@ -418,7 +634,69 @@ class User(BaseModel, UserMixin):
             `True` if the user has been assigned the specified role, otherwise
             `False`.
         """
-        return role in self.role_names
+        return role in self.role_set
+
+    @classmethod
+    def load_identity(cls, user_id, ttl=0):
+        """Load the user of a session, including their roles.
+
+        User and roles are obtained in a single query. If a TTL is given,
+        the identity is cached in-process for that many seconds (or until
+        the user or their roles change), and restored without querying.
+
+        Args:
+            user_id (str): ID of the user.
+            ttl (int): Seconds to cache the identity for, 0 to disable.
+
+        Returns:
+            User instance or `None` if not found.
+        """
+        key = str(user_id)
+
+        if ttl:
+            cached = identity_cache.get(key)
+
+            if cached is not None and cached[0] > time.monotonic():
+                return cls._restore_identity(*cached[1:])
+
+        user = (
+            cls.query
+            .options(joinedload(cls.roles))
+            .filter_by(id=user_id)
+        ).first()
+
+        if user is not None and ttl:
+            columns = {
+                attr.key: getattr(user, attr.key)
+                for attr in db.inspect(cls).column_attrs
+            }
+
+            identity_cache.set(
+                key,
+                (time.monotonic() + ttl, columns, user.role_set)
+            )
+
+        return user
+
+    @classmethod
+    def _restore_identity(cls, columns, role_set):
+        """Attach a cached identity to the current session.
+
+        Args:
+            columns (dict): Column values of the user.
+            role_set (frozenset): Role names of the user.
+
+        Returns:
+            User instance.
+        """
+        user = cls(**columns)
+        make_transient_to_detached(user)
+
+        # Reuse the instance if already in the session
+        user = db.session.merge(user, load=False)
+        user._role_set = role_set
+
+        return user
 
     @classmethod
     def get_by_username(self, username):
@@ -433,7 +711,198 @@ class User(BaseModel, UserMixin):
         return User.query.filter_by(username=username).first()
 
 
+# Internal models
+class CacheVersion(db.Model):
+    """Version stamps used to invalidate in-process caches.
+
+    Each worker process compares the stamp with the version its cache was
+    built from, so that changes made by other processes are noticed.
+
+    Attributes:
+        name (str): Unique name of the cache.
+        version (int): Current version, increased on every change.
+        changed_at (datetime): UTC datetime of the last change.
+    """
+    __tablename__ = 'cache_versions'
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def get_version(cls, name):
+        """Obtain the current version of a cache.
+
+        Args:
+            name (str): Unique name of the cache.
+
+        Returns:
+            Version number (0 if the cache has never been changed).
+        """
+        version = (
+            db.session.query(cls.version)
+            .filter(cls.name == name)
+        ).scalar()
+
+        return version or 0
+
+    @classmethod
+    def bump(cls, connection, name):
+        """Increase the version of a cache.
+
+        Meant to be called from ORM events, so that the new version is
+        committed in the same transaction as the change itself.
+
+        Args:
+            connection: Connection of the current flush.
+            name (str): Unique name of the cache.
+        """
+        table = cls.__table__
+        now = datetime.datetime.utcnow()
+
+        result = connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .values(version=table.c.version + 1, changed_at=now)
+        )
+
+        if not result.rowcount:
+            connection.execute(
+                table.insert().values(name=name, version=1, changed_at=now)
+            )
+
+
+def hash_content(content):
+    """Obtain the hash used to detect changes in markdown content.
+
+    Args:
+        content (str): Content to hash.
+
+    Returns:
+        SHA-256 hex digest of the content.
+    """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def summarize(content):
+    """Obtain the summary of a post.
+
+    Args:
+        content (str): Markdown content of the post.
+
+    Returns:
+        Content up to the first summary break marker.
+    """
+    return content.split(SUMMARY_BREAK)[0].strip()
+
+
 # Events
+@event.listens_for(Page, 'before_insert')
+@event.listens_for(Page, 'before_update')
+@event.listens_for(Post, 'before_insert')
+@event.listens_for(Post, 'before_update')
+def before_content_save(mapper, connection, instance):
+    """Render the markdown content of a page or post if it changed."""
+    instance.render_content()
+
+
+@event.listens_for(Post, 'after_insert')
+@event.listens_for(Post, 'after_update')
+@event.listens_for(Post, 'after_delete')
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def after_feed_change(mapper, connection, instance):
+    """Invalidate cached feeds when posts or their authors change.
+
+    The version stamp of the feed is part of its validators, so that
+    changes which do not alter the dates of the posts are noticed.
+    """
+    CacheVersion.bump(connection, FEED_VERSION)
+    feed_cache.clear()
+
+
+@event.listens_for(Page, 'after_insert')
+@event.listens_for(Page, 'after_delete')
+def after_page_change(mapper, connection, instance):
+    """Invalidate the page route table in all the worker processes.
+
+    The version is bumped in the same transaction as the change. The table
+    of this process is invalidated once the change is committed (see
+    `after_commit()`), so that it is not rebuilt from uncommitted data.
+    """
+    CacheVersion.bump(connection, page_routes.VERSION_NAME)
+    object_session(instance).info['page_routes_changed'] = True
+
+
+@event.listens_for(Page, 'after_update')
+def after_page_update(mapper, connection, instance):
+    """Invalidate the page route table if routing attributes changed."""
+    state = db.inspect(instance)
+
+    for attr in ('route', 'is_published', 'ghosted_id'):
+        if getattr(state.attrs, attr).history.has_changes():
+            after_page_change(mapper, connection, instance)
+            break
+
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    """Invalidate in-process caches after committing their changes."""
+    if session.info.pop('page_routes_changed', False):
+        page_routes.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def after_rollback(session):
+    """Discard pending invalidations of a transaction rolled back."""
+    session.info.pop('page_routes_changed', None)
+
+
+@event.listens_for(Page, 'after_insert')
+@event.listens_for(Post, 'after_insert')
+def after_content_insert(mapper, connection, instance):
+    """Add a new page or post to the search index."""
+    search_index.update(connection, instance)
+
+
+@event.listens_for(Page, 'after_update')
+@event.listens_for(Post, 'after_update')
+def after_content_update(mapper, connection, instance):
+    """Update the search index if searchable attributes changed."""
+    state = db.inspect(instance)
+
+    for attr in ('title', 'content', 'is_published', 'ghosted_id'):
+        if getattr(state.attrs, attr).history.has_changes():
+            search_index.update(connection, instance)
+            break
+
+
+@event.listens_for(Page, 'after_delete')
+@event.listens_for(Post, 'after_delete')
+def after_content_delete(mapper, connection, instance):
+    """Remove a deleted page or post from the search index."""
+    search_index.remove(connection, instance.SEARCH_KIND, instance.id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def after_user_change(mapper, connection, instance):
+    """Invalidate the cached identity of a user."""
+    identity_cache.delete(str(instance.id))
+
+
+@event.listens_for(User.roles, 'append')
+@event.listens_for(User.roles, 'remove')
+@event.listens_for(User.roles, 'set')
+def on_user_roles_change(target, value, *args):
+    """Invalidate the cached roles of a user."""
+    target._role_set = None
+
+    if target.id is not None:
+        identity_cache.delete(str(target.id))
+
+
 @event.listens_for(Post, 'before_insert')
 def before_post_insert(mapper, connection, post):
     """Perform actions before a post is first created.
@@ -0,0 +1,712 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the full-text search index of posts and pages.
+
+Only published posts and pages which are not ghosts are indexed. The index
+is kept up to date from ORM events (see `akamatsu.models`) and can be
+rebuilt with `flask search reindex`.
+
+The backend depends on the database engine:
+
+- SQLite: `search_index` FTS5 virtual table, ranked with BM25.
+- PostgreSQL: `search_index` table with a weighted `tsvector` column
+    indexed with GIN, ranked with `ts_rank`.
+- Other engines (or if the table does not exist): in-process inverted
+    index, ranked with BM25.
+"""
+
+from collections import Counter, namedtuple
+import math
+import re
+import threading
+import time
+
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, text
+
+
+# Name of the table of the index
+TABLE_NAME = 'search_index'
+
+# Markers surrounding matched terms in snippets (replaced after escaping)
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+# Maximum number of terms taken from a query
+_MAX_TERMS = 10
+
+# Number of words in snippets
+_SNIPPET_WORDS = 24
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+SearchHit = namedtuple('SearchHit', ['kind', 'item_id', 'rank', 'snippet'])
+
+
+class SearchIndex(object):
+    """Full-text search index of posts and pages.
+
+    The index expects the following configuration parameters:
+
+    - `SEARCH_BACKEND`: `'fts5'`, `'postgresql'` or `'memory'`. If not set,
+        the backend is chosen from the database engine.
+    - `SEARCH_LANGUAGE`: Text search configuration used by PostgreSQL
+        (defaults to `'english'`). Run `flask search reindex` after changing
+        it.
+    - `SEARCH_CHECK_INTERVAL`: Seconds between checks for changes made by
+        other processes when using the in-process index (defaults to 5).
+    """
+
+    VERSION_NAME = 'search'
+
+    def __init__(self):
+        self._backend = None
+        self._backend_name = None
+        self._language = 'english'
+        self._check_interval = 5
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Setup the index.
+
+        Args:
+            app: Application instance.
+
+        Raises:
+            `ValueError` if the backend is not valid.
+        """
+        self._backend_name = app.config.get('SEARCH_BACKEND')
+        self._language = app.config.get('SEARCH_LANGUAGE', 'english')
+        self._check_interval = app.config.get('SEARCH_CHECK_INTERVAL', 5)
+        self._backend = None
+
+        if self._backend_name and self._backend_name not in _BACKENDS:
+            raise ValueError('Invalid search backend: {}'.format(self._backend_name))
+
+    def search(self, connection, query, page=1, per_page=10):
+        """Search published posts and pages.
+
+        All the terms of the query must match. The last term also matches
+        words it is a prefix of.
+
+        Args:
+            connection: Database connection.
+            query (str): Text to search for.
+            page (int): Page of results to obtain (starting at 1).
+            per_page (int): Number of results per page.
+
+        Returns:
+            Tuple with a list of `SearchHit` instances (best first) and a flag
+            indicating whether there are more results. Snippets are `Markup`
+            instances with matched terms inside `<mark>` elements.
+        """
+        terms = tokenize(query)[:_MAX_TERMS]
+
+        if not terms:
+            return [], False
+
+        rows = self._get_backend(connection).search(
+            connection,
+            terms,
+            per_page + 1,
+            (max(page, 1) - 1) * per_page
+        )
+
+        hits = [
+            SearchHit(kind, item_id, rank, _highlight(snippet))
+            for kind, item_id, rank, snippet in rows[:per_page]
+        ]
+
+        return hits, len(rows) > per_page
+
+    def update(self, connection, instance):
+        """Index a post or page, or remove it if no longer searchable.
+
+        Args:
+            connection: Database connection.
+            instance: `Post` or `Page` instance.
+        """
+        backend = self._get_backend(connection)
+
+        if instance.is_published and instance.ghosted_id is None:
+            backend.upsert(
+                connection,
+                instance.SEARCH_KIND,
+                instance.id,
+                instance.title,
+                _indexable(instance.content)
+            )
+
+        else:
+            backend.delete(connection, instance.SEARCH_KIND, instance.id)
+
+    def remove(self, connection, kind, item_id):
+        """Remove a post or page from the index.
+
+        Args:
+            connection: Database connection.
+            kind (str): `'post'` or `'page'`.
+            item_id (int): ID of the post or page.
+        """
+        self._get_backend(connection).delete(connection, kind, item_id)
+
+    def rebuild(self, connection):
+        """Rebuild the whole index.
+
+        Args:
+            connection: Database connection.
+
+        Returns:
+            Number of indexed documents.
+        """
+        return self._get_backend(connection).rebuild(connection)
+
+    @property
+    def backend_name(self):
+        """Name of the backend in use (`None` until first used)."""
+        if self._backend is None:
+            return None
+
+        return self._backend.name
+
+    def _get_backend(self, connection):
+        """Obtain the backend, choosing it on first use.
+
+        Args:
+            connection: Database connection.
+
+        Returns:
+            Backend instance.
+        """
+        if self._backend is not None:
+            return self._backend
+
+        with self._lock:
+            if self._backend is None:
+                name = self._backend_name
+
+                if not name:
+                    dialect = connection.dialect.name
+                    has_table = connection.dialect.has_table(connection, TABLE_NAME)
+
+                    if dialect == 'sqlite' and has_table:
+                        name = 'fts5'
+
+                    elif dialect == 'postgresql' and has_table:
+                        name = 'postgresql'
+
+                    else:
+                        name = 'memory'
+
+                self._backend = _BACKENDS[name](self)
+
+        return self._backend
+
+
+class FTS5Backend(object):
+    """Search backend using a SQLite FTS5 virtual table.
+
+    The rowid of each document is derived from its kind and ID, so that
+    updates do not need to scan the table.
+    """
+
+    name = 'fts5'
+
+    _KINDS = {'post': 0, 'page': 1}
+
+    def __init__(self, index):
+        self.index = index
+
+    def upsert(self, connection, kind, item_id, title, content):
+        self.delete(connection, kind, item_id)
+
+        connection.execute(
+            text(
+                'INSERT INTO search_index (rowid, kind, item_id, title, content) '
+                'VALUES (:rowid, :kind, :item_id, :title, :content)'
+            ),
+            {
+                'rowid': self._rowid(kind, item_id),
+                'kind': kind,
+                'item_id': item_id,
+                'title': title,
+                'content': content
+            }
+        )
+
+    def delete(self, connection, kind, item_id):
+        connection.execute(
+            text('DELETE FROM search_index WHERE rowid = :rowid'),
+            {'rowid': self._rowid(kind, item_id)}
+        )
+
+    def rebuild(self, connection):
+        connection.execute(text('DELETE FROM search_index'))
+
+        for kind, table in (('post', 'posts'), ('page', 'pages')):
+            connection.execute(text(
+                'INSERT INTO search_index (rowid, kind, item_id, title, content) '
+                'SELECT id * 2 + {offset}, \'{kind}\', id, title, '
+                'REPLACE(content, :summary_break, \'\') '
+                'FROM {table} WHERE is_published = 1 AND ghosted_id IS NULL'
+                .format(offset=self._KINDS[kind], kind=kind, table=table)
+            ), {'summary_break': _summary_break()})
+
+        return connection.execute(text('SELECT COUNT(*) FROM search_index')).scalar()
+
+    def search(self, connection, terms, limit, offset):
+        # Terms are quoted so that they are not parsed as FTS5 operators
+        match = ' '.join('"{}"'.format(term) for term in terms) + '*'
+
+        # Columns: kind, item_id, title (weighted) and content
+        return connection.execute(
+            text(
+                'SELECT kind, item_id, -bm25(search_index, 0.0, 0.0, 10.0, 1.0) AS rank, '
+                'snippet(search_index, 3, :start, :end, \'…\', :words) '
+                'FROM search_index WHERE search_index MATCH :match '
+                'ORDER BY rank DESC LIMIT :limit OFFSET :offset'
+            ),
+            {
+                'start': _MARK_START,
+                'end': _MARK_END,
+                'words': _SNIPPET_WORDS,
+                'match': match,
+                'limit': limit,
+                'offset': offset
+            }
+        ).fetchall()
+
+    def _rowid(self, kind, item_id):
+        return item_id * 2 + self._KINDS[kind]
+
+
+class PostgresBackend(object):
+    """Search backend using a PostgreSQL `tsvector` column (GIN indexed).
+
+    Titles are weighted above the content when ranking.
+    """
+
+    name = 'postgresql'
+
+    # Computes the document of a row
+    _DOCUMENT = (
+        "setweight(to_tsvector(CAST(:language AS regconfig), coalesce({title}, '')), 'A') || "
+        "setweight(to_tsvector(CAST(:language AS regconfig), coalesce({content}, '')), 'B')"
+    )
+
+    def __init__(self, index):
+        self.index = index
+
+    def upsert(self, connection, kind, item_id, title, content):
+        connection.execute(
+            text(
+                'INSERT INTO search_index (kind, item_id, title, content, document) '
+                'VALUES (:kind, :item_id, :title, :content, {document}) '
+                'ON CONFLICT (kind, item_id) DO UPDATE SET '
+                'title = excluded.title, content = excluded.content, '
+                'document = excluded.document'
+                .format(document=self._DOCUMENT.format(title=':title', content=':content'))
+            ),
+            {
+                'kind': kind,
+                'item_id': item_id,
+                'title': title,
+                'content': content,
+                'language': self.index._language
+            }
+        )
+
+    def delete(self, connection, kind, item_id):
+        connection.execute(
+            text('DELETE FROM search_index WHERE kind = :kind AND item_id = :item_id'),
+            {'kind': kind, 'item_id': item_id}
+        )
+
+    def rebuild(self, connection):
+        connection.execute(text('DELETE FROM search_index'))
+
+        for kind, table in (('post', 'posts'), ('page', 'pages')):
+            content = "replace(content, :summary_break, '')"
+
+            connection.execute(
+                text(
+                    'INSERT INTO search_index (kind, item_id, title, content, document) '
+                    'SELECT \'{kind}\', id, title, {content}, {document} '
+                    'FROM {table} WHERE is_published AND ghosted_id IS NULL'
+                    .format(
+                        kind=kind,
+                        content=content,
+                        document=self._DOCUMENT.format(title='title', content=content),
+                        table=table
+                    )
+                ),
+                {
+                    'summary_break': _summary_break(),
+                    'language': self.index._language
+                }
+            )
+
+        return connection.execute(text('SELECT COUNT(*) FROM search_index')).scalar()
+
+    def search(self, connection, terms, limit, offset):
+        # Terms only contain word characters, so they are safe in a tsquery
+        tsquery = ' & '.join(terms) + ':*'
+
+        return connection.execute(
+            text(
+                'SELECT kind, item_id, ts_rank(document, query) AS rank, '
+                'ts_headline(CAST(:language AS regconfig), content, query, :options) '
+                'FROM search_index, to_tsquery(CAST(:language AS regconfig), :tsquery) query '
+                'WHERE document @@ query '
+                'ORDER BY rank DESC LIMIT :limit OFFSET :offset'
+            ),
+            {
+                'language': self.index._language,
+                'options': 'StartSel={}, StopSel={}, MaxWords={}, MinWords={}'.format(
+                    _MARK_START,
+                    _MARK_END,
+                    _SNIPPET_WORDS,
+                    _SNIPPET_WORDS // 2
+                ),
+                'tsquery': tsquery,
+                'limit': limit,
+                'offset': offset
+            }
+        ).fetchall()
+
+
+class MemoryBackend(object):
+    """In-process inverted index, ranked with BM25.
+
+    The index is built on first use and updated whenever the `'search'`
+    version stamp (see `akamatsu.models.CacheVersion`) changes, which is
+    bumped on every change to the indexed documents. The stamp is checked
+    at most once every `SEARCH_CHECK_INTERVAL` seconds.
+
+    Updates only read and tokenize the documents whose title or content
+    hash changed, so that every process (including the one making the
+    change) catches up without indexing all the documents again.
+    """
+
+    name = 'memory'
+
+    # BM25 parameters
+    _K1 = 1.2
+    _B = 0.75
+
+    # Each occurrence of a term in the title counts as this many
+    _TITLE_WEIGHT = 5
+
+    def __init__(self, index):
+        self.index = index
+
+        self._documents = None
+        self._postings = None
+        self._total_length = 0
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def upsert(self, connection, kind, item_id, title, content):
+        self._changed(connection)
+
+    def delete(self, connection, kind, item_id):
+        self._changed(connection)
+
+    def rebuild(self, connection):
+        with self._lock:
+            self._documents = {}
+            self._postings = {}
+            self._total_length = 0
+            self._sync(connection)
+            self._version = None
+
+        return len(self._documents)
+
+    def search(self, connection, terms, limit, offset):
+        self._refresh(connection)
+
+        with self._lock:
+            return self._search(terms, limit, offset)
+
+    def _search(self, terms, limit, offset):
+        documents = self._documents
+        postings = self._postings
+        average_length = (
+            self._total_length / len(documents) if documents else 1
+        ) or 1
+
+        # Last term matches as a prefix
+        matches = [postings.get(term, {}) for term in terms[:-1]]
+        prefix = terms[-1]
+        last = {}
+
+        for term, docs in postings.items():
+            if term.startswith(prefix):
+                for key, frequency in docs.items():
+                    last[key] = last.get(key, 0) + frequency
+
+        matches.append(last)
+
+        candidates = set(min(matches, key=len))
+
+        for docs in matches:
+            candidates.intersection_update(docs)
+
+        scores = []
+
+        for key in candidates:
+            length = documents[key].length
+            score = 0
+
+            for docs in matches:
+                frequency = docs[key]
+                idf = math.log(1 + (len(documents) - len(docs) + 0.5) / (len(docs) + 0.5))
+                score += idf * frequency * (self._K1 + 1) / (
+                    frequency + self._K1 * (
+                        1 - self._B + self._B * length / average_length
+                    )
+                )
+
+            scores.append((score, key))
+
+        scores.sort(key=lambda item: (-item[0], item[1]))
+
+        return [
+            (kind, item_id, score, _snippet(documents[(kind, item_id)].content, terms))
+            for score, (kind, item_id) in scores[offset:offset + limit]
+        ]
+
+    def _changed(self, connection):
+        """Mark the index as outdated in all the processes."""
+        from akamatsu.models import CacheVersion
+
+        CacheVersion.bump(connection, self.index.VERSION_NAME)
+        self._checked_at = 0
+
+    def _refresh(self, connection):
+        """Update the index if it is outdated."""
+        if not self._needs_check():
+            return
+
+        from akamatsu.models import CacheVersion
+
+        with self._lock:
+            if not self._needs_check():
+                return
+
+            # Read the version first: a change made while updating is then
+            # noticed on next check
+            version = CacheVersion.get_version(self.index.VERSION_NAME)
+
+            if self._documents is None:
+                self._documents = {}
+                self._postings = {}
+                self._total_length = 0
+                self._sync(connection)
+
+            elif version != self._version:
+                self._sync(connection)
+
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    def _needs_check(self):
+        return (
+            self._documents is None
+            or time.monotonic() - self._checked_at >= self.index._check_interval
+        )
+
+    def _sync(self, connection):
+        """Bring the index up to date with the database.
+
+        Documents are compared by title and content hash, and only the
+        ones that changed are read in full.
+        """
+        current = {}
+
+        for kind, table in (('post', 'posts'), ('page', 'pages')):
+            rows = connection.execute(text(
+                'SELECT id, title, content_hash FROM {} '
+                'WHERE is_published = :published AND ghosted_id IS NULL'
+                .format(table)
+            ), {'published': True})
+
+            for item_id, title, content_hash in rows:
+                current[(kind, item_id)] = (title, content_hash)
+
+        for key in set(self._documents) - set(current):
+            self._remove(key)
+
+        changed = [
+            key for key, (title, content_hash) in current.items()
+            if key not in self._documents
+            or self._documents[key].title != title
+            or self._documents[key].content_hash != content_hash
+        ]
+
+        for kind, table in (('post', 'posts'), ('page', 'pages')):
+            ids = [item_id for key_kind, item_id in changed if key_kind == kind]
+
+            for start in range(0, len(ids), 500):
+                rows = connection.execute(
+                    text(
+                        'SELECT id, title, content, content_hash FROM {} '
+                        'WHERE id IN :ids'.format(table)
+                    ).bindparams(bindparam('ids', expanding=True)),
+                    {'ids': ids[start:start + 500]}
+                )
+
+                for item_id, title, content, content_hash in rows:
+                    self._remove((kind, item_id))
+                    self._add((kind, item_id), title, content, content_hash)
+
+    def _add(self, key, title, content, content_hash):
+        """Add a document to the index."""
+        content = _indexable(content)
+        frequencies = self._frequencies(title, content)
+        length = sum(frequencies.values())
+
+        self._documents[key] = _Document(title, content, length, content_hash)
+        self._total_length += length
+
+        for term, frequency in frequencies.items():
+            self._postings.setdefault(term, {})[key] = frequency
+
+    def _remove(self, key):
+        """Remove a document from the index (if present)."""
+        document = self._documents.pop(key, None)
+
+        if document is None:
+            return
+
+        self._total_length -= document.length
+
+        for term in self._frequencies(document.title, document.content):
+            docs = self._postings[term]
+            docs.pop(key, None)
+
+            if not docs:
+                del self._postings[term]
+
+    def _frequencies(self, title, content):
+        """Obtain the weighted frequencies of the terms of a document."""
+        frequencies = Counter(tokenize(content))
+
+        for term, count in Counter(tokenize(title)).items():
+            frequencies[term] += count * self._TITLE_WEIGHT
+
+        return frequencies
+
+
+# Indexed document of `MemoryBackend`
+_Document = namedtuple('_Document', ['title', 'content', 'length', 'content_hash'])
+
+
+_BACKENDS = {
+    'fts5': FTS5Backend,
+    'postgresql': PostgresBackend,
+    'memory': MemoryBackend
+}
+
+
+def tokenize(value):
+    """Split text into lowercase terms.
+
+    Args:
+        value (str): Text to split.
+
+    Returns:
+        List of terms.
+    """
+    return _WORD_RE.findall((value or '').lower())
+
+
+def _indexable(content):
+    """Obtain the text of a post or page to index."""
+    return (content or '').replace(_summary_break(), '')
+
+
+def _summary_break():
+    from akamatsu.models import SUMMARY_BREAK
+
+    return SUMMARY_BREAK
+
+
+def _snippet(content, terms):
+    """Obtain a snippet of the content around the first matched term.
+
+    Args:
+        content (str): Content of the document.
+        terms (list): Terms of the query (the last one is a prefix).
+
+    Returns:
+        Snippet with matched terms surrounded by markers.
+    """
+    words = content.split()
+    prefix = terms[-1]
+    exact = set(terms[:-1])
+
+    def _matches(word):
+        for term in tokenize(word):
+            if term in exact or term.startswith(prefix):
+                return True
+
+        return False
+
+    first = next((i for i, word in enumerate(words) if _matches(word)), 0)
+    start = max(0, first - _SNIPPET_WORDS // 4)
+    end = start + _SNIPPET_WORDS
+
+    snippet = ' '.join(
+        '{}{}{}'.format(_MARK_START, word, _MARK_END) if _matches(word) else word
+        for word in words[start:end]
+    )
+
+    return '{}{}{}'.format(
+        '… ' if start > 0 else '',
+        snippet,
+        ' …' if end < len(words) else ''
+    )
+
+
+def _highlight(snippet):
+    """Escape a snippet and replace its markers with `<mark>` elements.
+
+    Args:
+        snippet (str): Snippet with markers.
+
+    Returns:
+        `Markup` instance.
+    """
+    return Markup(
+        str(escape(snippet or ''))
+        .replace(_MARK_START, '<mark>')
+        .replace(_MARK_END, '</mark>')
+    )
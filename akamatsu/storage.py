@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""This file contains the storage of uploaded files.
+
+Uploaded files are stored in a content-addressed blob store inside the
+uploads directory: `_blobs/<first 2 characters of hash>/<hash>`, where the
+hash is the SHA-256 of the contents. `FileUpload.path` is only the logical
+path of the file, so several uploads with the same contents share a single
+blob.
+
+Files uploaded before the blob store existed are still stored at their
+logical path until migrated with `files dedupe`.
+
+Large files can be uploaded in chunks (see `PartialUpload`). Partial
+uploads are kept in `_partial` until complete.
+
+Blobs are shared, so storing and discarding them is serialized with a lock
+(see `_blob_lock()`). New contents are staged in a temporary file which is
+kept until the upload record is committed, so that a blob discarded in the
+meantime by the deletion of another upload with the same contents can be
+stored again.
+"""
+
+from contextlib import contextmanager
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Not available in Windows
+    fcntl = None
+
+from flask import current_app
+from werkzeug.security import safe_join
+
+from akamatsu import db
+from akamatsu.models import FileUpload
+
+
+# Directory of the blob store, relative to the uploads directory
+BLOBS_DIR = '_blobs'
+
+# Directory of partial uploads, relative to the uploads directory
+PARTIAL_DIR = '_partial'
+
+# Directory of image variants, relative to the uploads directory
+VARIANTS_DIR = '_variants'
+
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def uploads_root():
+    """Obtain the absolute path of the uploads directory."""
+    return os.path.abspath(current_app.config['UPLOADS_PATH'])
+
+
+def blob_path(content_hash):
+    """Obtain the absolute path of a blob.
+
+    Args:
+        content_hash (str): SHA-256 hex digest of the contents.
+
+    Returns:
+        Absolute path (the blob may not exist).
+    """
+    return os.path.join(
+        uploads_root(),
+        BLOBS_DIR,
+        content_hash[:2],
+        content_hash
+    )
+
+
+def save_blob(stream, chunk_size=65536):
+    """Store the contents of a stream in the blob store.
+
+    The contents are hashed while they are written to a temporary file, so
+    the stream is only read once.
+
+    Args:
+        stream: Binary file object (e.g. upload stream).
+        chunk_size (int): Number of bytes to read at a time.
+
+    Returns:
+        Tuple with the hash of the contents and a flag indicating whether a
+        new blob was created (`False` if the contents were already stored).
+    """
+    content_hash, tmp_path = stage_blob(stream, chunk_size)
+
+    return content_hash, store_file(tmp_path, content_hash)
+
+
+def stage_blob(stream, chunk_size=65536):
+    """Write the contents of a stream to a temporary file, hashing them.
+
+    Args:
+        stream: Binary file object (e.g. upload stream).
+        chunk_size (int): Number of bytes to read at a time.
+
+    Returns:
+        Tuple with the hash of the contents and the path of the temporary
+        file (see `store_file()` and `discard_staged()`).
+    """
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=_tmp_dir())
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                digest.update(chunk)
+                f.write(chunk)
+
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    return digest.hexdigest(), tmp_path
+
+
+def store_file(path, content_hash, keep=False):
+    """Move a file into the blob store.
+
+    If the blob already exists, the file is removed instead.
+
+    Args:
+        path (str): Path of the file to move.
+        content_hash (str): SHA-256 hex digest of the contents of the file.
+        keep (bool): Keep the file, linking it into the blob store instead
+            of moving it. Used to store staged contents before committing
+            the upload record and again after it (see `stage_blob()`).
+
+    Returns:
+        `True` if a new blob was created, otherwise `False`.
+    """
+    dst_path = blob_path(content_hash)
+
+    with _blob_lock():
+        if os.path.isfile(dst_path):
+            if not keep:
+                os.unlink(path)
+
+            return False
+
+        dst_dir = os.path.dirname(dst_path)
+
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir, 0o755, exist_ok=True)
+
+        os.chmod(path, 0o644)
+
+        if keep:
+            os.link(path, dst_path)
+
+        else:
+            os.replace(path, dst_path)
+
+    return True
+
+
+def discard_staged(path):
+    """Remove a staged file if it was not moved into the blob store.
+
+    Args:
+        path (str): Path of the staged file.
+    """
+    try:
+        os.unlink(path)
+
+    except FileNotFoundError:
+        pass
+
+
+def resolve_upload(fupload):
+    """Obtain the absolute path of the contents of an upload.
+
+    Args:
+        fupload (FileUpload): Upload to resolve.
+
+    Returns:
+        Absolute path of the blob (or of the legacy file if it has not been
+        migrated yet) or `None` if the file does not exist.
+    """
+    if fupload.content_hash:
+        path = blob_path(fupload.content_hash)
+
+        if os.path.isfile(path):
+            return path
+
+    path = legacy_path(fupload)
+
+    if path is None or not os.path.isfile(path):
+        return None
+
+    return path
+
+
+def legacy_path(fupload):
+    """Obtain the path in which an upload was stored before the blob store.
+
+    Args:
+        fupload (FileUpload): Upload to resolve.
+
+    Returns:
+        Absolute path or `None` if the logical path is not safe.
+    """
+    return safe_join(uploads_root(), fupload.path)
+
+
+def release_upload(fupload):
+    """Remove the files of a deleted upload.
+
+    The blob is only removed when no other upload references it.
+
+    Args:
+        fupload (FileUpload): Upload that has been deleted from the database.
+
+    Raises:
+        `OSError` if a file could not be removed.
+    """
+    path = legacy_path(fupload)
+
+    if path is not None and os.path.isfile(path):
+        os.unlink(path)
+
+    if fupload.content_hash:
+        discard_blob(fupload.content_hash)
+
+
+def discard_blob(content_hash):
+    """Remove a blob (and its image variants) if no upload references it.
+
+    Args:
+        content_hash (str): SHA-256 hex digest of the contents.
+
+    The check and the removal are done while holding the blob store lock,
+    so that the blob is not removed while being stored for a new upload.
+
+    Raises:
+        `OSError` if the blob could not be removed.
+    """
+    with _blob_lock():
+        in_use = (
+            db.session.query(FileUpload.id)
+            .filter(FileUpload.content_hash == content_hash)
+        ).first()
+
+        if in_use:
+            return
+
+        path = blob_path(content_hash)
+
+        if os.path.isfile(path):
+            os.unlink(path)
+
+        variants_dir = os.path.join(uploads_root(), VARIANTS_DIR, content_hash)
+
+        if os.path.isdir(variants_dir):
+            shutil.rmtree(variants_dir)
+
+
+class PartialUpload(object):
+    """Upload received in chunks.
+
+    Chunks are appended to a data file as they are streamed, and the
+    contents are hashed incrementally. Metadata is stored next to the data
+    file in JSON format, so the upload can be resumed from any worker
+    process: the current offset is the size of the data file.
+
+    Hash states cannot be shared between processes. If a chunk is received
+    by a process that did not receive the previous one, the data received
+    so far is hashed again before appending.
+
+    Args:
+        upload_id (str): Unique ID of the upload.
+        meta (dict): Metadata of the upload (`path`, `size`, `mime`,
+            `description`, `user_id` and `created_at`).
+    """
+
+    # Hash states of the uploads received by this process
+    _hashes = {}
+    _hashes_lock = threading.Lock()
+
+    def __init__(self, upload_id, meta):
+        self.id = upload_id
+        self.meta = meta
+
+    @property
+    def path(self):
+        """Logical path of the upload."""
+        return self.meta['path']
+
+    @property
+    def size(self):
+        """Total size of the upload in bytes."""
+        return self.meta['size']
+
+    @property
+    def offset(self):
+        """Number of bytes received so far."""
+        try:
+            return os.path.getsize(self._data_path)
+
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def is_complete(self):
+        return self.offset >= self.size
+
+    @property
+    def created_at(self):
+        """UTC datetime in which the upload was started."""
+        return datetime.datetime.strptime(
+            self.meta['created_at'],
+            '%Y-%m-%d %H:%M:%S'
+        )
+
+    @property
+    def _data_path(self):
+        return os.path.join(_partial_dir(), self.id)
+
+    @property
+    def _meta_path(self):
+        return os.path.join(_partial_dir(), self.id + '.json')
+
+    @classmethod
+    def create(cls, path, size, mime=None, description=None, user_id=None):
+        """Start a new partial upload.
+
+        Args:
+            path (str): Logical path of the upload.
+            size (int): Total size of the upload in bytes.
+            mime (str): MIME type of the file.
+            description (str): Optional description of the file.
+            user_id (int): ID of the user uploading the file.
+
+        Returns:
+            `PartialUpload` instance.
+        """
+        upload = cls(
+            uuid.uuid4().hex,
+            {
+                'path': path,
+                'size': size,
+                'mime': mime,
+                'description': description,
+                'user_id': user_id,
+                'created_at': (
+                    datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                )
+            }
+        )
+
+        # Metadata is written atomically
+        fd, tmp_path = tempfile.mkstemp(dir=_partial_dir())
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(upload.meta, f)
+
+        open(upload._data_path, 'wb').close()
+        os.replace(tmp_path, upload._meta_path)
+
+        return upload
+
+    @classmethod
+    def get(cls, upload_id):
+        """Obtain an existing partial upload.
+
+        Args:
+            upload_id (str): Unique ID of the upload.
+
+        Returns:
+            `PartialUpload` instance or `None` if not found.
+        """
+        if not _UPLOAD_ID_RE.match(upload_id or ''):
+            return None
+
+        try:
+            with open(os.path.join(_partial_dir(), upload_id + '.json')) as f:
+                return cls(upload_id, json.load(f))
+
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def all(cls):
+        """Obtain all the partial uploads.
+
+        Returns:
+            List of `PartialUpload` instances.
+        """
+        uploads = []
+
+        for name in os.listdir(_partial_dir()):
+            if name.endswith('.json'):
+                upload = cls.get(name[:-5])
+
+                if upload is not None:
+                    uploads.append(upload)
+
+        return uploads
+
+    def append(self, stream, offset, chunk_size=65536):
+        """Append a chunk to the upload.
+
+        Args:
+            stream: Binary stream with the contents of the chunk.
+            offset (int): Position of the chunk in the file. Must be equal
+                to the number of bytes received so far.
+            chunk_size (int): Number of bytes to read at a time.
+
+        Returns:
+            Number of bytes received after appending the chunk.
+
+        Raises:
+            `ValueError` if the offset is not the current one or the chunk
+            exceeds the declared size of the upload, `FileNotFoundError` if
+            the upload was discarded or finalized.
+        """
+        with open(self._data_path, 'r+b') as f:
+            if fcntl is not None:
+                # Concurrent requests for the same upload
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+            if not _is_linked(f, self._data_path):
+                # Removed while waiting for the lock
+                raise FileNotFoundError('Upload is no longer available')
+
+            f.seek(0, os.SEEK_END)
+
+            if f.tell() != offset:
+                raise ValueError('Invalid offset, expected {}'.format(f.tell()))
+
+            digest = self._get_hash(offset)
+            written = offset
+
+            try:
+                for chunk in iter(lambda: stream.read(chunk_size), b''):
+                    if written + len(chunk) > self.size:
+                        raise ValueError('Chunk exceeds the size of the upload')
+
+                    f.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+
+            except Exception:
+                # Discard the incomplete chunk
+                f.truncate(offset)
+                raise
+
+            f.flush()
+
+            with self._hashes_lock:
+                self._hashes[self.id] = (written, digest)
+
+        return written
+
+    def finalize(self):
+        """Store the contents of a complete upload in the blob store.
+
+        The data file is moved out of the partial uploads while locked, so
+        an upload cannot be finalized twice. It is kept as a staged file
+        until the record of the upload is committed (see `stage_blob()`).
+
+        Returns:
+            Tuple with the hash of the contents, a flag indicating whether
+            a new blob was created and the path of the staged file.
+
+        Raises:
+            `ValueError` if the upload is not complete or was already
+            finalized or discarded.
+        """
+        try:
+            f = open(self._data_path, 'rb')
+
+        except FileNotFoundError:
+            raise ValueError('Upload is no longer available')
+
+        with f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+            if not _is_linked(f, self._data_path):
+                raise ValueError('Upload is no longer available')
+
+            if os.fstat(f.fileno()).st_size < self.size:
+                raise ValueError('Upload is not complete')
+
+            content_hash = self._get_hash(self.size).hexdigest()
+
+            fd, tmp_path = tempfile.mkstemp(dir=_tmp_dir())
+            os.close(fd)
+            os.replace(self._data_path, tmp_path)
+
+        self.discard()
+
+        try:
+            created = store_file(tmp_path, content_hash, keep=True)
+
+        except Exception:
+            discard_staged(tmp_path)
+            raise
+
+        return content_hash, created, tmp_path
+
+    def discard(self):
+        """Remove the files of the upload."""
+        with self._hashes_lock:
+            self._hashes.pop(self.id, None)
+
+        for path in (self._data_path, self._meta_path):
+            if os.path.isfile(path):
+                os.unlink(path)
+
+    def _get_hash(self, offset):
+        """Obtain the hash of the contents up to the given offset.
+
+        Reuses the hash state of this process when possible.
+        """
+        with self._hashes_lock:
+            state = self._hashes.pop(self.id, None)
+
+        if state is not None and state[0] == offset:
+            return state[1]
+
+        digest = hashlib.sha256()
+        remaining = offset
+
+        with open(self._data_path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(65536, remaining))
+
+                if not chunk:
+                    break
+
+                digest.update(chunk)
+                remaining -= len(chunk)
+
+        return digest
+
+
+def _is_linked(f, path):
+    """Check that an open file is still the one found in a path."""
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+
+    except FileNotFoundError:
+        return False
+
+
+def _partial_dir():
+    """Obtain the directory of partial uploads."""
+    path = os.path.join(uploads_root(), PARTIAL_DIR)
+
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o755, exist_ok=True)
+
+    return path
+
+
+# Serializes changes to the blob store between threads of this process
+_blob_thread_lock = threading.Lock()
+
+
+@contextmanager
+def _blob_lock():
+    """Serialize changes to the blob store between threads and processes.
+
+    Processes are synchronized with a lock file in the blob store (only
+    where `fcntl` is available).
+    """
+    with _blob_thread_lock:
+        if fcntl is None:
+            yield
+            return
+
+        lock_dir = os.path.join(uploads_root(), BLOBS_DIR)
+        os.makedirs(lock_dir, 0o755, exist_ok=True)
+
+        with open(os.path.join(lock_dir, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            try:
+                yield
+
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _tmp_dir():
+    """Obtain the directory for files being written to the blob store.
+
+    Located in the same file system as the blobs, so that they can be
+    moved atomically.
+    """
+    path = os.path.join(uploads_root(), BLOBS_DIR, 'tmp')
+
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o755, exist_ok=True)
+
+    return path
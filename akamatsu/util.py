@@ -27,9 +27,18 @@
 
 """This file contains utility code."""
 
-from functools import wraps
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, wraps
 from urllib.parse import urlparse, urljoin
 
+import datetime
+import hashlib
+import multiprocessing
+import threading
+import time
+
 import misaka
 import pytz
 
@@ -37,9 +46,86 @@ from flask import current_app, flash, redirect, request, url_for
 from flask_babel import _
 from flask_login import current_user
 from flask_mail import Message
+from flask_misaka import Misaka
 from pygments import highlight
 from pygments.formatters.html import HtmlFormatter
 from pygments.lexers import get_lexer_by_name
+from sqlalchemy import and_, or_
+from werkzeug.exceptions import ServiceUnavailable
+
+
+# Reference date for encoding pagination cursors
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class CachedMisaka(Misaka):
+    """Flask-Misaka extension with a cache for rendered markdown.
+
+    Rendered results are cached in-process, keyed by a hash of the markdown
+    text and the rendering options.
+
+    The extension expects the following configuration parameters:
+
+    - `MARKDOWN_CACHE_SIZE`: Maximum number of rendered results to keep in
+        the cache (defaults to 512). Set to 0 to disable the cache.
+
+    Attributes:
+        on_render: Optional function called with the seconds spent in each
+            call to `render()` (used for instrumentation).
+    """
+
+    def __init__(self, app=None, renderer=None, **defaults):
+        self.cache = LRUCache(512)
+        self.on_render = None
+
+        super(CachedMisaka, self).__init__(app, renderer, **defaults)
+
+    def init_app(self, app):
+        """Register the template filter and size the cache.
+
+        Args:
+            app: Application instance.
+        """
+        self.cache.maxsize = app.config.get('MARKDOWN_CACHE_SIZE', 512)
+
+        super(CachedMisaka, self).init_app(app)
+
+    def render(self, text, **overrides):
+        """Render markdown text, using the cache if possible.
+
+        Args:
+            text (str): Markdown text to render.
+            overrides: Options overriding the defaults.
+
+        Returns:
+            `Markup` instance with the rendered HTML.
+        """
+        if self.on_render is None:
+            return self._render(text, **overrides)
+
+        start = time.perf_counter()
+        result = self._render(text, **overrides)
+        self.on_render(time.perf_counter() - start)
+
+        return result
+
+    def _render(self, text, **overrides):
+        """Render markdown text, using the cache if possible."""
+        if not self.cache.maxsize:
+            return super(CachedMisaka, self).render(text, **overrides)
+
+        options = dict(self.defaults, **overrides)
+        digest = hashlib.sha256(text.encode('utf-8'))
+        digest.update(repr(sorted(options.items())).encode('utf-8'))
+
+        key = digest.hexdigest()
+        result = self.cache.get(key)
+
+        if result is None:
+            result = super(CachedMisaka, self).render(text, **overrides)
+            self.cache.set(key, result)
+
+        return result
 
 
 class CeleryWrapper(object):
@@ -116,10 +202,29 @@ class CryptoManager(object):
     <https://passlib.readthedocs.io/en/stable/lib/passlib.context.html#algorithm-options>).
     These are in the form `PASSLIB_ALG_<SCHEME>_<CONFIG>` and will be translated to the
     appropriate `<scheme>__<config>` configuration variable name internally.
+
+    Hashing and verification are CPU intensive, so they can be run in a pool
+    of worker processes rather than in the request thread:
+
+    - `PASSLIB_POOL_SIZE`: Number of worker processes. If not set (or 0),
+        operations are run in the calling thread.
+    - `PASSLIB_QUEUE_LIMIT`: Maximum number of operations waiting for a
+        free worker (defaults to 8). Operations over the limit are rejected
+        with a `503 Service Unavailable` error.
+    - `PASSLIB_TIMEOUT`: Seconds to wait for an operation to finish before
+        failing with a `503 Service Unavailable` error (defaults to 30).
     """
 
     def __init__(self):
         self._context = None
+        self._params = None
+        self._pool = None
+        self._pool_size = 0
+        self._queue_limit = 8
+        self._timeout = 30
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._stats = {}
 
     def __getattr__(self, attr):
         """Wrap the internal passlib context."""
@@ -129,6 +234,148 @@ class CryptoManager(object):
         # Calling hasher methods
         return getattr(self._context, attr)
 
+    def hash(self, secret):
+        """Hash a secret using the default scheme.
+
+        Args:
+            secret (str): Secret to hash.
+
+        Returns:
+            Hash string.
+
+        Raises:
+            `ServiceUnavailable` if the worker pool is overloaded.
+        """
+        return self._run('hash', _crypto_hash, secret)
+
+    def verify(self, secret, hash):
+        """Verify a secret against a hash.
+
+        Args:
+            secret (str): Secret to verify.
+            hash (str): Stored hash.
+
+        Returns:
+            `True` if the secret is correct.
+
+        Raises:
+            `ServiceUnavailable` if the worker pool is overloaded.
+        """
+        return self._run('verify', _crypto_verify, secret, hash)
+
+    def verify_and_update(self, secret, hash):
+        """Verify a secret and obtain a new hash if the stored one is outdated.
+
+        Hashes are outdated when using a deprecated scheme or algorithm
+        options below the configured minimum (e.g. `min_rounds`).
+
+        Args:
+            secret (str): Secret to verify.
+            hash (str): Stored hash.
+
+        Returns:
+            Tuple with a boolean indicating whether the secret is correct and
+            the new hash to store (`None` if no update is needed).
+
+        Raises:
+            `ServiceUnavailable` if the worker pool is overloaded.
+        """
+        return self._run(
+            'verify_and_update',
+            _crypto_verify_and_update,
+            secret,
+            hash
+        )
+
+    def stats(self):
+        """Obtain timing metrics of the operations.
+
+        Returns:
+            Dictionary with the `count`, `total` time and `max` time (in
+            seconds) of each operation, as well as the number of `rejected`
+            operations and operations currently `pending`.
+        """
+        with self._lock:
+            stats = {k: dict(v) for k, v in self._stats.items()}
+            stats['pending'] = self._pending
+
+        return stats
+
+    def _run(self, name, func, *args):
+        """Run an operation, in the worker pool if enabled."""
+        start = time.perf_counter()
+
+        if not self._pool_size:
+            result = func(self._context, *args)
+            self._record(name, time.perf_counter() - start)
+
+            return result
+
+        with self._lock:
+            if self._pending >= self._pool_size + self._queue_limit:
+                self._record_locked('rejected', 0)
+
+                raise ServiceUnavailable(_('Server busy, please try again later'))
+
+            self._pending += 1
+
+            if self._pool is None:
+                # Created lazily, after the application server forks
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self._pool_size,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_crypto_worker,
+                    initargs=(self._params,)
+                )
+
+            pool = self._pool
+
+        future = None
+
+        try:
+            future = pool.submit(func, None, *args)
+
+            # Released once the worker is done, not when the caller stops
+            # waiting: operations that timed out still occupy the pool
+            future.add_done_callback(self._release)
+
+            return future.result(timeout=self._timeout)
+
+        except TimeoutError:
+            future.cancel()
+
+            raise ServiceUnavailable(_('Server busy, please try again later'))
+
+        except BrokenProcessPool:
+            # A worker died, start a new pool on next operation
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+
+            raise ServiceUnavailable(_('Server busy, please try again later'))
+
+        finally:
+            if future is None:
+                # Could not be submitted
+                self._release()
+
+            self._record(name, time.perf_counter() - start)
+
+    def _release(self, future=None):
+        """Mark a pending operation as finished."""
+        with self._lock:
+            self._pending -= 1
+
+    def _record(self, name, elapsed):
+        with self._lock:
+            self._record_locked(name, elapsed)
+
+    def _record_locked(self, name, elapsed):
+        stats = self._stats.setdefault(name, {'count': 0, 'total': 0, 'max': 0})
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+
     def init_app(self, app):
         """Initialize manager.
 
@@ -162,8 +409,38 @@ class CryptoManager(object):
 
             params['{}__{}'.format(scheme, option)] = value
 
+        self._params = params
         self._context = CryptContext(**params)
 
+        self._pool_size = app.config.get('PASSLIB_POOL_SIZE') or 0
+        self._queue_limit = app.config.get('PASSLIB_QUEUE_LIMIT', 8)
+        self._timeout = app.config.get('PASSLIB_TIMEOUT', 30)
+
+
+# Context of crypto worker processes
+_worker_context = None
+
+
+def _init_crypto_worker(params):
+    """Create the passlib context of a crypto worker process."""
+    global _worker_context
+
+    from passlib.context import CryptContext
+
+    _worker_context = CryptContext(**params)
+
+
+def _crypto_hash(context, secret):
+    return (context or _worker_context).hash(secret)
+
+
+def _crypto_verify(context, secret, hash):
+    return (context or _worker_context).verify(secret, hash)
+
+
+def _crypto_verify_and_update(context, secret, hash):
+    return (context or _worker_context).verify_and_update(secret, hash)
+
 
 class HashidsWrapper(object):
     """Wrapper for deferred initialization of Hashids.
@@ -213,10 +490,365 @@ class HighlighterRenderer(misaka.HtmlRenderer):
         if not lang:
             return '\n<pre><code>{}</code></pre>\n'.format(text.strip())
 
-        lexer = get_lexer_by_name(lang, stripall=True)
-        formatter = HtmlFormatter()
+        return highlight(
+            code=text,
+            lexer=_get_lexer(lang),
+            formatter=_get_formatter()
+        )
+
+
+@lru_cache(maxsize=64)
+def _get_lexer(lang):
+    """Obtain a pygments lexer for the given language.
+
+    Looking up lexers goes through the whole registry, so instances are
+    memoized and reused between renders.
+
+    Args:
+        lang (str): Name or alias of the language.
+
+    Raises:
+        `pygments.util.ClassNotFound` if there is no lexer for the language.
+    """
+    return get_lexer_by_name(lang, stripall=True)
+
+
+@lru_cache(maxsize=None)
+def _get_formatter():
+    """Obtain the pygments formatter shared by all code blocks."""
+    return HtmlFormatter()
 
-        return highlight(code=text, lexer=lexer, formatter=formatter)
+
+class KeysetPagination(object):
+    """Cursor (keyset) based pagination for queries sorted by date.
+
+    Items are sorted by date and ID (newest first) and pages are fetched by
+    seeking past the last (or before the first) item shown, rather than by
+    skipping a number of rows with `OFFSET`. Therefore, the cost of fetching
+    a page does not depend on how deep in the listing it is.
+
+    Cursors are opaque tokens (encoded with Hashids) containing the direction
+    of travel and the date and ID of the item to seek from. Items without a
+    date cannot be placed in the listing and are therefore excluded.
+
+    Attributes:
+        items (list): Items of the current page.
+        has_prev (bool): Whether there is a previous page.
+        has_next (bool): Whether there is a next page.
+        prev_cursor (str): Cursor of the previous page or `None`.
+        next_cursor (str): Cursor of the next page or `None`.
+
+    Args:
+        query: Query to paginate (any existing ordering is discarded).
+        date_column: Date column to sort by.
+        id_column: ID column used to break ties between equal dates.
+        cursor (str): Cursor of the page to fetch. If `None`, the first page
+            is fetched.
+        per_page (int): Number of items per page.
+
+    Raises:
+        `ValueError` if the cursor is not valid.
+    """
+
+    # Used in templates to tell cursor and page number pagination apart
+    cursor_mode = True
+
+    _NEXT = 1
+    _PREV = 0
+
+    def __init__(self, query, date_column, id_column, cursor=None, per_page=10):
+        self.per_page = per_page
+
+        direction = self._NEXT
+        query = query.order_by(None).filter(date_column != None)
+
+        if cursor:
+            direction, date, item_id = self._decode(cursor)
+
+        if direction == self._NEXT:
+            query = query.order_by(date_column.desc(), id_column.desc())
+
+            if cursor:
+                query = query.filter(
+                    or_(
+                        date_column < date,
+                        and_(date_column == date, id_column < item_id)
+                    )
+                )
+
+        else:
+            query = (
+                query
+                .filter(
+                    or_(
+                        date_column > date,
+                        and_(date_column == date, id_column > item_id)
+                    )
+                )
+                .order_by(date_column.asc(), id_column.asc())
+            )
+
+        # Fetch an additional item to know whether there are more pages
+        items = query.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if direction == self._NEXT:
+            self.has_prev = cursor is not None
+            self.has_next = has_more
+
+        else:
+            items.reverse()
+
+            self.has_prev = has_more
+            self.has_next = True
+
+        self.items = items
+        self.prev_cursor = None
+        self.next_cursor = None
+
+        if items:
+            date_attr = date_column.key
+            id_attr = id_column.key
+
+            if self.has_prev:
+                first = items[0]
+                self.prev_cursor = self._encode(
+                    self._PREV,
+                    getattr(first, date_attr),
+                    getattr(first, id_attr)
+                )
+
+            if self.has_next:
+                last = items[-1]
+                self.next_cursor = self._encode(
+                    self._NEXT,
+                    getattr(last, date_attr),
+                    getattr(last, id_attr)
+                )
+
+    @staticmethod
+    def _encode(direction, date, item_id):
+        """Encode a cursor.
+
+        Args:
+            direction (int): Direction of travel.
+            date (datetime): Date of the item to seek from.
+            item_id (int): ID of the item to seek from.
+
+        Returns:
+            Cursor token.
+        """
+        from akamatsu import hashids_hasher
+
+        delta = date - _EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+        return hashids_hasher.encode(direction, micros, item_id)
+
+    @staticmethod
+    def _decode(cursor):
+        """Decode a cursor.
+
+        Args:
+            cursor (str): Cursor token.
+
+        Returns:
+            Tuple with direction, date and ID.
+
+        Raises:
+            `ValueError` if the cursor is not valid.
+        """
+        from akamatsu import hashids_hasher
+
+        values = hashids_hasher.decode(cursor)
+
+        if len(values) != 3 or values[0] not in (0, 1):
+            raise ValueError('Invalid cursor')
+
+        direction, micros, item_id = values
+
+        try:
+            date = _EPOCH + datetime.timedelta(microseconds=micros)
+
+        except OverflowError:
+            # Out of the supported range of dates
+            raise ValueError('Invalid cursor')
+
+        return direction, date, item_id
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """Thread-safe in-process cache with least-recently-used eviction.
+
+    The cache keeps track of hits and misses, which can be obtained through
+    the `info()` method in order to size the cache appropriately.
+
+    Args:
+        maxsize (int): Maximum number of entries to keep.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Obtain a value from the cache.
+
+        Args:
+            key: Key of the entry.
+            default: Value to return if the entry does not exist.
+
+        Returns:
+            Cached value or `default`.
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        """Store a value in the cache, evicting old entries if needed.
+
+        Args:
+            key: Key of the entry.
+            value: Value to store.
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove an entry from the cache (if present).
+
+        Args:
+            key: Key of the entry.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all the entries from the cache."""
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """Obtain cache statistics.
+
+        Returns:
+            `CacheInfo` named tuple.
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+
+class OffsetPagination(object):
+    """Page number based pagination which does not require an exact total.
+
+    This mimics the interface of Flask-SQLAlchemy's `Pagination` object, so it
+    can be used in the same templates, but whether there is a next page is
+    known by fetching one additional row. The total number of items may be
+    `None` when it is not known, in which case `pages` is `None` as well and
+    `iter_pages()` does not yield anything.
+
+    Attributes:
+        items (list): Items of the current page.
+        page (int): Current page number.
+        per_page (int): Number of items per page.
+        total (int): Total number of items or `None` if unknown.
+        has_next (bool): Whether there is a next page.
+
+    Args:
+        items (list): Items of the current page.
+        page (int): Current page number.
+        per_page (int): Number of items per page.
+        total (int): Total number of items or `None` if unknown.
+        has_next (bool): Whether there is a next page.
+    """
+
+    # Used in templates to tell cursor and page number pagination apart
+    cursor_mode = False
+
+    def __init__(self, items, page, per_page, total, has_next):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.has_next = has_next
+
+    @property
+    def pages(self):
+        """Total number of pages or `None` if the total is not known."""
+        if self.total is None:
+            return None
+
+        if self.per_page == 0:
+            return 0
+
+        return max(1, -(-self.total // self.per_page))
+
+    @property
+    def has_prev(self):
+        """Whether there is a previous page."""
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        """Number of the previous page or `None`."""
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        """Number of the next page or `None`."""
+        return self.page + 1 if self.has_next else None
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
+        """Iterate over the page numbers, using `None` for skipped pages.
+
+        Works like Flask-SQLAlchemy's `Pagination.iter_pages()`.
+
+        Yields:
+            Page numbers or `None`.
+        """
+        if not self.pages:
+            return
+
+        last = 0
+
+        for num in range(1, self.pages + 1):
+            if num <= left_edge or \
+                    (self.page - left_current - 1 < num < self.page + right_current) or \
+                    num > self.pages - right_edge:
+                if last + 1 != num:
+                    yield None
+
+                yield num
+                last = num
+
+
+# Cache of pagination totals (see `paginate()`)
+_totals_cache = LRUCache(256)
 
 
 def allowed_roles(*roles):
@@ -232,7 +864,7 @@ def allowed_roles(*roles):
                 return current_app.login_manager.unauthorized()
 
             # Check roles
-            if set(roles).isdisjoint(current_user.role_names):
+            if current_user.role_set.isdisjoint(roles):
                 flash(
                     _('You do not have permission to access the page'),
                     'warning'
@@ -305,6 +937,28 @@ def is_allowed_file(filename):
         filename.rsplit('.', 1)[1] in current_app.config['ALLOWED_EXTENSIONS']
 
 
+def hash_file(fileobj, chunk_size=65536):
+    """Obtain the hash of a file without loading it in memory.
+
+    The file is rewound after hashing so that it can be saved afterwards.
+
+    Args:
+        fileobj: Binary file object (e.g. upload stream).
+        chunk_size (int): Number of bytes to read at a time.
+
+    Returns:
+        SHA-256 hex digest of the contents.
+    """
+    digest = hashlib.sha256()
+
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+
+    fileobj.seek(0)
+
+    return digest.hexdigest()
+
+
 def is_safe_url(target):
     """Check whether the target is safe for redirection.
 
@@ -324,20 +978,25 @@ def is_safe_url(target):
 def send_email(*args, **kwargs):
     """Send an email.
 
-    Emails are sent asynchronously if Celery is enabled.
+    Emails are sent asynchronously if Celery is enabled. Otherwise, they are
+    sent from a background thread if `USE_MAIL_QUEUE` is enabled (see
+    `akamatsu.mailer.MailQueue`).
 
     All arguments are passed as-is to Flask-Mail.
 
     Returns:
         Mail send result or `None`.
     """
-    from akamatsu import mail
+    from akamatsu import mail, mail_queue
 
     if current_app.config.get('USE_CELERY', False):
         from akamatsu.async_tasks import async_mail
 
         async_mail.delay(*args, **kwargs)
 
+    elif current_app.config.get('USE_MAIL_QUEUE', False):
+        mail_queue.send(Message(*args, **kwargs))
+
     else:
         message = Message(*args, **kwargs)
 
@@ -357,3 +1016,83 @@ def is_ajax():
         `True` if the request was made through AJAX, otherwise `False`.
     """
     return request.headers.get('x-akamatsu-partial', 'false') == 'true'
+
+
+def paginate(query, page, per_page, count=True):
+    """Paginate a query without counting its rows on every request.
+
+    The page is fetched with an additional row to know whether there is a next
+    page. The total number of items is obtained with `COUNT(*)` only if it is
+    not in the cache, where it is kept for `ADMIN_LIST_COUNT_TTL` seconds
+    (defaults to 60) keyed by the SQL of the query (without ordering), so
+    sorting a listing or moving through its pages reuses the same total.
+
+    Totals from the cache are adjusted with what the fetched page shows, e.g.
+    when the last page has more (or less) items than expected.
+
+    Args:
+        query: Query to paginate.
+        page (int): Page number to fetch (starting at 1).
+        per_page (int): Number of items per page.
+        count (bool): Whether to count the items when the total is not cached.
+            If `False`, the total is `None` unless it can be obtained from the
+            cache or from the fetched page itself.
+
+    Returns:
+        `OffsetPagination` instance.
+    """
+    if page < 1:
+        page = 1
+
+    offset = (page - 1) * per_page
+    items = query.limit(per_page + 1).offset(offset).all()
+
+    has_next = len(items) > per_page
+    items = items[:per_page]
+
+    # Lower bound of the total given what has been fetched
+    seen = offset + len(items)
+
+    if not has_next and (items or page == 1):
+        # This is the last page, so the total is known
+        total = seen
+
+    else:
+        key = _totals_key(query)
+        cached = _totals_cache.get(key)
+        total = None
+
+        if cached and cached[0] > time.monotonic():
+            total = cached[1]
+
+        elif count:
+            total = query.order_by(None).count()
+            _totals_cache.set(
+                key,
+                (
+                    time.monotonic() + current_app.config.get('ADMIN_LIST_COUNT_TTL', 60),
+                    total
+                )
+            )
+
+        if total is not None and has_next:
+            total = max(total, seen + 1)
+
+    return OffsetPagination(items, page, per_page, total, has_next)
+
+
+def _totals_key(query):
+    """Obtain the key of the cached total of a query.
+
+    Args:
+        query: Query to obtain the key for.
+
+    Returns:
+        Cache key.
+    """
+    compiled = query.order_by(None).statement.compile()
+    params = sorted((k, repr(v)) for k, v in compiled.params.items())
+
+    return hashlib.sha1(
+        (str(compiled) + repr(params)).encode('utf-8')
+    ).hexdigest()
@@ -27,78 +27,47 @@
 
 """This module contains administration views."""
 
-from flask import Blueprint, render_template
+from flask import Blueprint, current_app, render_template
 from flask_babel import _
 from flask_login import current_user, login_required
+from sqlalchemy import func
 
+import time
+
+from akamatsu import db
 from akamatsu.models import FileUpload, Page, Post, User, user_posts
+from akamatsu.util import LRUCache
 
 
 bp_admin = Blueprint('admin', __name__)
 
+# Dashboard counters
+_counts_cache = LRUCache(64)
+
 
 @bp_admin.route('/')
 @login_required
 def home():
     """Show admin dashboard."""
-    params = {}
+    names = []
+    owner_id = None
 
     if current_user.has_role('administrator'):
-        params['posts'] = (
-            Post.query
-            .filter(Post.ghosted_id == None)
-        ).count()
-
-        params['post_ghosts'] = (
-            Post.query
-            .filter(Post.ghosted_id != None)
-        ).count()
-
-        params['pages'] = (
-            Page.query
-            .filter(Page.ghosted_id == None)
-        ).count()
-
-        params['page_ghosts'] = (
-            Page.query
-            .filter(Page.ghosted_id != None)
-        ).count()
-
-        params['files'] = FileUpload.query.count()
-
-        params['users'] = User.query.count()
+        names = ['posts', 'post_ghosts', 'pages', 'page_ghosts', 'files', 'users']
 
     else:
         if current_user.has_role('blogger'):
-            params['posts'] = (
-                Post.query
-                .join(user_posts)
-                .join(User)
-                .filter(User.id == current_user.id)
-                .filter(Post.ghosted_id == None)
-            ).count()
-
-            params['post_ghosts'] = (
-                Post.query
-                .join(user_posts)
-                .join(User)
-                .filter(User.id == current_user.id)
-                .filter(Post.ghosted_id != None)
-            ).count()
+            # Only posts in which the user has participated
+            names += ['posts', 'post_ghosts']
+            owner_id = current_user.id
 
         if current_user.has_role('editor'):
-            params['pages'] = (
-                Page.query
-                .filter(Page.ghosted_id == None)
-            ).count()
-
-            params['page_ghosts'] = (
-                Page.query
-                .filter(Page.ghosted_id != None)
-            ).count()
+            names += ['pages', 'page_ghosts']
 
         if current_user.has_role('blogger') or current_user.has_role('editor'):
-            params['files'] = FileUpload.query.count()
+            names.append('files')
+
+    params = _get_counts(tuple(names), owner_id) if names else {}
 
     return render_template('admin/index.html', **params)
 
@@ -118,3 +87,63 @@ def dashboard_not_found(e):
         'admin/error.html',
         error_msg=_('It\'s gone! Poof! Magic!')
     ), 404
+
+
+def _get_counts(names, owner_id=None):
+    """Obtain the dashboard counters in a single query.
+
+    Results are cached for `ADMIN_COUNTS_TTL` seconds (defaults to 30).
+
+    Args:
+        names (tuple): Names of the counters to obtain.
+        owner_id (int): If set, only posts of this user are counted.
+
+    Returns:
+        Dictionary mapping counter names to values.
+    """
+    key = (names, owner_id)
+    cached = _counts_cache.get(key)
+
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    post_filters = []
+
+    if owner_id is not None:
+        post_filters.append(
+            Post.id.in_(
+                db.session.query(user_posts.c.post_id)
+                .filter(user_posts.c.user_id == owner_id)
+            )
+        )
+
+    queries = {
+        'posts': (Post.id, [Post.ghosted_id == None] + post_filters),
+        'post_ghosts': (Post.id, [Post.ghosted_id != None] + post_filters),
+        'pages': (Page.id, [Page.ghosted_id == None]),
+        'page_ghosts': (Page.id, [Page.ghosted_id != None]),
+        'files': (FileUpload.id, []),
+        'users': (User.id, [])
+    }
+
+    # Each counter is a scalar subquery of the same statement
+    columns = []
+
+    for name in names:
+        column, filters = queries[name]
+
+        columns.append(
+            db.session.query(func.count(column))
+            .filter(*filters)
+            .label(name)
+        )
+
+    row = db.session.query(*columns).one()
+    counts = dict(zip(names, row))
+
+    _counts_cache.set(
+        key,
+        (time.monotonic() + current_app.config.get('ADMIN_COUNTS_TTL', 30), counts)
+    )
+
+    return counts
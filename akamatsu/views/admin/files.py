@@ -35,15 +35,20 @@ from urllib.parse import unquote
 from flask import abort, current_app, flash, jsonify, redirect, \
         render_template, request, url_for
 from flask_babel import _
+from flask_login import current_user
 from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 from wtforms import ValidationError
 
 from akamatsu import db
+from akamatsu.images import schedule_variants
 from akamatsu.models import FileUpload
+from akamatsu.storage import PartialUpload, discard_blob, discard_staged, \
+        release_upload, stage_blob, store_file
 from akamatsu.views.admin import bp_admin
 from akamatsu.forms import UploadForm
-from akamatsu.util import allowed_roles, is_allowed_file, is_ajax, is_safe_url
+from akamatsu.util import allowed_roles, is_allowed_file, is_ajax, is_safe_url, \
+        paginate
 
 
 @bp_admin.route('/files')
@@ -62,7 +67,12 @@ def file_index():
     files = FileUpload.query
 
     files, sort_key, order_dir = _sort_files(files, sort_key, order_dir)
-    files = files.paginate(page, current_app.config['PAGE_ITEMS'], False)
+    files = paginate(
+        files,
+        page,
+        current_app.config['PAGE_ITEMS'],
+        count=not is_ajax()
+    )
 
     if is_ajax():
         # AJAX request
@@ -111,43 +121,40 @@ def upload_file():
             subdir = secure_filename(subdir)
             rel_path = os.path.join(subdir, rel_path)
 
-        dst_path = os.path.join(current_app.config['UPLOADS_PATH'], rel_path)
-        dst_dir = os.path.dirname(dst_path)
-
-        if os.path.exists(dst_path):
+        if FileUpload.get_by_path(rel_path):
             flash(_('A file in that path already exists'))
             return render_template('admin/files/edit.html', form=form)
 
-        if not os.path.exists(dst_dir):
-            # Create subdirectory
-            try:
-                os.mkdir(dst_dir)
-                os.chmod(dst_dir, 0o755)
+        # Contents are stored in the blob store, the path is only logical.
+        # The staged file is kept until the record is committed
+        try:
+            content_hash, tmp_path = stage_blob(form.upload.data.stream)
+            created = store_file(tmp_path, content_hash, keep=True)
 
-            except:
-                flash(_('Failed to create subdirectory, contact an administrator'))
-                return render_template('admin/files/edit.html', form=form)
+        except OSError:
+            current_app.logger.exception('Failed to store file')
 
+            flash(_('Failed to upload file, contact an administrator'), 'error')
+            return render_template('admin/files/edit.html', form=form)
 
         new_file = FileUpload(
             path=rel_path,
-            description=form.description.data
+            description=form.description.data,
+            content_hash=content_hash
         )
 
-        if form.mime.data and form.mime.data in mimetypes.types_map.values():
-            new_file.mime = form.mime.data
-
-        else:
-            _fname, ext = os.path.splitext(filename)
-            new_file.mime = mimetypes.types_map.get(ext, 'UNKNOWN')
+        new_file.mime = _get_mime(filename, form.mime.data)
 
         try:
             correct = True
             db.session.add(new_file)
             db.session.commit()
 
-            form.upload.data.save(dst_path)
-            os.chmod(dst_path, 0o644)
+            # The blob may have been discarded before committing (e.g. if
+            # another upload with the same contents was deleted)
+            store_file(tmp_path, content_hash)
+
+            schedule_variants(new_file)
 
             flash(_('New file uploaded correctly'), 'success')
 
@@ -157,6 +164,10 @@ def upload_file():
             # Path already exists
             # Need to manually rollback here
             db.session.rollback()
+
+            if created:
+                discard_blob(content_hash)
+
             form.route.errors.append(_('File in that path already exists'))
 
             return render_template('admin/files/edit.html', form=form)
@@ -173,9 +184,147 @@ def upload_file():
             if not correct:
                 db.session.rollback()
 
+                if created:
+                    discard_blob(content_hash)
+
+            discard_staged(tmp_path)
+
     return render_template('admin/files/edit.html', form=form)
 
 
+@bp_admin.route('/files/chunked', methods=['POST'])
+@allowed_roles('administrator', 'blogger', 'editor')
+def start_chunked_upload():
+    """Start a chunked upload.
+
+    Meant for large files, which are sent in several requests (see
+    `upload_chunk()`) and can be resumed if interrupted. The request body
+    is a JSON object with the following fields:
+
+    - `filename`: Name of the file (required).
+    - `size`: Size of the file in bytes (required).
+    - `subdir`: Subdirectory in which to store the file.
+    - `mime`: MIME type of the file.
+    - `description`: Description of the file.
+
+    As in any other form, the CSRF token must be sent (in the `X-CSRFToken`
+    header) with every request.
+
+    Files larger than `MAX_UPLOAD_SIZE` bytes are rejected.
+
+    Returns:
+        JSON object with the `id` of the upload and the current `offset`.
+    """
+    data = request.get_json(silent=True) or {}
+
+    filename = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+
+    if not filename or not is_allowed_file(filename):
+        return jsonify({'error': _('File type is not allowed')}), 400
+
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': _('Invalid file size')}), 400
+
+    if _exceeds_upload_limit(size):
+        return jsonify({'error': _('File is too large')}), 413
+
+    rel_path = filename
+
+    if data.get('subdir'):
+        rel_path = os.path.join(secure_filename(data['subdir']), rel_path)
+
+    if FileUpload.get_by_path(rel_path):
+        return jsonify({'error': _('A file in that path already exists')}), 409
+
+    try:
+        upload = PartialUpload.create(
+            rel_path,
+            size,
+            mime=_get_mime(filename, data.get('mime')),
+            description=data.get('description'),
+            user_id=current_user.id
+        )
+
+    except OSError:
+        current_app.logger.exception('Failed to start chunked upload')
+
+        return jsonify({'error': _('Failed to upload file, contact an administrator')}), 500
+
+    return jsonify({'id': upload.id, 'offset': 0}), 201
+
+
+@bp_admin.route('/files/chunked/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+@allowed_roles('administrator', 'blogger', 'editor')
+def upload_chunk(upload_id):
+    """Manage an ongoing chunked upload.
+
+    - `GET`: obtain the current offset, to resume an interrupted upload.
+    - `PUT`: append a chunk. The request body contains the raw bytes and the
+        `offset` query parameter must be equal to the current offset. The
+        file is stored once the last chunk is received.
+    - `DELETE`: cancel the upload.
+
+    Args:
+        upload_id (str): ID of the upload.
+
+    Returns:
+        JSON object with the current `offset`, or the `hashid` and `url` of
+        the file once the upload is complete.
+    """
+    upload = PartialUpload.get(upload_id)
+
+    if not upload:
+        return jsonify({'error': _('Could not find upload')}), 404
+
+    if upload.meta['user_id'] != current_user.id \
+            and not current_user.has_role('administrator'):
+        return jsonify({'error': _('You cannot access that upload')}), 403
+
+    if request.method == 'GET':
+        return jsonify({
+            'id': upload.id,
+            'offset': upload.offset,
+            'size': upload.size
+        })
+
+    if request.method == 'DELETE':
+        upload.discard()
+
+        return jsonify({'id': upload.id}), 200
+
+    # Append chunk
+    offset = request.args.get('offset', type=int)
+
+    if offset is None:
+        return jsonify({'error': _('Missing offset')}), 400
+
+    # Limit may have been lowered after starting the upload
+    if _exceeds_upload_limit(upload.size):
+        return jsonify({'error': _('File is too large')}), 413
+
+    try:
+        # Body is streamed, not loaded in memory
+        new_offset = upload.append(request.stream, offset)
+
+    except ValueError as e:
+        return jsonify({'error': str(e), 'offset': upload.offset}), 409
+
+    except FileNotFoundError:
+        # Discarded or finalized by another request
+        return jsonify({'error': _('Could not find upload')}), 404
+
+    except OSError:
+        current_app.logger.exception('Failed to store chunk')
+
+        return jsonify({'error': _('Failed to upload file, contact an administrator')}), 500
+
+    if new_offset < upload.size:
+        return jsonify({'id': upload.id, 'offset': new_offset})
+
+    return _finalize_chunked_upload(upload)
+
+
 @bp_admin.route('/files/<hashid>')
 @allowed_roles('administrator', 'blogger', 'editor')
 def show_file(hashid):
@@ -225,14 +374,8 @@ def delete_file(hashid):
             db.session.delete(fupload)
             db.session.commit()
 
-            # Delete from file system
-            fpath = os.path.join(
-                current_app.config['UPLOADS_PATH'],
-                fupload.path
-            )
-
-            if os.path.isfile(fpath):
-                os.unlink(fpath)
+            # Delete from file system (unless the contents are shared)
+            release_upload(fupload)
 
             flash(_('File deleted'), 'success')
 
@@ -333,3 +476,94 @@ def _sort_files(query, key, order):
 
     order = 'desc'
     return query.order_by(ordering.desc()), key, order
+
+
+def _finalize_chunked_upload(upload):
+    """Store a complete chunked upload and create its record.
+
+    Args:
+        upload (PartialUpload): Complete upload.
+
+    Returns:
+        JSON response.
+    """
+    try:
+        content_hash, created, tmp_path = upload.finalize()
+
+    except ValueError as e:
+        # Finalized by another request
+        return jsonify({'error': str(e), 'offset': upload.offset}), 409
+
+    except OSError:
+        current_app.logger.exception('Failed to store file')
+
+        return jsonify({'error': _('Failed to upload file, contact an administrator')}), 500
+
+    new_file = FileUpload(
+        path=upload.path,
+        description=upload.meta['description'],
+        mime=upload.meta['mime'],
+        content_hash=content_hash
+    )
+
+    try:
+        correct = True
+        db.session.add(new_file)
+        db.session.commit()
+
+        # The blob may have been discarded before committing
+        store_file(tmp_path, content_hash)
+
+        schedule_variants(new_file)
+
+        return jsonify({
+            'hashid': new_file.hashid,
+            'url': url_for('admin.show_file', hashid=new_file.hashid)
+        }), 201
+
+    except IntegrityError:
+        # Path was taken while uploading
+        correct = False
+
+        return jsonify({'error': _('A file in that path already exists')}), 409
+
+    except Exception:
+        # Catch anything unknown
+        correct = False
+        current_app.logger.exception('Failed to create file')
+
+        return jsonify({'error': _('Failed to upload file, contact an administrator')}), 500
+
+    finally:
+        if not correct:
+            db.session.rollback()
+
+            if created:
+                discard_blob(content_hash)
+
+        discard_staged(tmp_path)
+
+
+def _exceeds_upload_limit(size):
+    """Check whether a file size is over the `MAX_UPLOAD_SIZE` limit."""
+    limit = current_app.config.get('MAX_UPLOAD_SIZE')
+
+    return bool(limit) and size > limit
+
+
+def _get_mime(filename, mime=None):
+    """Obtain the MIME type of an uploaded file.
+
+    Args:
+        filename (str): Name of the file.
+        mime (str): MIME type provided by the user, if any.
+
+    Returns:
+        Provided MIME type if valid, otherwise guessed from the extension.
+    """
+    if mime and mime in mimetypes.types_map.values():
+        return mime
+
+    _fname, ext = os.path.splitext(filename)
+
+    return mimetypes.types_map.get(ext, 'UNKNOWN')
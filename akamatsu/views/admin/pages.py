@@ -33,15 +33,15 @@ from flask import abort, current_app, flash, jsonify, redirect, \
         render_template, request, url_for
 from flask_babel import _
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, selectinload
 from wtforms import ValidationError
 
-from akamatsu import db
+from akamatsu import db, response_cache
 from akamatsu.models import Page
 from akamatsu.views.admin import bp_admin
 from akamatsu.forms import PageForm
 from akamatsu.util import allowed_roles, datetime_to_utc, is_ajax, is_safe_url, \
-        utc_to_local_tz
+        paginate, utc_to_local_tz
 
 
 @bp_admin.route('/pages')
@@ -64,7 +64,12 @@ def page_index():
     )
 
     pages, sort_key, order_dir = _sort_pages(pages, sort_key, order_dir)
-    pages = pages.paginate(page, current_app.config['PAGE_ITEMS'], False)
+    pages = paginate(
+        pages,
+        page,
+        current_app.config['PAGE_ITEMS'],
+        count=not is_ajax()
+    )
 
     if is_ajax():
         # AJAX request
@@ -98,10 +103,16 @@ def page_ghosts():
     pages = (
         Page.query
         .filter(Page.ghosted_id != None)
+        .options(selectinload(Page.ghosted))
     )
 
     pages, sort_key, order_dir = _sort_pages(pages, sort_key, order_dir)
-    pages = pages.paginate(page, current_app.config['PAGE_ITEMS'], False)
+    pages = paginate(
+        pages,
+        page,
+        current_app.config['PAGE_ITEMS'],
+        count=not is_ajax()
+    )
 
     if is_ajax():
         # AJAX request
@@ -145,6 +156,8 @@ def new_page():
             db.session.add(new_page)
             db.session.commit()
 
+            response_cache.purge(*new_page.cache_tags)
+
             flash(_('New page created correctly'), 'success')
 
             return redirect(url_for('admin.page_index'))
@@ -206,6 +219,8 @@ def edit_page(hashid):
             correct = True
             db.session.commit()
 
+            response_cache.purge(*page.cache_tags)
+
             flash(_('Page updated correctly'), 'success')
 
             return redirect(
@@ -264,12 +279,15 @@ def delete_page(hashid):
     if request.method == 'POST':
         # Delete page
         ref = unquote(request.args.get('ref', ''))
+        cache_tags = page.cache_tags
 
         try:
             correct = True
             db.session.delete(page)
             db.session.commit()
 
+            response_cache.purge(*cache_tags)
+
             flash(_('Page "%(title)s" deleted', title=page.title), 'success')
 
             # Redirect user
@@ -36,15 +36,15 @@ from flask import abort, current_app, flash, jsonify, redirect, \
 from flask_babel import _
 from flask_login import current_user
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, selectinload
 from wtforms import ValidationError
 
-from akamatsu import db
+from akamatsu import db, response_cache
 from akamatsu.models import user_posts, Post, User
 from akamatsu.views.admin import bp_admin
 from akamatsu.forms import PostForm
 from akamatsu.util import allowed_roles, datetime_to_utc, is_ajax, is_safe_url, \
-        utc_to_local_tz
+        paginate, utc_to_local_tz
 
 
 @bp_admin.route('/posts')
@@ -79,7 +79,12 @@ def post_index():
             .filter(User.id == current_user.id)
         )
 
-    posts = posts.paginate(page, current_app.config['PAGE_ITEMS'], False)
+    posts = paginate(
+        posts,
+        page,
+        current_app.config['PAGE_ITEMS'],
+        count=not is_ajax()
+    )
 
     if is_ajax():
         # AJAX request
@@ -115,6 +120,7 @@ def post_ghosts():
     posts = (
         Post.query
         .filter(Post.ghosted_id != None)
+        .options(selectinload(Post.ghosted))
     )
 
     posts, sort_key, order_dir = _sort_posts(posts, sort_key, order_dir)
@@ -127,7 +133,12 @@ def post_ghosts():
             .filter(User.id == current_user.id)
         )
 
-    posts = posts.paginate(page, current_app.config['PAGE_ITEMS'], False)
+    posts = paginate(
+        posts,
+        page,
+        current_app.config['PAGE_ITEMS'],
+        count=not is_ajax()
+    )
 
     if is_ajax():
         # AJAX request
@@ -209,6 +220,8 @@ def new_post():
             db.session.add(new_post)
             db.session.commit()
 
+            response_cache.purge(*new_post.cache_tags)
+
             flash(_('New post created correctly'), 'success')
 
             return redirect(url_for('admin.post_index'))
@@ -298,6 +311,9 @@ def edit_post(hashid):
                 max_length=512
         )
 
+        # Cached responses showing the post before the update
+        old_cache_tags = post.cache_tags
+
         form.populate_obj(post)
 
         # Adjust timezone
@@ -317,6 +333,8 @@ def edit_post(hashid):
             correct = True
             db.session.commit()
 
+            response_cache.purge(*(old_cache_tags + post.cache_tags))
+
             flash(_('Post updated correctly'), 'success')
 
             return redirect(
@@ -387,12 +405,15 @@ def delete_post(hashid):
     if request.method == 'POST':
         # Delete post
         ref = unquote(request.args.get('ref', ''))
+        cache_tags = post.cache_tags
 
         try:
             correct = True
             db.session.delete(post)
             db.session.commit()
 
+            response_cache.purge(*cache_tags)
+
             flash(_('Post "%(title)s" deleted', title=post.title), 'success')
 
             # Redirect user
@@ -32,7 +32,7 @@ from flask_babel import _
 from flask_login import current_user, fresh_login_required, login_required
 from sqlalchemy.exc import IntegrityError
 
-from akamatsu import crypto_manager, db
+from akamatsu import crypto_manager, db, response_cache
 from akamatsu.views.admin import bp_admin
 from akamatsu.forms import PasswordResetForm, ProfileForm
 
@@ -50,6 +50,8 @@ def profile_edit():
             correct = True
             db.session.commit()
 
+            response_cache.purge(*current_user.cache_tags)
+
             flash(_('Profile updated correctly'), 'success')
 
             return render_template('admin/profile/edit.html', form=form)
@@ -36,11 +36,11 @@ from passlib import pwd
 from sqlalchemy.exc import IntegrityError
 from wtforms import ValidationError
 
-from akamatsu import crypto_manager, db
+from akamatsu import crypto_manager, db, response_cache
 from akamatsu.models import User, Role
 from akamatsu.views.admin import bp_admin
 from akamatsu.forms import UserForm
-from akamatsu.util import allowed_roles, is_ajax, is_safe_url
+from akamatsu.util import allowed_roles, is_ajax, is_safe_url, paginate
 
 
 @bp_admin.route('/users')
@@ -58,7 +58,12 @@ def user_index():
     users = User.query
 
     users, sort_key, order_dir = _sort_users(users, sort_key, order_dir)
-    users = users.paginate(page, current_app.config['PAGE_ITEMS'], False)
+    users = paginate(
+        users,
+        page,
+        current_app.config['PAGE_ITEMS'],
+        count=not is_ajax()
+    )
 
     if is_ajax():
         # AJAX request
@@ -160,6 +165,7 @@ def edit_user(username):
 
     if form.validate_on_submit():
         _orig_pass = user.password
+        old_cache_tags = user.cache_tags
         form.populate_obj(user)
 
         user.password = _orig_pass
@@ -172,6 +178,8 @@ def edit_user(username):
             correct = True
             db.session.commit()
 
+            response_cache.purge(*(old_cache_tags + user.cache_tags))
+
             flash(_('User updated correctly'), 'success')
 
             return redirect(
@@ -231,12 +239,15 @@ def delete_user(username):
     if request.method == 'POST':
         # Delete user
         ref = unquote(request.args.get('ref', ''))
+        cache_tags = user.cache_tags
 
         try:
             correct = True
             db.session.delete(user)
             db.session.commit()
 
+            response_cache.purge(*cache_tags)
+
             flash(_('User "%(username)s" deleted', username=username), 'success')
 
             # Redirect user
@@ -64,12 +64,33 @@ def login():
             )
         ).first()
 
-        if not user or not crypto_manager.verify(form.password.data, user.password):
+        if user:
+            is_valid, new_hash = crypto_manager.verify_and_update(
+                form.password.data,
+                user.password
+            )
+
+        if not user or not is_valid:
             # Show invalid credentials message
             flash(_('Invalid credentials'), 'error')
 
             return render_template('auth/login.html', form=form)
 
+        if new_hash:
+            # Transparently upgrade outdated hash
+            try:
+                correct = True
+                user.password = new_hash
+                db.session.commit()
+
+            except Exception:
+                correct = False
+                current_app.logger.exception('Failed to update password hash')
+
+            finally:
+                if not correct:
+                    db.session.rollback()
+
         # Log the user in
         if login_user(user, remember=form.remember_me.data):
             flash(_('Logged in successfully'), 'success')
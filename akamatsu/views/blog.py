@@ -30,122 +30,101 @@
 from flask import Blueprint, Response, abort, current_app, redirect, \
         render_template, request, url_for
 from feedgen.feed import FeedGenerator
-from sqlalchemy import or_
+from sqlalchemy import func, or_
+from sqlalchemy.orm import defer, selectinload
 from werkzeug.exceptions import NotFound
 
 import pytz
 
-from akamatsu import md as markdown
-from akamatsu.models import Post, Role, User, user_posts, user_roles
+from akamatsu import db, feed_cache, response_cache, search_index
+from akamatsu.models import FEED_VERSION, CacheVersion, Page, Post, Role, \
+        User, user_posts, user_roles
+from akamatsu.util import KeysetPagination, OffsetPagination
 
 
 bp_blog = Blueprint('blog', __name__)
 
 
+# Listings only show the summary, so avoid loading the full content. Authors
+# and tags of all the posts in a page are loaded in one query each.
+_LISTING_OPTIONS = (
+    defer(Post.content),
+    defer(Post.content_html),
+    selectinload(Post.authors),
+    selectinload(Post.tags)
+)
+
+
 @bp_blog.route('/_rss')
 def feed():
-    """Generate a RSS feed for the blog."""
-    fg = FeedGenerator()
+    """Generate a RSS feed for the blog.
 
-    fg.id(url_for('blog.index', _external=True))
-    fg.title('{} feed'.format(current_app.config['SITENAME']))
-    fg.description('{} feed'.format(current_app.config['SITENAME']))
-    fg.author({'name': current_app.config['SITENAME']})
-    fg.link(href=url_for('blog.index', _external=True), rel='alternate')
-    # fg.logo('http://ex.com/logo.jpg')
-    fg.link(href=url_for('blog.feed', _external=True), rel='self')
-    fg.language(current_app.config['LOCALE'])
-
-    # Add contributors
-    users = (
-        User.query
-        .join(user_roles)
-        .join(Role)
-        .filter(User.is_active == True)
-        .filter(
-            or_(
-                Role.name == 'administrator',
-                Role.name == 'blogger'
-            )
-        )
+    The serialized feed is cached in-process and validators (`ETag` and
+    `Last-Modified`) are derived from the newest published post and the
+    version stamp of the feed (bumped whenever posts or users change), so
+    that conditional requests can be answered with a single aggregate query.
+    """
+    stamp = db.session.query(CacheVersion).filter(
+        CacheVersion.name == FEED_VERSION
     )
 
-    contributors = []
-
-    for user in users:
-        name = user.username
-
-        if user.first_name and user.last_name:
-            name = '{} {}'.format(user.first_name, user.last_name)
-
-        contributors.append({
-            'name': name,
-            #'email': user.email
-        })
-
-    fg.contributor = contributors
-
-    # Add entries
-    posts = (
-        Post.query
-        .filter_by(is_published=True)
-        .filter_by(ghosted_id=None)
-        .order_by(Post.last_updated.desc())
-        .limit(15)
+    newest, count, version, changed_at = (
+        db.session.query(
+            func.max(Post.last_updated),
+            func.count(Post.id),
+            stamp.with_entities(CacheVersion.version).as_scalar(),
+            stamp.with_entities(CacheVersion.changed_at).as_scalar()
+        )
+        .filter(Post.is_published == True)
+        .filter(Post.ghosted_id == None)
+    ).one()
+
+    etag = '{}-{}-{}'.format(
+        newest.strftime('%Y%m%d%H%M%S%f') if newest else 0,
+        count,
+        version or 0
     )
 
-    for post in posts:
-        # Unicode conversion is needed for the content
-        entry = fg.add_entry()
+    # Edits do not always change the date of the posts
+    last_modified = max(filter(None, (newest, changed_at)), default=None)
 
-        entry.id(url_for('blog.show', slug=post.slug, _external=True))
-        entry.link(href=url_for('blog.show', slug=post.slug, _external=True))
-        entry.title(post.title)
-        entry.updated(pytz.utc.localize(post.last_updated))
-        entry.description(
-            description=markdown.render(
-                post.content.split('<!--aka-break-->')[0]
-            ).unescape(),
-            isSummary=True
-        )
-        entry.content(
-            content=markdown.render(post.content).unescape(),
-            type='html'
-        )
+    if _feed_not_modified(etag, last_modified):
+        response = Response(status=304)
 
-        authors = []
+    else:
+        cache_key = (etag, request.url_root)
+        rss = feed_cache.get(cache_key)
 
-        for author in post.authors:
-            name = author.username
+        if rss is None:
+            rss = _generate_feed()
+            feed_cache.set(cache_key, rss)
 
-            if author.first_name and author.last_name:
-                name = '{} {}'.format(author.first_name, author.last_name)
+        response = Response(rss, mimetype='text/xml')
 
-            authors.append({
-                'name': name,
-                'email': author.email
-            })
+    response.set_etag(etag)
 
-        entry.author(authors)
+    if last_modified:
+        response.last_modified = last_modified
 
-    return Response(fg.rss_str(), mimetype='text/xml')
+    return response
 
 
 @bp_blog.route('/')
+@response_cache.cached
 def index():
     """Show the list of published posts.
 
     Args:
         page (int): Page to show.
+        cursor (str): Cursor of the page to show (see `_paginate()`).
     """
-    page = request.args.get('page', 1, int)
+    response_cache.tag('listing:index')
 
-    posts = (
+    posts = _paginate(
         Post.query
         .filter_by(is_published=True)
         .filter_by(ghosted_id=None)
-        .order_by(Post.last_updated.desc())
-        .paginate(page, current_app.config['PAGE_ITEMS'], False)
+        .options(*_LISTING_OPTIONS)
     )
 
     try:
@@ -157,22 +136,23 @@ def index():
 
 
 @bp_blog.route('/tagged/<tag>')
+@response_cache.cached
 def tagged(tag):
     """Display posts tagged with the given tag.
 
     Args:
         tag (str): Tag name.
         page (int): Page to show.
+        cursor (str): Cursor of the page to show (see `_paginate()`).
     """
-    page = request.args.get('page', 1, int)
+    response_cache.tag('listing:tag:{}'.format(tag))
 
-    posts = (
+    posts = _paginate(
         Post.query
         .filter(Post.tags.any(name=tag))
         .filter_by(is_published=True)
         .filter_by(ghosted_id=None)
-        .order_by(Post.last_updated.desc())
-        .paginate(page, current_app.config['PAGE_ITEMS'], False)
+        .options(*_LISTING_OPTIONS)
     )
 
     try:
@@ -184,6 +164,7 @@ def tagged(tag):
 
 
 @bp_blog.route('/by/<username>')
+@response_cache.cached
 def by_user(username):
     """Display posts written by the given user.
 
@@ -192,18 +173,18 @@ def by_user(username):
     Args:
         username (str): Username of the author.
         page (int): Page to show.
+        cursor (str): Cursor of the page to show (see `_paginate()`).
     """
-    page = request.args.get('page', 1, int)
+    response_cache.tag('listing:user:{}'.format(username))
 
-    posts = (
+    posts = _paginate(
         Post.query
         .join(user_posts)
         .join(User)
         .filter(Post.is_published==True)
         .filter(Post.ghosted_id==None)
         .filter(User.username==username)
-        .order_by(Post.last_updated.desc())
-        .paginate(page, current_app.config['PAGE_ITEMS'], False)
+        .options(*_LISTING_OPTIONS)
     )
 
     try:
@@ -214,7 +195,61 @@ def by_user(username):
         return render_template('blog/index.html', username=username)
 
 
+@bp_blog.route('/search')
+def search():
+    """Search published posts and pages.
+
+    Results are not cached, as they depend on arbitrary query strings.
+
+    Args:
+        q (str): Text to search for.
+        page (int): Page of results to show.
+    """
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, int), 1)
+    per_page = current_app.config['PAGE_ITEMS']
+
+    hits, has_next = search_index.search(
+        db.session.connection(),
+        query,
+        page,
+        per_page
+    )
+
+    # Load the matched posts and pages (one query each)
+    ids = {'post': [], 'page': []}
+
+    for hit in hits:
+        ids[hit.kind].append(hit.item_id)
+
+    documents = {}
+
+    if ids['post']:
+        for post in Post.query.filter(Post.id.in_(ids['post'])).options(
+                defer(Post.content), defer(Post.content_html)):
+            documents[('post', post.id)] = post
+
+    if ids['page']:
+        for page_ in Page.query.filter(Page.id.in_(ids['page'])).options(
+                defer(Page.content), defer(Page.content_html)):
+            documents[('page', page_.id)] = page_
+
+    # Skip documents removed since the index was queried
+    results = [
+        (hit, documents[(hit.kind, hit.item_id)])
+        for hit in hits
+        if (hit.kind, hit.item_id) in documents
+    ]
+
+    return render_template(
+        'blog/search.html',
+        query=query,
+        results=OffsetPagination(results, page, per_page, None, has_next)
+    )
+
+
 @bp_blog.route('/<slug>')
+@response_cache.cached
 def show(slug):
     """Show the contents of a specific post.
 
@@ -242,4 +277,176 @@ def show(slug):
 
         return redirect(url_for('blog.show', slug=ghosted.slug))
 
+    response_cache.tag(*post.cache_tags)
+
     return render_template('blog/show.html', post=post)
+
+
+def _paginate(query):
+    """Paginate a listing of posts, newest first.
+
+    Cursor (keyset) pagination is used when the `cursor` query parameter is
+    present, or when the `BLOG_CURSOR_PAGINATION` configuration parameter is
+    enabled and no page number was requested. Otherwise, page numbers are
+    used so that existing `?page=` URLs keep working.
+
+    Args:
+        query: Query of the posts to list.
+
+    Returns:
+        Pagination object.
+    """
+    per_page = current_app.config['PAGE_ITEMS']
+    cursor = request.args.get('cursor')
+
+    use_cursor = cursor is not None or (
+        current_app.config.get('BLOG_CURSOR_PAGINATION', False)
+        and 'page' not in request.args
+    )
+
+    if use_cursor:
+        try:
+            pagination = KeysetPagination(
+                query,
+                Post.last_updated,
+                Post.id,
+                cursor=cursor,
+                per_page=per_page
+            )
+
+        except ValueError:
+            # Invalid cursor
+            abort(404)
+
+    else:
+        page = request.args.get('page', 1, int)
+
+        pagination = (
+            query
+            .order_by(Post.last_updated.desc())
+            .paginate(page, per_page, False)
+        )
+
+    # Listed posts show their summary, tags and authors
+    if response_cache.enabled:
+        for post in pagination.items:
+            response_cache.tag(*post.cache_tags)
+
+    return pagination
+
+
+def _feed_not_modified(etag, newest):
+    """Check the conditional headers of a feed request.
+
+    Args:
+        etag (str): Current ETag of the feed.
+        newest (datetime): Date of the last change of the feed (UTC).
+
+    Returns:
+        `True` if the client already has the current feed.
+    """
+    if request.if_none_match:
+        # Takes precedence over the modification date
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+
+    if since is None or newest is None:
+        return False
+
+    if since.tzinfo:
+        since = since.astimezone(pytz.utc).replace(tzinfo=None)
+
+    # HTTP dates have a resolution of seconds
+    return newest.replace(microsecond=0) <= since
+
+
+def _generate_feed():
+    """Build the RSS feed for the blog.
+
+    Returns:
+        Serialized feed.
+    """
+    fg = FeedGenerator()
+
+    fg.id(url_for('blog.index', _external=True))
+    fg.title('{} feed'.format(current_app.config['SITENAME']))
+    fg.description('{} feed'.format(current_app.config['SITENAME']))
+    fg.author({'name': current_app.config['SITENAME']})
+    fg.link(href=url_for('blog.index', _external=True), rel='alternate')
+    # fg.logo('http://ex.com/logo.jpg')
+    fg.link(href=url_for('blog.feed', _external=True), rel='self')
+    fg.language(current_app.config['LOCALE'])
+
+    # Add contributors
+    users = (
+        User.query
+        .join(user_roles)
+        .join(Role)
+        .filter(User.is_active == True)
+        .filter(
+            or_(
+                Role.name == 'administrator',
+                Role.name == 'blogger'
+            )
+        )
+    )
+
+    contributors = []
+
+    for user in users:
+        name = user.username
+
+        if user.first_name and user.last_name:
+            name = '{} {}'.format(user.first_name, user.last_name)
+
+        contributors.append({
+            'name': name,
+            #'email': user.email
+        })
+
+    fg.contributor = contributors
+
+    # Add entries
+    posts = (
+        Post.query
+        .filter_by(is_published=True)
+        .filter_by(ghosted_id=None)
+        .options(defer(Post.content), selectinload(Post.authors))
+        .order_by(Post.last_updated.desc())
+        .limit(15)
+    )
+
+    for post in posts:
+        # Unicode conversion is needed for the content
+        entry = fg.add_entry()
+
+        entry.id(url_for('blog.show', slug=post.slug, _external=True))
+        entry.link(href=url_for('blog.show', slug=post.slug, _external=True))
+        entry.title(post.title)
+        entry.updated(pytz.utc.localize(post.last_updated))
+        entry.description(
+            description=post.summary.unescape(),
+            isSummary=True
+        )
+        entry.content(
+            content=post.html.unescape(),
+            type='html'
+        )
+
+        authors = []
+
+        for author in post.authors:
+            name = author.username
+
+            if author.first_name and author.last_name:
+                name = '{} {}'.format(author.first_name, author.last_name)
+
+            authors.append({
+                'name': name,
+                'email': author.email
+            })
+
+        entry.author(authors)
+
+    return fg.rss_str()
@@ -29,10 +29,14 @@
 
 import os
 
-from flask import Blueprint, current_app, make_response, send_from_directory
+from flask import Blueprint, current_app, make_response, request, send_file, \
+        send_from_directory
+from werkzeug.urls import url_quote
 from werkzeug.utils import secure_filename
 
-from akamatsu.models import FileUpload
+from akamatsu.images import FORMAT_MIMES, SOURCE_FORMATS, select_variant
+from akamatsu.models import FINGERPRINT_LENGTH, FileUpload
+from akamatsu.storage import resolve_upload, uploads_root
 
 
 bp_common = Blueprint('common', __name__)
@@ -42,18 +46,114 @@ bp_common = Blueprint('common', __name__)
 def serve_file(filename):
     """Serve the given uploaded file.
 
+    Files can also be requested through a fingerprinted URL, in which the
+    path is prefixed with the fingerprint of the contents (see
+    `FileUpload.fingerprint`). As these URLs change with the contents,
+    responses to them may be cached for a year.
+
+    The way the file is sent depends on the `UPLOADS_SENDFILE`
+    configuration parameter:
+
+    - `None` (default): the file is sent by the application. The WSGI
+        server's file wrapper is used when available (e.g. gunicorn uses
+        `sendfile()` for it).
+    - `'x-accel-redirect'`: nginx sends the file from the internal location
+        set in `UPLOADS_ACCEL_PREFIX` (defaults to `/_protected_uploads/`),
+        which must be an alias of the uploads directory.
+    - `'x-sendfile'`: Apache (mod_xsendfile) or lighttpd send the file from
+        its absolute path.
+
+    For images, a resized or converted variant (see `akamatsu.images`) is
+    served if available, selected with the `w` (width) and `fmt` (format)
+    query parameters. If no format is requested, the best format accepted
+    by the client is used.
+
     Args:
-        filename (str): Relative file path.
+        filename (str): Relative file path, optionally prefixed with the
+            fingerprint of the file.
+        w (int): Requested width of an image.
+        fmt (str): Requested format of an image.
     """
-    fupload = FileUpload.get_by_path(filename)
+    fupload, immutable = _get_upload(filename)
 
     if not fupload:
         return make_response('', 404)
 
-    return send_from_directory(
-        current_app.config['UPLOADS_PATH'],
-        filename,
-        mimetype=fupload.mime
+    file_path = resolve_upload(fupload)
+
+    if file_path is None:
+        return make_response('', 404)
+
+    mimetype = fupload.mime
+    etag = fupload.content_hash
+    negotiated = fupload.mime in SOURCE_FORMATS and 'fmt' not in request.args
+
+    variant = select_variant(
+        fupload,
+        width=request.args.get('w', type=int),
+        fmt=request.args.get('fmt'),
+        accept=request.accept_mimetypes
+    )
+
+    if variant:
+        file_path, fmt = variant
+        mimetype = FORMAT_MIMES[fmt]
+        etag = '{}-{}'.format(etag, os.path.basename(file_path))
+
+    mode = current_app.config.get('UPLOADS_SENDFILE')
+
+    if not mode:
+        response = send_file(
+            file_path,
+            mimetype=mimetype,
+            add_etags=False,
+            conditional=False
+        )
+
+    else:
+        response = current_app.response_class(mimetype=mimetype)
+        response.cache_control.public = True
+        response.cache_control.max_age = \
+            current_app.get_send_file_max_age(file_path)
+
+        if mode == 'x-accel-redirect':
+            prefix = current_app.config.get(
+                'UPLOADS_ACCEL_PREFIX',
+                '/_protected_uploads/'
+            )
+
+            response.headers['X-Accel-Redirect'] = (
+                prefix.rstrip('/') + '/'
+                + url_quote(os.path.relpath(file_path, uploads_root()), safe='/')
+            )
+
+        elif mode == 'x-sendfile':
+            response.headers['X-Sendfile'] = file_path
+
+        else:
+            raise ValueError('Invalid uploads sendfile mode: {}'.format(mode))
+
+    if negotiated:
+        response.vary.add('Accept')
+
+    # Validators
+    if etag:
+        response.set_etag(etag)
+
+    response.last_modified = fupload.uploaded_at
+
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.expires = None
+
+    if mode:
+        # Ranges are handled by the web server
+        return response.make_conditional(request)
+
+    return response.make_conditional(
+        request,
+        accept_ranges=True,
+        complete_length=os.path.getsize(file_path)
     )
 
 
@@ -92,3 +192,30 @@ def favicon_extras(filename):
         return make_response('', 404)
 
     return send_from_directory(fav_path, secure_filename(filename))
+
+
+def _get_upload(filename):
+    """Obtain the upload requested through a plain or fingerprinted path.
+
+    Args:
+        filename (str): Requested path.
+
+    Returns:
+        Tuple with the `FileUpload` instance (`None` if not found) and a
+        flag indicating whether the path was fingerprinted.
+    """
+    fupload = FileUpload.get_by_path(filename)
+
+    if fupload:
+        return fupload, False
+
+    fingerprint, _sep, path = filename.partition('/')
+
+    if path and len(fingerprint) == FINGERPRINT_LENGTH:
+        fupload = FileUpload.get_by_path(path)
+
+        if fupload and fupload.fingerprint == fingerprint:
+            return fupload, True
+
+    return None, False
+
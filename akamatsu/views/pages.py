@@ -29,6 +29,7 @@
 
 from flask import Blueprint, abort, redirect, render_template, url_for
 
+from akamatsu import page_routes, response_cache
 from akamatsu.models import Page
 
 
@@ -36,18 +37,18 @@ bp_pages = Blueprint('pages', __name__)
 
 
 @bp_pages.route('/')
+@response_cache.cached
 def root():
     """Load the root page."""
-    page = (
-        Page.query
-        .filter_by(route='/')
-        .filter_by(is_published=True)
-    ).first_or_404()
+    page = _get_published_page(page_routes.lookup('/'))
+
+    response_cache.tag(*page.cache_tags)
 
     return render_template('pages/show.html', page=page)
 
 
 @bp_pages.route('/<path:route>')
+@response_cache.cached
 def show(route):
     """Show the page identified by the given route.
 
@@ -55,27 +56,45 @@ def show(route):
         route (path): Route to the page.
     """
     # Mind root slash
-    route = '/' + route
-
-    page = (
-        Page.query
-        .filter_by(route=route)
-        .filter_by(is_published=True)
-    ).first_or_404()
-
-    # Check ghost redirection
-    if page.ghosted_id is not None:
-        if page.ghosted_id == page.id:
-            # Prevent loops
+    entry = page_routes.lookup('/' + route)
+
+    # Check ghost redirection (chains and loops are resolved by the table)
+    if entry is not None and entry.is_published and entry.is_ghost:
+        if entry.target is None:
             abort(404)
 
-        # Only published pages are allowed
-        ghosted = (
-            Page.query
-            .filter_by(id=page.ghosted_id)
-            .filter_by(is_published=True)
-        ).first_or_404()
+        if entry.target == '/':
+            return redirect(url_for('pages.root'))
+
+        # Mind root slash
+        return redirect(url_for('pages.show', route=entry.target[1:]))
+
+    page = _get_published_page(entry)
 
-        return redirect(url_for('pages.show', route=ghosted.route))
+    response_cache.tag(*page.cache_tags)
 
     return render_template('pages/show.html', page=page)
+
+
+def _get_published_page(entry):
+    """Load the page of a route table entry.
+
+    Args:
+        entry (PageRoute): Entry obtained from the route table.
+
+    Returns:
+        `Page` instance.
+
+    Raises:
+        `NotFound` if the page does not exist or is not published.
+    """
+    if entry is None or not entry.is_published:
+        abort(404)
+
+    page = Page.query.get(entry.id)
+
+    # The table of this process may be outdated
+    if page is None or not page.is_published:
+        abort(404)
+
+    return page
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the benchmark commands."""
+
+import json
+
+from flask.cli import AppGroup
+
+from akamatsu import db
+from akamatsu.backup import BackupImporter
+from benchmarks.runner import build_scenarios, compare, run
+from benchmarks.seed import generate
+
+import click
+
+
+@click.group(cls=AppGroup)
+def bench():
+    """Benchmark commands."""
+    pass
+
+
+@bench.command()
+@click.option('--users', default=10, show_default=True, help='Number of users')
+@click.option('--posts', default=1000, show_default=True, help='Number of posts')
+@click.option('--pages', default=50, show_default=True, help='Number of pages')
+@click.option('--uploads', default=100, show_default=True, help='Number of uploads')
+@click.option('--tags', default=50, show_default=True, help='Number of distinct tags')
+@click.option(
+    '--ghosts',
+    default=0.05,
+    show_default=True,
+    type=click.FloatRange(0, 1),
+    help='Fraction of posts and pages which are ghosts'
+)
+@click.option('--seed', default=0, show_default=True, help='Random seed')
+def seed(users, posts, pages, uploads, tags, ghosts, seed):
+    """Fill the database with synthetic content.
+
+    The database should be empty (apart from the roles created by the
+    migrations), as generated names are the same for a given seed.
+    """
+    if not click.confirm('Do you want to add synthetic content to the database?'):
+        click.echo('Operation cancelled')
+        return
+
+    importer = BackupImporter(echo=click.echo)
+
+    try:
+        correct = True
+
+        importer.run(generate(
+            users=users,
+            posts=posts,
+            pages=pages,
+            uploads=uploads,
+            tags=tags,
+            ghosts=ghosts,
+            seed=seed
+        ))
+
+        db.session.commit()
+
+    except Exception as e:
+        correct = False
+
+        click.echo('Error seeding database')
+        click.echo(e)
+
+        return
+
+    finally:
+        if not correct:
+            db.session.rollback()
+
+    importer.invalidate_caches()
+
+    click.echo('Generated {} entities in {:.1f}s'.format(
+        importer.total,
+        importer.elapsed
+    ))
+
+
+@bench.command(name='run')
+@click.option(
+    '--requests',
+    default=50,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Measured requests per scenario'
+)
+@click.option(
+    '--warmup',
+    default=5,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help='Requests per scenario before measuring'
+)
+@click.option(
+    '--scenario',
+    'names',
+    multiple=True,
+    help='Only run scenarios whose name starts with this (can be repeated)'
+)
+@click.option('--output', type=click.Path(), help='Write the results to a JSON file')
+@click.option(
+    '--baseline',
+    type=click.Path(exists=True),
+    help='Compare the results against a JSON file'
+)
+@click.option(
+    '--threshold',
+    default=0.1,
+    show_default=True,
+    help='Allowed p95 slowdown relative to the baseline'
+)
+def run_benchmarks(requests, warmup, names, output, baseline, threshold):
+    """Measure the response times of the main views.
+
+    Exits with status 1 if any scenario regressed with respect to the
+    baseline.
+    """
+    scenarios = build_scenarios()
+
+    if names:
+        scenarios = [
+            s for s in scenarios
+            if any(s.name.startswith(name) for name in names)
+        ]
+
+    try:
+        results = run(scenarios, requests=requests, warmup=warmup, echo=click.echo)
+
+    except RuntimeError as e:
+        click.echo('Error running benchmarks: {}'.format(e))
+        raise SystemExit(1)
+
+    click.echo('RSS: {start} MB at start, {end} MB at end, {peak} MB peak'.format(
+        **{k: '{:.1f}'.format(v) if v is not None else '-' for k, v in results['rss_mb'].items()}
+    ))
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        click.echo('Results written to {}'.format(output))
+
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as f:
+            lines, regressions = compare(json.load(f), results, threshold)
+
+        click.echo('\n'.join(lines))
+
+        if regressions:
+            click.echo('{} scenarios regressed'.format(len(regressions)))
+            raise SystemExit(1)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the benchmark runner.
+
+Each scenario is a set of URLs requested in turn through the Flask test
+client. For every scenario, the runner reports the percentiles of the
+response times and the average number of SQL statements per request, as
+well as the memory (RSS) of the process.
+
+Results are plain dictionaries which can be stored as JSON and compared
+against a baseline.
+"""
+
+from collections import Counter, namedtuple
+import datetime
+import os
+import platform
+import resource
+import time
+
+from flask import current_app, url_for
+from sqlalchemy import event, func
+
+from akamatsu import db, login_manager
+from akamatsu.models import FileUpload, Page, Post, Tag, User, post_tags
+from akamatsu.util import KeysetPagination
+
+
+# Version of the results format
+RESULTS_VERSION = 1
+
+# Headers of AJAX requests for admin page listings
+_AJAX_HEADERS = {'x-akamatsu-partial': 'true'}
+
+Scenario = namedtuple('Scenario', ['name', 'urls', 'headers', 'admin'])
+
+
+def build_scenarios(sample=20):
+    """Build the scenarios from the contents of the database.
+
+    Must be called within an application context.
+
+    Args:
+        sample (int): Maximum number of distinct URLs per scenario.
+
+    Returns:
+        List of `Scenario` instances.
+    """
+    per_page = current_app.config['PAGE_ITEMS']
+
+    published = (
+        Post.query
+        .filter(Post.is_published == True)
+        .filter(Post.ghosted_id == None)
+    )
+    total = published.count()
+    deep_page = max(1, int(total / per_page * 0.9))
+
+    # Post right before the deep page, to seek from it
+    seek = (
+        published
+        .order_by(Post.last_updated.desc(), Post.id.desc())
+        .offset((deep_page - 1) * per_page - 1 if deep_page > 1 else 0)
+        .first()
+    )
+
+    slugs = [
+        slug for slug, in
+        published.with_entities(Post.slug).order_by(Post.id).limit(sample)
+    ]
+    routes = [
+        route for route, in
+        db.session.query(Page.route)
+        .filter(Page.is_published == True)
+        .filter(Page.ghosted_id == None)
+        .order_by(Page.id)
+        .limit(sample)
+    ]
+    paths = [
+        path for path, in
+        db.session.query(FileUpload.path).order_by(FileUpload.id).limit(sample)
+    ]
+    tags = [
+        name for name, _ in
+        db.session.query(Tag.name, func.count(post_tags.c.post_id))
+        .join(post_tags, post_tags.c.tag_id == Tag.id)
+        .group_by(Tag.name)
+        .order_by(func.count(post_tags.c.post_id).desc())
+        .limit(3)
+    ]
+
+    with current_app.test_request_context():
+        scenarios = [
+            Scenario('blog.index', [url_for('blog.index')], {}, False),
+            Scenario(
+                'blog.index (deep page)',
+                [url_for('blog.index', page=deep_page)],
+                {},
+                False
+            ),
+            Scenario('blog.feed', [url_for('blog.feed')], {}, False),
+        ]
+
+        if seek and deep_page > 1:
+            cursor = KeysetPagination._encode(
+                KeysetPagination._NEXT,
+                seek.last_updated,
+                seek.id
+            )
+            scenarios.append(Scenario(
+                'blog.index (deep cursor)',
+                [url_for('blog.index', cursor=cursor)],
+                {},
+                False
+            ))
+
+        if tags:
+            scenarios.append(Scenario(
+                'blog.tagged',
+                [url_for('blog.tagged', tag=tag) for tag in tags],
+                {},
+                False
+            ))
+
+        if slugs:
+            scenarios.append(Scenario(
+                'blog.show',
+                [url_for('blog.show', slug=slug) for slug in slugs],
+                {},
+                False
+            ))
+
+        if routes:
+            scenarios.append(Scenario(
+                'pages.show',
+                [url_for('pages.show', route=route.lstrip('/')) for route in routes],
+                {},
+                False
+            ))
+
+        if paths:
+            scenarios.append(Scenario(
+                'common.serve_file',
+                [url_for('common.serve_file', filename=path) for path in paths],
+                {},
+                False
+            ))
+
+        for endpoint in (
+                'admin.home', 'admin.post_index', 'admin.post_ghosts',
+                'admin.page_index', 'admin.page_ghosts', 'admin.file_index',
+                'admin.user_index'):
+            scenarios.append(Scenario(endpoint, [url_for(endpoint)], {}, True))
+
+            if endpoint != 'admin.home':
+                scenarios.append(Scenario(
+                    '{} (ajax)'.format(endpoint),
+                    [url_for(endpoint, page=2)],
+                    _AJAX_HEADERS,
+                    True
+                ))
+
+    return scenarios
+
+
+def run(scenarios, requests=50, warmup=5, echo=print):
+    """Run the scenarios.
+
+    Must be called within an application context.
+
+    Args:
+        scenarios (list): `Scenario` instances to run.
+        requests (int): Number of measured requests per scenario.
+        warmup (int): Number of requests per scenario before measuring.
+        echo: Function used to report progress.
+
+    Returns:
+        Dictionary with the results.
+
+    Raises:
+        `RuntimeError` if a request does not return `200 OK` (e.g. when
+        the administrator is redirected to the login page).
+    """
+    app = current_app._get_current_object()
+    admin = (
+        User.query
+        .filter(User.roles.any(name='administrator'))
+        .order_by(User.id)
+        .first()
+    )
+
+    anonymous = app.test_client()
+    authenticated = app.test_client()
+
+    if admin:
+        # Identifier checked by strong session protection
+        with app.test_request_context(environ_base=authenticated.environ_base):
+            identifier = login_manager._session_identifier_generator()
+
+        with authenticated.session_transaction() as session:
+            session['_user_id'] = str(admin.id)
+            session['_fresh'] = True
+            session['_id'] = identifier
+
+    queries = [0]
+
+    def _count_query(*args):
+        queries[0] += 1
+
+    event.listen(db.engine, 'after_cursor_execute', _count_query)
+
+    rss_start = _current_rss()
+    results = {}
+
+    try:
+        for scenario in scenarios:
+            if scenario.admin and not admin:
+                echo('Skipping {} (no administrator)'.format(scenario.name))
+                continue
+
+            client = authenticated if scenario.admin else anonymous
+            timings = []
+            statuses = Counter()
+            queries[0] = 0
+
+            for i in range(warmup + requests):
+                url = scenario.urls[i % len(scenario.urls)]
+
+                if i == warmup:
+                    queries[0] = 0
+
+                start = time.perf_counter()
+                response = client.get(url, headers=scenario.headers)
+                response.get_data()
+                elapsed = time.perf_counter() - start
+
+                if response.status_code != 200:
+                    raise RuntimeError('{} returned {} for {}'.format(
+                        scenario.name,
+                        response.status_code,
+                        url
+                    ))
+
+                if i >= warmup:
+                    timings.append(elapsed)
+                    statuses[str(response.status_code)] += 1
+
+            timings.sort()
+
+            results[scenario.name] = {
+                'urls': scenario.urls,
+                'p50_ms': _percentile(timings, 50) * 1000,
+                'p95_ms': _percentile(timings, 95) * 1000,
+                'p99_ms': _percentile(timings, 99) * 1000,
+                'mean_ms': sum(timings) / len(timings) * 1000,
+                'queries': queries[0] / requests,
+                'statuses': dict(statuses)
+            }
+
+            echo('{:<32} p50 {:8.2f}ms  p95 {:8.2f}ms  p99 {:8.2f}ms  {:6.1f} queries'.format(
+                scenario.name,
+                results[scenario.name]['p50_ms'],
+                results[scenario.name]['p95_ms'],
+                results[scenario.name]['p99_ms'],
+                results[scenario.name]['queries']
+            ))
+
+    finally:
+        event.remove(db.engine, 'after_cursor_execute', _count_query)
+
+    return {
+        'version': RESULTS_VERSION,
+        'created_at': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'database': db.engine.dialect.name,
+        'requests': requests,
+        'warmup': warmup,
+        'config': {
+            key: app.config.get(key)
+            for key in (
+                'PAGE_ITEMS', 'RESPONSE_CACHE_TYPE', 'BLOG_CURSOR_PAGINATION',
+                'MARKDOWN_CACHE_SIZE', 'LOGIN_CACHE_TTL', 'METRICS_ENABLED'
+            )
+        },
+        'rss_mb': {
+            'start': rss_start,
+            'end': _current_rss(),
+            'peak': _peak_rss()
+        },
+        'scenarios': results
+    }
+
+
+def compare(baseline, results, threshold=0.1):
+    """Compare results against a baseline.
+
+    A scenario regresses when its 95th percentile is slower than the
+    baseline by more than the threshold, or when it executes more queries.
+
+    Args:
+        baseline (dict): Baseline results.
+        results (dict): Results to compare.
+        threshold (float): Allowed relative slowdown (e.g. 0.1 for 10%).
+
+    Returns:
+        Tuple with a list of report lines and a list of the names of the
+        scenarios which regressed.
+    """
+    lines = ['{:<32} {:>12} {:>12} {:>8} {:>14}'.format(
+        'Scenario', 'Base p95', 'p95', 'Change', 'Queries'
+    )]
+    regressions = []
+
+    for name, current in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+
+        if base is None:
+            lines.append('{:<32} {:>12} {:>10.2f}ms'.format(name, '-', current['p95_ms']))
+            continue
+
+        change = (
+            (current['p95_ms'] - base['p95_ms']) / base['p95_ms']
+            if base['p95_ms'] else 0
+        )
+        regressed = change > threshold or current['queries'] > base['queries']
+
+        if regressed:
+            regressions.append(name)
+
+        lines.append('{:<32} {:>10.2f}ms {:>10.2f}ms {:>+7.1f}% {:>6.1f} -> {:<5.1f}{}'.format(
+            name,
+            base['p95_ms'],
+            current['p95_ms'],
+            change * 100,
+            base['queries'],
+            current['queries'],
+            ' !' if regressed else ''
+        ))
+
+    return lines, regressions
+
+
+def _percentile(values, percent):
+    """Obtain a percentile of sorted values (with linear interpolation).
+
+    Args:
+        values (list): Sorted values.
+        percent (float): Percentile to obtain (0-100).
+
+    Returns:
+        Percentile value or 0 if there are no values.
+    """
+    if not values:
+        return 0
+
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _current_rss():
+    """Obtain the current resident memory of the process in MB.
+
+    Returns:
+        Memory in MB or `None` if it cannot be obtained (non-Linux systems).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def _peak_rss():
+    """Obtain the peak resident memory of the process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in bytes in macOS and in kilobytes elsewhere
+    if platform.system() == 'Darwin':
+        return peak / 1024 / 1024
+
+    return peak / 1024
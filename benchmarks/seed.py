@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""This file contains the generator of synthetic content.
+
+Content is generated as backup lines (see `akamatsu.backup`), so that it is
+inserted through the same bulk importer used by `flask data import`. The
+generator is deterministic for a given seed.
+"""
+
+import datetime
+import io
+import json
+import random
+import struct
+import zlib
+
+from akamatsu import crypto_manager
+from akamatsu.backup import DATE_FORMAT
+from akamatsu.models import SUMMARY_BREAK
+from akamatsu.storage import save_blob
+
+
+# Words used to generate text
+WORDS = (
+    'akamatsu', 'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+    'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor', 'incididunt',
+    'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim',
+    'veniam', 'quis', 'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi',
+    'aliquip', 'ex', 'ea', 'commodo', 'consequat', 'duis', 'aute', 'irure',
+    'in', 'reprehenderit', 'voluptate', 'velit', 'esse', 'cillum', 'fugiat',
+    'nulla', 'pariatur', 'excepteur', 'sint', 'occaecat', 'cupidatat', 'non',
+    'proident', 'sunt', 'culpa', 'qui', 'officia', 'deserunt', 'mollit',
+    'anim', 'id', 'est', 'laborum'
+)
+
+# Code blocks included in generated content
+CODE_BLOCKS = (
+    ('python', 'def fibonacci(n):\n    a, b = 0, 1\n\n    for _ in range(n):\n'
+               '        a, b = b, a + b\n\n    return a\n\nprint(fibonacci(10))'),
+    ('javascript', 'function debounce(fn, wait) {\n    var timeout;\n\n'
+                   '    return function() {\n        clearTimeout(timeout);\n'
+                   '        timeout = setTimeout(fn, wait);\n    };\n}'),
+    ('bash', 'for f in *.md; do\n    pandoc "$f" -o "${f%.md}.html"\ndone'),
+    ('sql', 'SELECT p.title, COUNT(t.id)\nFROM posts p\n'
+            'JOIN post_tags t ON t.post_id = p.id\nGROUP BY p.id;')
+)
+
+# Date of the first generated entity
+_START_DATE = datetime.datetime(2015, 1, 1)
+
+
+def generate(users=10, posts=1000, pages=50, uploads=100, tags=50,
+             ghosts=0.05, seed=0):
+    """Generate synthetic content.
+
+    Uploaded files are written to the blob store while generating.
+
+    Args:
+        users (int): Number of users (the first one is an administrator and
+            the rest are bloggers).
+        posts (int): Number of posts.
+        pages (int): Number of pages.
+        uploads (int): Number of uploaded files.
+        tags (int): Number of distinct tags.
+        ghosts (float): Fraction of posts and pages which are ghosts.
+        seed (int): Seed of the random generator.
+
+    Yields:
+        Backup lines.
+    """
+    rng = random.Random(seed)
+
+    # Hashing is slow, so all the users share the same password
+    password = crypto_manager.hash('benchmark')
+    usernames = ['bench-user{}'.format(i) for i in range(users)]
+
+    for i, username in enumerate(usernames):
+        yield json.dumps({'entity': 'user', 'data': {
+            'username': username,
+            'password': password,
+            'reset_password_token': None,
+            'email': '{}@example.com'.format(username),
+            'is_active': True,
+            'first_name': _words(rng, 1).title(),
+            'last_name': _words(rng, 1).title(),
+            'personal_bio': _sentence(rng),
+            'notify_login': False,
+            'roles': ['administrator'] if i == 0 else ['blogger']
+        }})
+
+    routes = []
+
+    for i in range(pages):
+        route = '/bench/{}'.format(i)
+        is_ghost = bool(routes) and rng.random() < ghosts
+
+        yield json.dumps({'entity': 'page', 'data': {
+            'title': _words(rng, rng.randint(2, 6)).title(),
+            'mini': _words(rng, 1),
+            'route': route,
+            'custom_head': None,
+            'content': _markdown(rng),
+            'is_published': rng.random() < 0.9,
+            'comments_enabled': False,
+            'ghosted': rng.choice(routes) if is_ghost else None,
+            'last_updated': _date(rng, i).strftime(DATE_FORMAT)
+        }})
+
+        if not is_ghost:
+            routes.append(route)
+
+    tag_names = ['tag-{}'.format(_words(rng, 1)) + str(i) for i in range(tags)]
+    slugs = []
+
+    for i in range(posts):
+        slug = 'bench-post-{}'.format(i)
+        is_ghost = bool(slugs) and rng.random() < ghosts
+
+        yield json.dumps({'entity': 'post', 'data': {
+            'title': _words(rng, rng.randint(3, 10)).title(),
+            'slug': slug,
+            'content': _markdown(rng, summary=True),
+            'is_published': rng.random() < 0.95,
+            'comments_enabled': rng.random() < 0.5,
+            'last_updated': _date(rng, i).strftime(DATE_FORMAT),
+            'authors': rng.sample(usernames, min(len(usernames), rng.randint(1, 2))),
+            'ghosted': rng.choice(slugs) if is_ghost else None,
+            # Tags follow a long tail distribution
+            'tags': sorted({
+                tag_names[min(int(rng.paretovariate(1)) - 1, len(tag_names) - 1)]
+                for _ in range(rng.randint(0, 4))
+            }) if tag_names else []
+        }})
+
+        if not is_ghost:
+            slugs.append(slug)
+
+    for i in range(uploads):
+        if i % 2:
+            path = 'bench/{}.png'.format(i)
+            mime = 'image/png'
+            contents = _png(rng, rng.choice((64, 320, 800)), rng.choice((64, 240, 600)))
+
+        else:
+            path = 'bench/{}.txt'.format(i)
+            mime = 'text/plain'
+            contents = '\n\n'.join(
+                _paragraph(rng) for _ in range(rng.randint(1, 20))
+            ).encode('utf-8')
+
+        content_hash, _ = save_blob(io.BytesIO(contents))
+
+        yield json.dumps({'entity': 'upload', 'data': {
+            'path': path,
+            'description': _sentence(rng),
+            'mime': mime,
+            'uploaded_at': _date(rng, i).strftime(DATE_FORMAT),
+            'content_hash': content_hash
+        }})
+
+
+def _date(rng, index):
+    """Obtain an increasing date for the entity at the given index."""
+    return _START_DATE + datetime.timedelta(
+        hours=index * 6,
+        minutes=rng.randint(0, 300)
+    )
+
+
+def _words(rng, count):
+    """Obtain a number of random words."""
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def _sentence(rng):
+    """Obtain a random sentence."""
+    return _words(rng, rng.randint(5, 15)).capitalize() + '.'
+
+
+def _paragraph(rng):
+    """Obtain a random paragraph with some inline markup."""
+    sentences = [_sentence(rng) for _ in range(rng.randint(2, 6))]
+
+    if rng.random() < 0.5:
+        sentences.append('See [the docs](https://example.com/{}) for **{}**.'.format(
+            rng.choice(WORDS),
+            _words(rng, 2)
+        ))
+
+    if rng.random() < 0.3:
+        sentences.append('Use `{}()` with *care*.'.format(rng.choice(WORDS)))
+
+    return ' '.join(sentences)
+
+
+def _markdown(rng, summary=False):
+    """Obtain random markdown content.
+
+    Args:
+        rng: Random generator.
+        summary (bool): Whether to include the summary break marker.
+
+    Returns:
+        Markdown text.
+    """
+    blocks = [_paragraph(rng)]
+
+    if summary:
+        blocks.append(SUMMARY_BREAK)
+
+    for _ in range(rng.randint(2, 8)):
+        choice = rng.random()
+
+        if choice < 0.2:
+            blocks.append('## {}'.format(_words(rng, rng.randint(2, 5)).title()))
+
+        elif choice < 0.4:
+            lang, code = rng.choice(CODE_BLOCKS)
+            blocks.append('```{}\n{}\n```'.format(lang, code))
+
+        elif choice < 0.5:
+            blocks.append('\n'.join(
+                '- {}'.format(_words(rng, rng.randint(2, 8)))
+                for _ in range(rng.randint(2, 6))
+            ))
+
+        elif choice < 0.55:
+            blocks.append('| Name | Value |\n|------|-------|\n' + '\n'.join(
+                '| {} | {} |'.format(rng.choice(WORDS), rng.randint(0, 1000))
+                for _ in range(rng.randint(2, 5))
+            ))
+
+        else:
+            blocks.append(_paragraph(rng))
+
+    return '\n\n'.join(blocks)
+
+
+def _png(rng, width, height):
+    """Obtain a PNG image filled with a random vertical gradient.
+
+    Args:
+        rng: Random generator.
+        width (int): Width of the image.
+        height (int): Height of the image.
+
+    Returns:
+        Bytes of the image.
+    """
+    red, green, blue = (rng.randint(0, 255) for _ in range(3))
+
+    # Each row is filled with the same color to keep generation fast
+    rows = b''.join(
+        b'\x00' + bytes((red, (green + y) % 256, blue)) * width
+        for y in range(height)
+    )
+
+    def chunk(kind, data):
+        return (
+            struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+        )
+
+    return (
+        b'\x89PNG\r\n\x1a\n' +
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+        chunk(b'IDAT', zlib.compress(rows)) +
+        chunk(b'IEND', b'')
+    )
@@ -43,7 +43,7 @@ setup(
     classifiers=[],
     keywords='akamatsu cms flask web',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
 
     include_package_data=True,
     exclude_package_data={
@@ -79,6 +79,12 @@ setup(
             'celery>=4.4.0',
             'redis>=3.4.1'
         ],
+        'images': [
+            'Pillow>=7.0.0'
+        ],
+        'zstd': [
+            'zstandard>=0.15.0'
+        ],
         'dev': [
             'rcssmin==1.0.6',
             'Flask-DebugToolbar==0.11.0',
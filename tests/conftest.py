@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Fixtures shared by the tests.
+
+The application is created once, using `settings.py`, and each test gets
+an empty in-memory database (with the default roles) and a new uploads
+directory.
+"""
+
+import datetime
+import os
+import socketserver
+import threading
+
+import pytest
+
+os.environ['AKAMATSU_CONFIG'] = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'settings.py'
+)
+
+from sqlalchemy import event
+
+from akamatsu import db, feed_cache, identity_cache, init_app, \
+        login_manager, page_routes, search_index
+from akamatsu.models import Page, Post, Role, Tag, User
+
+
+# Roles created by the migrations
+ROLES = ('administrator', 'blogger', 'editor')
+
+
+@pytest.fixture(scope='session')
+def app():
+    """Application instance."""
+    return init_app()
+
+
+@pytest.fixture
+def database(app, tmp_path):
+    """Empty database (with the default roles) inside an app context."""
+    app.config['UPLOADS_PATH'] = str(tmp_path)
+
+    with app.app_context():
+        db.create_all()
+
+        for name in ROLES:
+            db.session.add(Role(name=name))
+
+        db.session.commit()
+
+        yield db
+
+        db.session.remove()
+        db.drop_all()
+
+    _reset_caches()
+
+
+@pytest.fixture
+def client(app, database):
+    """Test client (anonymous until `login()` is called)."""
+    return app.test_client()
+
+
+@pytest.fixture
+def queries(database):
+    """List of the SQL statements executed (can be cleared at any time)."""
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.engine
+    event.listen(engine, 'before_cursor_execute', _record)
+
+    yield statements
+
+    event.remove(engine, 'before_cursor_execute', _record)
+
+
+@pytest.fixture
+def smtp_server(app, monkeypatch):
+    """Local SMTP server which Flask-Mail sends the emails to."""
+    server = SMTPStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    state = app.extensions['mail']
+    monkeypatch.setattr(state, 'server', server.server_address[0])
+    monkeypatch.setattr(state, 'port', server.server_address[1])
+    monkeypatch.setattr(state, 'suppress', False)
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server recording the messages it receives.
+
+    Attributes:
+        connections (int): Number of connections accepted.
+        messages (list): Data of the messages accepted.
+        failures (int): Number of messages to reject with a temporary
+            error before accepting any.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+
+        self.connections = 0
+        self.messages = []
+        self.failures = 0
+        self.lock = threading.Lock()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """SMTP session of a `SMTPStub` client."""
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+
+        self._reply('220 localhost SMTP stub')
+
+        for line in iter(self.rfile.readline, b''):
+            command = line[:4].upper()
+
+            if command == b'QUIT':
+                self._reply('221 Bye')
+                return
+
+            if command != b'DATA':
+                self._reply('250 OK')
+                continue
+
+            self._reply('354 End data with <CR><LF>.<CR><LF>')
+            data = []
+
+            for data_line in iter(self.rfile.readline, b''):
+                if data_line == b'.\r\n':
+                    break
+
+                data.append(data_line)
+
+            else:
+                # Connection closed while sending the message
+                return
+
+            with self.server.lock:
+                if self.server.failures:
+                    self.server.failures -= 1
+                    self._reply('451 Try again later')
+                    continue
+
+                self.server.messages.append(b''.join(data))
+
+            self._reply('250 OK')
+
+    def _reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+
+def login(app, client, user):
+    """Log the client in as the given user.
+
+    The session identifier is generated as Flask-Login would for the
+    client, so that strong session protection accepts the session.
+    """
+    with app.test_request_context(environ_base=client.environ_base):
+        identifier = login_manager._session_identifier_generator()
+
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+        session['_id'] = identifier
+
+
+def create_user(username, *roles):
+    """Create an active user with the given roles."""
+    user = User(
+        username=username,
+        email='{}@localhost'.format(username),
+        password='',
+        is_active=True
+    )
+    user.roles = [Role.get_role(name) for name in roles]
+
+    db.session.add(user)
+    db.session.commit()
+
+    return user
+
+
+def create_post(title, authors=(), tags=(), ghosted=None, published=True,
+                last_updated=None):
+    """Create a post."""
+    post = Post(
+        title=title,
+        content='Summary of {}<!--aka-break-->Rest of the post'.format(title),
+        is_published=published,
+        last_updated=last_updated or datetime.datetime.utcnow(),
+        ghosted_id=ghosted.id if ghosted else None
+    )
+    post.authors = list(authors)
+    post.tags = {Tag.get_or_new(name) for name in tags}
+
+    db.session.add(post)
+    db.session.commit()
+
+    return post
+
+
+def create_page(route, ghosted=None, published=True):
+    """Create a page."""
+    page = Page(
+        title='Page {}'.format(route),
+        route=route,
+        mini='',
+        content='Contents of {}'.format(route),
+        is_published=published,
+        last_updated=datetime.datetime.utcnow(),
+        ghosted_id=ghosted.id if ghosted else None
+    )
+
+    db.session.add(page)
+    db.session.commit()
+
+    return page
+
+
+def _reset_caches():
+    """Clear the in-process caches, which outlive each test database."""
+    from akamatsu.util import _totals_cache
+    from akamatsu.views.admin import _counts_cache
+
+    feed_cache.clear()
+    identity_cache.clear()
+    page_routes.invalidate()
+    _totals_cache.clear()
+    _counts_cache.clear()
+
+    search_index._backend = None
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Configuration used by the test suite (see `conftest.py`)."""
+
+SECRET_KEY = 'testing'
+TESTING = True
+
+# In-memory database (a single connection shared by all the threads)
+SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+# Forms are submitted without CSRF tokens
+WTF_CSRF_ENABLED = False
+
+# Fast password hashing
+PASSLIB_ALG_BCRYPT_ROUNDS = 4
+
+HASHIDS_SALT = 'testing'
+HASHIDS_LENGTH = 8
+
+PAGE_ITEMS = 5
+
+# Mails are sent synchronously, to a stub server when needed
+USE_MAIL_QUEUE = False
+MAIL_SERVER = 'localhost'
+MAIL_PORT = 25
+MAIL_DEFAULT_SENDER = 'akamatsu@localhost'
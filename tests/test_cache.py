@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the response cache."""
+
+import types
+
+import pytest
+
+from akamatsu.cache import ResponseCache
+
+
+@pytest.fixture
+def response_cache():
+    """Response cache using the memory backend."""
+    cache = ResponseCache()
+    cache.init_app(types.SimpleNamespace(
+        config={'RESPONSE_CACHE_TYPE': 'memory', 'RESPONSE_CACHE_TIMEOUT': 0}
+    ))
+
+    return cache
+
+
+def _view(cache, renders, purge=False):
+    @cache.cached
+    def view():
+        renders.append(True)
+        cache.tag('post:1')
+
+        if purge:
+            # Concurrent edit while the response is rendered
+            cache.purge('post:1')
+
+        return 'rendered {}'.format(len(renders))
+
+    return view
+
+
+def test_response_is_cached(app, database, response_cache):
+    renders = []
+    view = _view(response_cache, renders)
+
+    for _ in range(2):
+        with app.test_request_context('/blog/post'):
+            response = view()
+
+    assert len(renders) == 1
+    assert response.get_data() == b'rendered 1'
+
+
+def test_purge_invalidates_response(app, database, response_cache):
+    renders = []
+    view = _view(response_cache, renders)
+
+    with app.test_request_context('/blog/post'):
+        view()
+
+    response_cache.purge('post:1')
+
+    with app.test_request_context('/blog/post'):
+        response = view()
+
+    assert response.get_data() == b'rendered 2'
+
+
+def test_purge_while_rendering_skips_store(app, database, response_cache):
+    renders = []
+
+    with app.test_request_context('/blog/post'):
+        _view(response_cache, renders, purge=True)()
+
+    with app.test_request_context('/blog/post'):
+        response = _view(response_cache, renders)()
+
+    assert len(renders) == 2
+    assert response.get_data() == b'rendered 2'
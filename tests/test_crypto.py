@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the worker pool of the crypto manager."""
+
+import time
+
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+
+from akamatsu.util import CryptoManager
+
+
+def _slow_hash(context, secret):
+    time.sleep(1)
+    return secret
+
+
+@pytest.fixture
+def manager():
+    """Manager with a single worker and no queue."""
+    manager = CryptoManager()
+    manager._params = {'schemes': ['plaintext']}
+    manager._pool_size = 1
+    manager._queue_limit = 0
+    manager._timeout = 5
+
+    yield manager
+
+    if manager._pool is not None:
+        manager._pool.shutdown()
+
+
+def test_timed_out_operation_stays_pending(manager):
+    # Start the worker process
+    assert manager._run('hash', _slow_hash, 'secret') == 'secret'
+
+    manager._timeout = 0.1
+
+    with pytest.raises(ServiceUnavailable):
+        manager._run('hash', _slow_hash, 'secret')
+
+    # Worker is still busy with the operation
+    assert manager.stats()['pending'] == 1
+
+    with pytest.raises(ServiceUnavailable):
+        manager._run('hash', _slow_hash, 'secret')
+
+    assert manager.stats()['rejected']['count'] == 1
+
+    deadline = time.monotonic() + 5
+
+    while manager.stats()['pending'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert manager.stats()['pending'] == 0
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the validators of the blog feed."""
+
+import datetime
+
+from akamatsu import db
+from akamatsu.models import FEED_VERSION, CacheVersion
+from tests.conftest import create_post, create_user
+
+
+def test_feed_changes_when_post_is_edited(client, database):
+    author = create_user('alice', 'blogger')
+    post = create_post('Original title', authors=[author])
+
+    response = client.get('/blog/_rss')
+    etag = response.headers['ETag']
+
+    assert response.status_code == 200
+    assert client.get('/blog/_rss', headers={'If-None-Match': etag}).status_code == 304
+
+    # Date of the post is not changed
+    post.title = 'Edited title'
+    db.session.commit()
+
+    response = client.get('/blog/_rss', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert b'Edited title' in response.data
+
+
+def test_feed_modified_when_post_is_edited(client, database):
+    yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+
+    author = create_user('alice', 'blogger')
+    post = create_post('Original title', authors=[author], last_updated=yesterday)
+
+    # Feed last changed along with the post
+    CacheVersion.query.filter_by(name=FEED_VERSION).update({'changed_at': yesterday})
+    db.session.commit()
+
+    response = client.get('/blog/_rss')
+    last_modified = response.headers['Last-Modified']
+
+    assert client.get(
+        '/blog/_rss',
+        headers={'If-Modified-Since': last_modified}
+    ).status_code == 304
+
+    # Date of the post is not changed
+    post.title = 'Edited title'
+    db.session.commit()
+
+    response = client.get('/blog/_rss', headers={'If-Modified-Since': last_modified})
+
+    assert response.status_code == 200
+    assert response.headers['Last-Modified'] != last_modified
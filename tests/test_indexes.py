@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the use of indexes in hot queries.
+
+Plans are checked with `EXPLAIN QUERY PLAN` in SQLite. PostgreSQL plans are
+checked as well if `AKAMATSU_TEST_POSTGRES_URI` points to an (empty) test
+database. Sequential scans are disabled there, as they are cheaper than any
+index in tables this small.
+"""
+
+import datetime
+import os
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import and_, or_
+
+from akamatsu import db
+from akamatsu.models import Page, Post, post_tags, user_posts
+
+
+POSTGRES_URI = os.environ.get('AKAMATSU_TEST_POSTGRES_URI')
+
+CASES = (
+    'listing', 'keyset', 'post_ghosts', 'page_ghosts', 'tag_posts',
+    'post_authors'
+)
+
+
+def _queries(session):
+    """Hot queries (see `CASES`) and the index each of them should use."""
+    date = datetime.datetime(2020, 1, 1)
+
+    listing = (
+        session.query(Post)
+        .filter(Post.is_published == True)
+        .filter(Post.ghosted_id == None)
+    )
+
+    return {
+        # Public listing (page numbers)
+        'listing': (
+            listing
+            .order_by(Post.last_updated.desc())
+            .limit(10)
+            .offset(20),
+            'ix_posts_listing'
+        ),
+        # Public listing (keyset)
+        'keyset': (
+            listing
+            .filter(
+                or_(
+                    Post.last_updated < date,
+                    and_(Post.last_updated == date, Post.id < 10)
+                )
+            )
+            .order_by(Post.last_updated.desc(), Post.id.desc())
+            .limit(11),
+            'ix_posts_listing'
+        ),
+        # Ghosts of a post
+        'post_ghosts': (
+            session.query(Post.id).filter(Post.ghosted_id == 1),
+            'ix_posts_ghosted_id'
+        ),
+        # Ghosts of a page
+        'page_ghosts': (
+            session.query(Page.id).filter(Page.ghosted_id == 1),
+            'ix_pages_ghosted_id'
+        ),
+        # Posts of a tag
+        'tag_posts': (
+            session.query(post_tags.c.post_id).filter(post_tags.c.tag_id == 1),
+            'ix_post_tags_tag_id'
+        ),
+        # Authors of a post
+        'post_authors': (
+            session.query(user_posts.c.user_id).filter(user_posts.c.post_id == 1),
+            'ix_user_posts_post_id'
+        ),
+    }
+
+
+def _plan(connection, query, prefix):
+    """Obtain the plan of a query as text.
+
+    Args:
+        connection: Connection to explain the query in.
+        query: ORM query.
+        prefix (str): Statement used to explain the query.
+
+    Returns:
+        Plan.
+    """
+    compiled = query.statement.compile(dialect=connection.dialect)
+    params = compiled.params
+
+    if connection.dialect.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    rows = connection.execute(prefix + ' ' + str(compiled), params).fetchall()
+
+    return '\n'.join(' '.join(str(value) for value in row) for row in rows)
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_sqlite_uses_indexes(database, case):
+    query, name = _queries(database.session)[case]
+    plan = _plan(database.session.connection(), query, 'EXPLAIN QUERY PLAN')
+
+    assert name in plan
+
+    # Listings are read in index order
+    assert 'TEMP B-TREE' not in plan
+
+
+@pytest.fixture
+def postgres(database):
+    """Connection to the PostgreSQL test database, with the tables created."""
+    if not POSTGRES_URI:
+        pytest.skip('AKAMATSU_TEST_POSTGRES_URI is not set')
+
+    engine = sa.create_engine(POSTGRES_URI)
+    db.Model.metadata.create_all(engine)
+
+    connection = engine.connect()
+    connection.execute('SET enable_seqscan = off')
+
+    yield connection
+
+    connection.close()
+    db.Model.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_postgresql_uses_indexes(database, postgres, case):
+    query, name = _queries(database.session)[case]
+    plan = _plan(postgres, query, 'EXPLAIN')
+
+    assert name in plan
+    assert 'Sort' not in plan
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the background delivery of emails."""
+
+import pytest
+from flask_mail import Message
+
+from akamatsu import celery
+from akamatsu.mailer import MailQueue, SMTPConnection
+
+
+def _message(number=0):
+    return Message(
+        subject='Message {}'.format(number),
+        recipients=['alice@localhost'],
+        body='Body'
+    )
+
+
+@pytest.fixture
+def mail_queue(app):
+    """Queue which retries quickly."""
+    queue = MailQueue()
+    queue.init_app(app)
+    queue.max_retries = 2
+    queue.retry_backoff = 1
+
+    yield queue
+
+    queue.stop()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """List of the seconds slept between retries (without sleeping)."""
+    seconds = []
+    monkeypatch.setattr('akamatsu.mailer.time.sleep', seconds.append)
+
+    return seconds
+
+
+def test_queue_reuses_connection(app, smtp_server, mail_queue):
+    with app.app_context():
+        for number in range(3):
+            mail_queue.send(_message(number))
+
+    mail_queue.stop()
+
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.connections == 1
+
+
+def test_queue_retries_with_backoff(app, smtp_server, mail_queue, sleeps):
+    smtp_server.failures = 2
+
+    with app.app_context():
+        connection = SMTPConnection()
+
+        assert mail_queue._deliver(connection, _message())
+
+        connection.close()
+
+    assert sleeps == [1, 2]
+    assert len(smtp_server.messages) == 1
+    # Connection is opened again after each failure
+    assert smtp_server.connections == 3
+
+
+def test_queue_gives_up_after_retries(app, smtp_server, mail_queue, sleeps):
+    smtp_server.failures = 5
+
+    with app.app_context():
+        assert not mail_queue._deliver(SMTPConnection(), _message())
+
+    assert sleeps == [1, 2]
+    assert smtp_server.messages == []
+
+
+@pytest.fixture
+def async_mail(app, smtp_server):
+    """Celery task sending emails, run eagerly."""
+    pytest.importorskip('celery')
+
+    if celery.task is None:
+        app.config['CELERY_BROKER_URL'] = 'memory://'
+        app.config['CELERY_RESULT_BACKEND'] = 'cache+memory://'
+        celery.init_app(app)
+
+    from akamatsu import async_tasks
+
+    yield async_tasks.async_mail
+
+    with app.app_context():
+        async_tasks._smtp.close()
+
+
+def test_task_reuses_connection(smtp_server, async_mail):
+    for number in range(2):
+        async_mail.apply(kwargs={
+            'subject': 'Message {}'.format(number),
+            'recipients': ['alice@localhost'],
+            'body': 'Body'
+        })
+
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 1
+
+
+def test_task_retries(smtp_server, async_mail):
+    smtp_server.failures = 2
+
+    async_mail.apply(kwargs={
+        'subject': 'Message',
+        'recipients': ['alice@localhost'],
+        'body': 'Body'
+    })
+
+    assert len(smtp_server.messages) == 1
+    assert smtp_server.connections == 3
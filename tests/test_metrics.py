@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the access control of the metrics endpoint."""
+
+import pytest
+
+from akamatsu.metrics import Metrics
+
+
+@pytest.fixture
+def metrics():
+    return Metrics()
+
+
+def test_denied_by_default(app, metrics):
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+        assert not metrics._is_allowed()
+
+
+def test_allowed_ips(app, metrics):
+    metrics._allowed_ips = ('10.0.0.1',)
+
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        assert metrics._is_allowed()
+
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+        assert not metrics._is_allowed()
+
+
+def test_token(app, metrics):
+    metrics._token = 'secret'
+
+    with app.test_request_context(headers={'Authorization': 'Bearer secret'}):
+        assert metrics._is_allowed()
+
+    with app.test_request_context(headers={'Authorization': 'Bearer wrong'}):
+        assert not metrics._is_allowed()
+
+    with app.test_request_context():
+        assert not metrics._is_allowed()
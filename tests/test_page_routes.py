@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the invalidation of the page route table."""
+
+from akamatsu import db, page_routes
+from akamatsu.models import Page
+from tests.conftest import create_page
+
+
+def _new_page(route):
+    return Page(
+        title='Page {}'.format(route),
+        route=route,
+        mini='',
+        content='Contents',
+        is_published=True
+    )
+
+
+def test_table_is_invalidated_on_commit(database):
+    create_page('/about')
+
+    assert page_routes.lookup('/about') is not None
+
+    db.session.add(_new_page('/contact'))
+    db.session.flush()
+
+    # Not rebuilt from uncommitted data
+    assert page_routes._version is not None
+
+    db.session.commit()
+
+    assert page_routes._version is None
+    assert page_routes.lookup('/contact') is not None
+
+
+def test_table_is_kept_on_rollback(database):
+    create_page('/about')
+    page_routes.lookup('/about')
+
+    db.session.add(_new_page('/contact'))
+    db.session.flush()
+    db.session.rollback()
+
+    assert page_routes._version is not None
+    assert page_routes.lookup('/contact') is None
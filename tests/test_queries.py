@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the number of queries of listings and the dashboard.
+
+Listings must load the relationships of their items in a fixed number of
+queries, regardless of how many items are shown.
+"""
+
+import pytest
+
+from akamatsu.util import _totals_cache
+from tests.conftest import create_page, create_post, create_user, login
+
+
+@pytest.fixture
+def content(database):
+    """Posts (with authors and tags), ghosts, pages and users.
+
+    Each listing has more items than the largest page size tested, so that
+    every run needs the same count query.
+    """
+    alice = create_user('alice', 'administrator')
+    bob = create_user('bob', 'blogger')
+
+    for i in range(10):
+        create_user('user-{}'.format(i), 'editor')
+
+    posts = [
+        create_post(
+            'Post {}'.format(i),
+            authors=[alice, bob],
+            tags=['tag-a', 'tag-{}'.format(i)]
+        )
+        for i in range(12)
+    ]
+
+    for post in posts:
+        create_post('Ghost of {}'.format(post.title), authors=[bob], ghosted=post)
+
+    pages = [create_page('/page-{}'.format(i)) for i in range(12)]
+
+    for page in pages:
+        create_page('{}-ghost'.format(page.route), ghosted=page)
+
+    return alice
+
+
+def _count_queries(client, queries, url, headers=None):
+    """Request a URL and obtain the number of queries executed."""
+    # Totals of admin listings would be cached otherwise
+    _totals_cache.clear()
+    queries.clear()
+
+    response = client.get(url, headers=headers)
+
+    assert response.status_code == 200
+
+    return len(queries)
+
+
+@pytest.mark.parametrize('url', [
+    '/blog/',
+    '/blog/?cursor=',
+    '/blog/tagged/tag-a',
+    '/blog/by/bob',
+])
+def test_blog_listing_queries_are_constant(app, client, queries, content,
+                                           monkeypatch, url):
+    counts = []
+
+    for per_page in (1, 10):
+        monkeypatch.setitem(app.config, 'PAGE_ITEMS', per_page)
+        counts.append(_count_queries(client, queries, url))
+
+    assert counts[0] == counts[1]
+
+
+def test_feed_queries_are_constant(app, client, queries, database):
+    from akamatsu import feed_cache
+
+    author = create_user('carol', 'blogger')
+    create_post('First', authors=[author], tags=['one'])
+
+    single = _count_queries(client, queries, '/blog/_rss')
+
+    for i in range(10):
+        create_post('Post {}'.format(i), authors=[author], tags=['one', 'two'])
+
+    feed_cache.clear()
+
+    assert _count_queries(client, queries, '/blog/_rss') == single
+
+
+@pytest.mark.parametrize('endpoint', [
+    'post_index',
+    'post_ghosts',
+    'page_index',
+    'page_ghosts',
+    'user_index',
+])
+@pytest.mark.parametrize('ajax', [False, True])
+def test_admin_listing_queries_are_constant(app, client, queries, content,
+                                            monkeypatch, endpoint, ajax):
+    login(app, client, content)
+
+    url = '/admin/{}'.format({
+        'post_index': 'posts',
+        'post_ghosts': 'post-ghosts',
+        'page_index': 'pages',
+        'page_ghosts': 'page-ghosts',
+        'user_index': 'users',
+    }[endpoint])
+    headers = {'x-akamatsu-partial': 'true'} if ajax else None
+
+    counts = []
+
+    for per_page in (1, 10):
+        monkeypatch.setitem(app.config, 'PAGE_ITEMS', per_page)
+        counts.append(_count_queries(client, queries, url, headers))
+
+    assert counts[0] == counts[1]
+
+
+def test_admin_listing_skips_count_in_ajax(app, client, queries, content):
+    login(app, client, content)
+
+    full = _count_queries(client, queries, '/admin/posts')
+    partial = _count_queries(
+        client,
+        queries,
+        '/admin/posts?page=2',
+        {'x-akamatsu-partial': 'true'}
+    )
+
+    # Items (plus one to know if there is a next page) and total, or only
+    # the items
+    assert full - partial == 1
+
+
+def test_dashboard_counters_use_one_cached_query(app, client, queries, content):
+    login(app, client, content)
+
+    _count_queries(client, queries, '/admin/')
+    counters = [q for q in queries if 'count(' in q.lower()]
+
+    assert len(counters) == 1
+
+    # Cached afterwards
+    _count_queries(client, queries, '/admin/')
+
+    assert not [q for q in queries if 'count(' in q.lower()]
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Akamatsu CMS
+# https://github.com/rmed/akamatsu
+#
+# MIT License
+#
+# Copyright (c) 2020 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for chunked uploads."""
+
+import pytest
+
+from akamatsu.models import FileUpload
+from akamatsu.storage import PartialUpload, blob_path, discard_staged
+from akamatsu.views.admin.files import _finalize_chunked_upload
+from tests.conftest import create_user, login
+
+
+CONTENTS = b'0123456789'
+
+
+@pytest.fixture
+def upload_id(app, client, database):
+    """ID of a chunked upload started by a logged in blogger."""
+    login(app, client, create_user('alice', 'blogger'))
+
+    response = client.post(
+        '/admin/files/chunked',
+        json={'filename': 'notes.txt', 'size': len(CONTENTS)}
+    )
+
+    assert response.status_code == 201
+
+    return response.get_json()['id']
+
+
+def _put(client, upload_id, offset, data):
+    return client.put(
+        '/admin/files/chunked/{}?offset={}'.format(upload_id, offset),
+        data=data
+    )
+
+
+def test_chunked_upload(client, upload_id):
+    assert _put(client, upload_id, 0, CONTENTS[:4]).get_json()['offset'] == 4
+
+    response = _put(client, upload_id, 4, CONTENTS[4:])
+    fupload = FileUpload.get_by_path('notes.txt')
+
+    assert response.status_code == 201
+    assert response.get_json()['hashid'] == fupload.hashid
+
+    with open(blob_path(fupload.content_hash), 'rb') as f:
+        assert f.read() == CONTENTS
+
+
+def test_chunk_after_discard_is_not_found(client, upload_id):
+    # Request received before the upload is discarded
+    upload = PartialUpload.get(upload_id)
+    upload.discard()
+
+    with pytest.raises(FileNotFoundError):
+        upload.append(_Stream(CONTENTS), 0)
+
+    assert client.delete('/admin/files/chunked/' + upload_id).status_code == 404
+    assert _put(client, upload_id, 0, CONTENTS).status_code == 404
+
+
+def test_retried_final_chunk_is_not_found(client, upload_id):
+    assert _put(client, upload_id, 0, CONTENTS).status_code == 201
+    assert _put(client, upload_id, 0, CONTENTS).status_code == 404
+    assert FileUpload.query.count() == 1
+
+
+def test_finalize_twice_is_conflict(app, client, upload_id):
+    upload = PartialUpload.get(upload_id)
+    upload.append(_Stream(CONTENTS), 0)
+
+    # Another request finalizes the upload first
+    discard_staged(upload.finalize()[2])
+
+    with app.test_request_context():
+        response, status = _finalize_chunked_upload(upload)
+
+    assert status == 409
+    assert FileUpload.query.count() == 0
+
+
+class _Stream(object):
+    """Binary stream over the given contents."""
+
+    def __init__(self, data):
+        self._data = data
+
+    def read(self, size=-1):
+        chunk, self._data = self._data[:size], self._data[size:]
+        return chunk
+
+
+def test_declared_size_over_limit_is_rejected(app, client, database, monkeypatch):
+    login(app, client, create_user('alice', 'blogger'))
+    monkeypatch.setitem(app.config, 'MAX_UPLOAD_SIZE', len(CONTENTS) - 1)
+
+    response = client.post(
+        '/admin/files/chunked',
+        json={'filename': 'notes.txt', 'size': len(CONTENTS)}
+    )
+
+    assert response.status_code == 413
+    assert PartialUpload.all() == []
+
+
+def test_chunk_over_lowered_limit_is_rejected(app, client, upload_id, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_UPLOAD_SIZE', len(CONTENTS) - 1)
+
+    assert _put(client, upload_id, 0, CONTENTS[:4]).status_code == 413
+    assert PartialUpload.get(upload_id).offset == 0